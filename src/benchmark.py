@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from collections import defaultdict
+
+from vector_helpers import streamToIntervals, parseMeasures, buildCorpus, buildCorpora
+from lib.preprocess.feature_cache import FeatureCache
+from lib.instrumentation.profiler import PROFILER
+
+"""
+Benchmarks for each stage of the pipeline, run on synthetic data so they need
+nothing but music21 and can be repeated offline with a fixed seed.
+
+A catalog of random melodies is generated (a random walk over diatonic pitches,
+optionally with extra accompanying parts), each complaintant is paired with a
+mutated copy of itself as the defendant, and every work is written out as
+MusicXML. Then each stage is timed on its own:
+
+    parse                       music21.converter.parse of one file
+    read                        readScore of one file (see lib/preprocess/score_reader.py)
+    streamToIntervals           one parsed score
+    parseMeasures               one parsed score
+    buildCorpus                 the whole catalog, cold (no feature cache) and warm
+    bm25 / pln                  MusicRanker on one pair of interval vectors
+    lcs / levenshtein           lcsLength / levenshteinDistance on one pair of interval lists
+    lcsDP / levenshteinDistanceDP   the original Music21Helper versions, for comparison
+
+For every stage we report the number of calls, throughput, latency percentiles and
+the peak memory allocated while the stage runs (measured in a separate traced pass
+so the tracing does not skew the timings). Results are written as json, and a
+previous result file can be passed with --compare to print the change per stage.
+
+usage: python benchmark.py --works 20 --length 200 --output bench.json
+"""
+
+STAGES = ["parse", "read", "streamToIntervals", "parseMeasures", "buildCorpus", "bm25", "pln",
+          "lcs", "levenshtein", "lcsDP", "levenshteinDistanceDP"]
+# stages timing the midi_levenshtein_lcs submodule, skipped when it is not checked out
+DP_STAGES = ["lcsDP", "levenshteinDistanceDP"]
+
+
+def syntheticMelody(length, rng, low=22, high=43):
+    """random walk over diatonic note numbers, mostly steps with the odd leap.
+
+    :param length: number of notes
+    :type length: int
+    :param rng: random number generator
+    :type rng: random.Random
+    :rtype: list
+    """
+    steps = [-4, -3, -2, -1, 0, 1, 2, 3, 4]
+    weights = [1, 2, 6, 12, 6, 12, 6, 2, 1]
+    melody = [rng.randint(low + 5, high - 5)]
+    for _ in range(length - 1):
+        note = melody[-1] + rng.choices(steps, weights)[0]
+        melody.append(min(high, max(low, note)))
+    return melody
+
+def mutateMelody(melody, rng, rate=0.2):
+    """copy of a melody with a fraction of its notes changed, dropped or doubled,
+    standing in for the defendant of a case.
+
+    :rtype: list
+    """
+    result = []
+    for note in melody:
+        roll = rng.random()
+        if roll < rate / 3:
+            result.append(note + rng.choice([-2, -1, 1, 2]))
+        elif roll < 2 * rate / 3:
+            continue
+        elif roll < rate:
+            result.extend([note, note])
+        else:
+            result.append(note)
+    return result
+
+def melodyToScore(melody, parts, rng):
+    """build a music21 score in 4/4 with the melody as the first part and
+    parts - 1 random accompanying parts.
+
+    :rtype: music21.stream.Score
+    """
+    from music21 import stream, note, meter
+
+    score = stream.Score()
+    for i in range(parts):
+        pitches = melody if i == 0 else syntheticMelody(len(melody), rng, low=8, high=29)
+        part = stream.Part()
+        part.append(meter.TimeSignature("4/4"))
+        for diatonic in pitches:
+            n = note.Note(quarterLength=rng.choice([0.5, 1, 1, 2]))
+            n.pitch.diatonicNoteNum = diatonic
+            part.append(n)
+        score.insert(0, part.makeMeasures())
+    return score
+
+def syntheticCatalog(directory, works=20, length=200, parts=1, seed=0):
+    """write a synthetic catalog to directory and return it as a cases dictionary
+    (the same shape parseData returns).
+
+    :param works: number of works, half complaintants and half defendants
+    :type works: int
+    :param length: notes in each melody
+    :type length: int
+    :param parts: parts in each score
+    :type parts: int
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    cases = defaultdict(defaultdict)
+    for i in range(max(1, works // 2)):
+        complaintant = syntheticMelody(length, rng)
+        defendant = mutateMelody(complaintant, rng)
+        for role, melody in [("complaintant", complaintant), ("defendant", defendant)]:
+            file = "synthetic_{0}_{1}.xml".format(i, role)
+            melodyToScore(melody, parts, rng).write("musicxml", fp=os.path.join(directory, file))
+            cases["synthetic/{0}".format(i)][role] = {
+                "song": file,
+                "artist": role,
+                "file": file,
+                "fileType": "MXL"
+            }
+    return cases
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def measureStage(fn, inputs, repeat=3):
+    """time fn(*args) for every args in inputs, repeat times, then run it once
+    more under tracemalloc for the peak memory.
+
+    :param fn: function to benchmark
+    :type fn: callable
+    :param inputs: list of argument tuples
+    :type inputs: list
+    :return: calls, total seconds, throughput, latency percentiles (ms) and peak memory (bytes)
+    :rtype: dict
+    """
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for args in inputs:
+            t = time.perf_counter()
+            fn(*args)
+            latencies.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+
+    # with --profile-memory the profiler is tracing already, it keeps its tracing and
+    # the peak is measured from the memory in use when the stage starts
+    was_tracing = tracemalloc.is_tracing()
+    if was_tracing:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        for args in inputs:
+            fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        peak -= base
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    return {
+        "calls": len(latencies),
+        "total_s": total,
+        "throughput_per_s": len(latencies) / total if total else None,
+        "latency_ms": {
+            "mean": 1000 * sum(latencies) / len(latencies) if latencies else None,
+            "p50": 1000 * _percentile(latencies, 0.5) if latencies else None,
+            "p90": 1000 * _percentile(latencies, 0.9) if latencies else None,
+            "p99": 1000 * _percentile(latencies, 0.99) if latencies else None,
+            "max": 1000 * max(latencies) if latencies else None
+        },
+        "peak_memory_bytes": peak
+    }
+
+def dpHelper():
+    """the Music21Helper of the midi_levenshtein_lcs submodule, or None when the
+    submodule is not checked out (see the README).
+
+    :rtype: Music21Helper
+    """
+    try:
+        from lib.midi_levenshtein_lcs.lib.helpers import Music21Helper
+    except ImportError:
+        return None
+    return Music21Helper()
+
+def runBenchmarks(works=20, length=200, parts=1, repeat=3, seed=0, stages=None, vector_min=-20, vector_max=20):
+    """generate a synthetic catalog and benchmark each stage on it.
+
+    :param stages: names of the stages to run, defaults to all of STAGES
+    :type stages: list
+    :return: benchmark results, json serializable
+    :rtype: dict
+    """
+    from music21.converter import parse
+
+    stages = STAGES if stages is None else stages
+    # looked up before the catalog is built, a missing submodule only drops its own stages
+    helper = dpHelper() if any(stage in stages for stage in DP_STAGES) else None
+    if helper is None and any(stage in stages for stage in DP_STAGES):
+        print("warning: skipping {}, the midi_levenshtein_lcs submodule is not checked out".format(
+            " and ".join(DP_STAGES)), file=sys.stderr)
+        stages = [stage for stage in stages if stage not in DP_STAGES]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cases = syntheticCatalog(directory, works, length, parts, seed)
+        files = [case[role]["file"] for case in cases.values() for role in ("complaintant", "defendant")]
+        paths = [(os.path.join(directory, file),) for file in files]
+
+        streams = [(parse(path[0], forceSource=True),) for path in paths]
+        features = buildCorpora(cases, vector_min, vector_max, workers=1, data_dir=directory, cache=None, stats_dir=None)
+        melody_pairs = list(zip(features["intervals"][::2], features["intervals"][1::2]))
+        vector_pairs = list(zip(features["vectors"][1::2], features["vectors"][::2]))
+
+        if "parse" in stages:
+            results["parse"] = measureStage(lambda path: parse(path, forceSource=True), paths, repeat)
+        if "read" in stages:
+            from lib.preprocess.score_reader import readScore
+            results["read"] = measureStage(readScore, paths, repeat)
+        if "streamToIntervals" in stages:
+            results["streamToIntervals"] = measureStage(streamToIntervals, streams, repeat)
+        if "parseMeasures" in stages:
+            results["parseMeasures"] = measureStage(parseMeasures, streams, repeat)
+        if "buildCorpus" in stages:
+            results["buildCorpus_cold"] = measureStage(
+                lambda: buildCorpus(cases, workers=1, data_dir=directory, cache=None, stats_dir=None), [()], 1)
+            cache = FeatureCache(os.path.join(directory, "cache"), "benchmark")
+            buildCorpus(cases, workers=1, data_dir=directory, cache=cache, stats_dir=None)
+            results["buildCorpus_warm"] = measureStage(
+                lambda: buildCorpus(cases, workers=1, data_dir=directory, cache=cache, stats_dir=None), [()], repeat)
+
+        if "bm25" in stages or "pln" in stages:
+            from lib.music_ranker.music_ranker import MusicRanker
+            ranker = MusicRanker(features["vectors"], b=0.75, k=1.2, reference_corpus=features["intervals"])
+            if "bm25" in stages:
+                results["bm25"] = measureStage(ranker.bm25, vector_pairs, repeat)
+            if "pln" in stages:
+                results["pln"] = measureStage(ranker.pivoted_length_normalization, vector_pairs, repeat)
+
+        if "lcs" in stages or "levenshtein" in stages:
+            from lib.sequence_similarity.sequence_similarity import lcsLength, levenshteinDistance
+            if "lcs" in stages:
+                results["lcs"] = measureStage(lcsLength, melody_pairs, repeat)
+            if "levenshtein" in stages:
+                results["levenshtein"] = measureStage(levenshteinDistance, melody_pairs, repeat)
+
+        if helper is not None:
+            if "lcsDP" in stages:
+                results["lcsDP"] = measureStage(helper.lcsDP, melody_pairs, repeat)
+            if "levenshteinDistanceDP" in stages:
+                results["levenshteinDistanceDP"] = measureStage(helper.levenshteinDistanceDP, melody_pairs, repeat)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _gitCommit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {
+                "works": works,
+                "length": length,
+                "parts": parts,
+                "repeat": repeat,
+                "seed": seed
+            }
+        },
+        "stages": results
+    }
+
+def _gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compareResults(old, new):
+    """print the change in median latency and peak memory of every stage between two
+    benchmark results.
+
+    :param old: earlier results (as returned by runBenchmarks)
+    :type old: dict
+    :param new: later results
+    :type new: dict
+    """
+    print("{:<24}{:>14}{:>14}{:>10}{:>16}".format("stage", "old p50 ms", "new p50 ms", "ratio", "peak mem ratio"))
+    for stage, current in new["stages"].items():
+        previous = old["stages"].get(stage)
+        if previous is None:
+            continue
+        old_p50 = previous["latency_ms"]["p50"]
+        new_p50 = current["latency_ms"]["p50"]
+        ratio = new_p50 / old_p50 if old_p50 else float("nan")
+        memory = current["peak_memory_bytes"] / previous["peak_memory_bytes"] if previous["peak_memory_bytes"] else float("nan")
+        print("{:<24}{:>14.3f}{:>14.3f}{:>10.2f}{:>16.2f}".format(stage, old_p50, new_p50, ratio, memory))
+
+def printResults(results):
+    print("{:<24}{:>8}{:>14}{:>12}{:>12}{:>12}{:>14}".format("stage", "calls", "per second", "p50 ms", "p90 ms", "p99 ms", "peak KiB"))
+    for stage, r in results["stages"].items():
+        print("{:<24}{:>8}{:>14.1f}{:>12.3f}{:>12.3f}{:>12.3f}{:>14.1f}".format(
+            stage, r["calls"], r["throughput_per_s"], r["latency_ms"]["p50"], r["latency_ms"]["p90"],
+            r["latency_ms"]["p99"], r["peak_memory_bytes"] / 1024))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the pipeline on synthetic data")
+    parser.add_argument("--works", type=int, default=20, help="number of works in the synthetic catalog")
+    parser.add_argument("--length", type=int, default=200, help="notes per melody")
+    parser.add_argument("--parts", type=int, default=1, help="parts per score")
+    parser.add_argument("--repeat", type=int, default=3, help="timed repetitions of each stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, help="stages to run (default: all)")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="earlier results json to compare against")
+    parser.add_argument("--profile", help="also record every pipeline stage and write the summary / chrome trace here")
+    parser.add_argument("--profile-memory", action="store_true", help="record peak memory per stage in the profile (slow)")
+    args = parser.parse_args()
+    if args.stages and any(stage in args.stages for stage in DP_STAGES) and dpHelper() is None:
+        parser.error("{} need the midi_levenshtein_lcs submodule, see the README".format(" and ".join(DP_STAGES)))
+
+    if args.profile:
+        PROFILER.profileTo(args.profile, memory=args.profile_memory)
+
+    results = runBenchmarks(args.works, args.length, args.parts, args.repeat, args.seed, args.stages)
+    printResults(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compareResults(json.load(f), results)
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import argparse
+
+from music21.converter import parse
+
+from lib.preprocess.score_reader import readScore, UnsupportedScore
+
+from vector_helpers import extractFeatures, featuresFromParts, iterMeasureWords
+
+from constants import DATA_DIR
+
+# checks that the light score readers (see score_reader.py) give the same features as
+# parsing with music21, for every score of the dataset. files the readers decline are
+# parsed by music21 in extractFile, they are listed but do not count as mismatches.
+# music21 opens the .mxl archives itself, so their manifest is checked as well. the
+# streamed measure words (iterMeasureWords) are checked against the extracted ones on
+# every score, declined or not
+
+# the dataset directory also holds the pdf / tif scans of the works
+EXTENSIONS = (".xml", ".mxl", ".mid")
+
+def checkReaderParity(data_dir=DATA_DIR):
+    """compare the features of the score readers and of music21, and the streamed measure
+    words with the extracted ones, on every score in a directory, printing the
+    mismatches, the declined files and the time per file.
+
+    :param data_dir: directory holding the scores
+    :type data_dir: str
+    :return: (file, keys that differ) of every mismatching score
+    :rtype: list
+    """
+    files = sorted(file for file in os.listdir(data_dir) if os.path.splitext(file)[1].lower() in EXTENSIONS)
+    read_time = 0.0
+    parse_time = 0.0
+    mismatches = []
+    declined = []
+    for file in files:
+        path = os.path.join(data_dir, file)
+        start = time.time()
+        try:
+            fast = featuresFromParts(readScore(path))
+            read_time += time.time() - start
+        except UnsupportedScore as e:
+            declined.append((file, str(e)))
+            fast = None
+
+        start = time.time()
+        score = parse(path, forceSource=True)
+        expected = extractFeatures(score)
+        if fast is not None:
+            parse_time += time.time() - start
+
+        different = [] if fast is None else [key for key in expected if fast.get(key) != expected[key]]
+        if list(iterMeasureWords(score)) != expected["words"]:
+            different.append("streamed words")
+        if different:
+            mismatches.append((file, different))
+            print("MISMATCH {}: {}".format(file, ", ".join(different)))
+
+    checked = len(files) - len(declined)
+    print("{} files, {} read, {} declined, {} mismatches".format(len(files), checked, len(declined), len(mismatches)))
+    for file, reason in declined:
+        print("  declined {}: {}".format(file, reason))
+    if checked:
+        print("reader {:.1f} ms/file, music21 {:.1f} ms/file".format(1000 * read_time / checked, 1000 * parse_time / checked))
+    return mismatches
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the features of the score readers with those of music21")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="directory holding the scores (default: {})".format(DATA_DIR))
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.data_dir):
+        parser.error("no such directory {}".format(args.data_dir))
+    return 1 if checkReaderParity(args.data_dir) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+
+"""
+Single entry point for the pipeline. Every stage is a subcommand:
+
+    extract     parse every work of the cases into the feature cache
+    index       write the memory mapped feature store (see lib/preprocess/feature_store.py)
+    evaluate    the horizontal and vertical analysis of main.py, or with --all-pairs
+                every counterpart ranked among all works (evaluate_all_pairs.py)
+    tune        the b / k grid search of tune_params.py
+    query       rank the catalog against one work (by every part with --parts, by all
+                metrics fused with --method fusion), or start the query server
+    passages    find the passages of the catalog that align with a stretch of one work
+    bench       the synthetic benchmarks of benchmark.py
+
+The options shared by every subcommand (--workers, --cache-dir, --profile) go before
+the subcommand name, e.g.
+
+    python cli.py --workers 4 --cache-dir /tmp/features evaluate --seed 1
+
+Only argparse is imported up front, the pipeline modules are imported by the
+subcommand that needs them. music21 in particular is only loaded when a score is
+actually parsed, so --help and runs served from the feature cache start quickly.
+"""
+
+
+def _cache(args):
+    # the feature cache every subcommand reads and writes
+    from vector_helpers import FEATURE_CACHE, EXTRACTOR_VERSION
+    from lib.preprocess.feature_cache import FeatureCache
+
+    if args.cache_dir is None:
+        return FEATURE_CACHE
+    return FeatureCache(args.cache_dir, EXTRACTOR_VERSION)
+
+def _cases():
+    from lib.preprocess.parse_cases import parseData
+    from constants import CASES_XML
+
+    return parseData(CASES_XML)
+
+def extract(args):
+    from vector_helpers import extractCorpusFeatures
+    from lib.preprocess.corpus_stats import CorpusStats
+
+    cache = _cache(args)
+    stats = CorpusStats()
+    features = extractCorpusFeatures(_cases(), workers=args.workers, chunksize=args.chunksize, cache=cache, stats=stats)
+    print("{} works extracted to {} ({} cached, {} parsed)".format(len(features), cache.cache_dir, cache.hits, cache.misses))
+    print("intervals {} to {}, {} measure words".format(stats.interval_min, stats.interval_max, stats.vocab_size))
+
+def index(args):
+    from vector_helpers import buildFeatureStore
+    from constants import STORE_DIR
+
+    directory = args.store_dir if args.store_dir is not None else STORE_DIR
+    store = buildFeatureStore(_cases(), directory, args.vector_min, args.vector_max, workers=args.workers,
+                              chunksize=args.chunksize, cache=_cache(args))
+    print("{} works written to {}".format(len(store), directory))
+
+def checkEvaluate(parser, args):
+    if args.all_pairs and (args.seed is not None or args.screen):
+        parser.error("--seed and --screen are about the random baselines, --all-pairs has none")
+    if args.tile_size < 1:
+        parser.error("--tile-size must be at least 1")
+
+def evaluate(args):
+    if args.all_pairs:
+        from evaluate_all_pairs import evaluateAllPairs
+        from constants import CHECKPOINT_DIR
+
+        checkpoint_dir = CHECKPOINT_DIR if args.checkpoint_dir is None else args.checkpoint_dir
+        evaluateAllPairs(args.vector_min, args.vector_max, args.b, args.k, tile_size=args.tile_size, workers=args.workers,
+                         cache=_cache(args), checkpoint_dir=None if args.no_checkpoint else checkpoint_dir)
+        return
+    from main import main
+
+    main(args.vector_min, args.vector_max, args.b, args.k, workers=args.workers, seed=args.seed, cache=_cache(args), screen=args.screen)
+
+def _grid(low, high, step):
+    # rounded so the steps do not drift, 0.69 rather than 0.6900000000000001
+    return [round(low + i * step, 10) for i in range(int(round((high - low) / step)) + 1)]
+
+def checkTune(parser, args):
+    for name in ("b", "k"):
+        low, high, step = (getattr(args, "{}_{}".format(name, part)) for part in ("min", "max", "step"))
+        if step <= 0:
+            parser.error("--{}-step must be positive".format(name))
+        if low > high:
+            parser.error("--{0}-min must not be larger than --{0}-max".format(name))
+
+def tune(args):
+    from tune_params import tune as tuneParams
+
+    b_values = _grid(args.b_min, args.b_max, args.b_step)
+    k_values = _grid(args.k_min, args.k_max, args.k_step)
+    tuneParams(args.vector_min, args.vector_max, b_values, k_values, workers=args.workers, cache=_cache(args))
+
+def checkQuery(parser, args):
+    if args.serve:
+        if args.file is not None or args.intervals is not None:
+            parser.error("--serve answers queries over http, do not pass a work to query")
+    elif (args.file is None) == (args.intervals is None):
+        parser.error("pass either a score file or --intervals to query")
+    if args.vertical and args.intervals is not None:
+        parser.error("--vertical needs a score file, the measure words can not be derived from intervals")
+    if args.count < 1:
+        parser.error("--count must be at least 1")
+    if args.parts is not None and (args.serve or args.vertical):
+        parser.error("--parts ranks by the intervals of the parts, it can not be combined with --serve or --vertical")
+    if args.method == "fusion" and (args.serve or args.parts is not None):
+        parser.error("--method fusion can not be combined with --serve or --parts")
+
+def query(args):
+    from vector_helpers import buildCorpusManager, buildPartIndex, buildFusionRanker, extractFile
+
+    cache = _cache(args)
+    if args.serve:
+        import asyncio
+        from query_server import QueryServer
+
+        manager = buildCorpusManager(_cases(), args.vector_min, args.vector_max, b=args.b, k=args.k, workers=args.workers, cache=cache)
+        server = QueryServer(manager, workers=args.workers, cache=cache)
+        try:
+            asyncio.run(server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.file is not None:
+        features = cache.getOrExtract(args.file, extractFile)
+    else:
+        features = {"intervals": args.intervals}
+    if args.method == "fusion":
+        # bm25, pln, lcs and levenshtein in one pass over the catalog, fused into one score
+        ranker = buildFusionRanker(_cases(), vertical=args.vertical, fusion=args.fusion, rrf_k=args.rrf_k, b=args.b, k=args.k,
+                                   vector_min=args.vector_min, vector_max=args.vector_max, workers=args.workers, cache=cache)
+        for name, score, metrics in ranker.rankSequence(features["words"] if args.vertical else features["intervals"], args.count):
+            print("{:10.4f}  {}  ({})".format(score, name, ", ".join("{} {:g}".format(metric, value) for metric, value in metrics.items())))
+        return
+    if args.parts is not None:
+        # every part of every work is a document, the part scores are aggregated per work
+        index = buildPartIndex(_cases(), args.vector_min, args.vector_max, b=args.b, k=args.k, workers=args.workers, cache=cache)
+        results = index.topK(features, args.count, args.method, aggregate=args.parts)
+    else:
+        manager = buildCorpusManager(_cases(), args.vector_min, args.vector_max, b=args.b, k=args.k, workers=args.workers, cache=cache)
+        results = manager.topK(features, args.count, args.method, vertical=args.vertical)
+    for name, score in results:
+        print("{:10.4f}  {}".format(score, name))
+
+def _measureRange(span):
+    return "?" if span is None else "{}-{}".format(*span)
+
+def passages(args):
+    from vector_helpers import buildPassageIndex, extractFile, catalogName
+
+    cache = _cache(args)
+    index = buildPassageIndex(_cases(), k=args.seed_length, band=args.band, window=args.window, workers=args.workers, cache=cache)
+    features = cache.getOrExtract(args.file, extractFile)
+    # works can be excluded by their file on disk, e.g. data/cases/song.mxl for song.xml
+    exclude = [catalogName(file) for file in args.exclude or ()]
+    for passage in index.search(features, args.count, exclude=exclude):
+        print("{:6d}  {}  measures {} (query measures {})".format(
+            passage["score"], passage["name"], _measureRange(passage["measures"]), _measureRange(passage["query_measures"])))
+
+def checkBench(parser, args):
+    # benchmark pulls in the pipeline, so the stage names are only checked once parsed
+    from benchmark import STAGES, DP_STAGES, dpHelper
+
+    unknown = [stage for stage in args.stages or () if stage not in STAGES]
+    if unknown:
+        parser.error("unknown stages {} (choose from {})".format(", ".join(unknown), ", ".join(STAGES)))
+    # asked for by name they fail here, the default stages skip them with a warning
+    if args.stages and any(stage in args.stages for stage in DP_STAGES) and dpHelper() is None:
+        parser.error("{} need the midi_levenshtein_lcs submodule, see the README".format(" and ".join(DP_STAGES)))
+
+def bench(args):
+    import json
+    from benchmark import runBenchmarks, printResults, compareResults
+
+    results = runBenchmarks(args.works, args.length, args.parts, args.repeat, args.seed, args.stages)
+    printResults(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compareResults(json.load(f), results)
+
+def _vectorOptions(parser):
+    parser.add_argument("--vector-min", type=int, help="smallest interval with a vector slot (default: from the corpus statistics)")
+    parser.add_argument("--vector-max", type=int, help="largest interval with a vector slot (default: from the corpus statistics)")
+
+def _rankerOptions(parser):
+    parser.add_argument("--b", type=float, default=0.75, help="length normalization of bm25 / pln")
+    parser.add_argument("--k", type=float, default=1.2, help="term frequency saturation of bm25 / pln")
+
+def buildParser():
+    parser = argparse.ArgumentParser(description="Music plagiarism detection pipeline")
+    parser.add_argument("--workers", type=int, default=None, help="processes parsing scores (default: one per cpu, 1 disables the pool)")
+    parser.add_argument("--cache-dir", help="feature cache directory (default: .cache/features)")
+    parser.add_argument("--profile", help="record every stage and write the summary / chrome trace here on exit")
+    parser.add_argument("--profile-memory", action="store_true", help="record peak memory per stage in the profile (slow)")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    command = commands.add_parser("extract", help="parse every work of the cases into the feature cache")
+    command.add_argument("--chunksize", type=int, default=1, help="files handed to a worker at a time")
+    command.set_defaults(run=extract)
+
+    command = commands.add_parser("index", help="write the memory mapped feature store")
+    command.add_argument("--store-dir", help="directory of the store (default: .cache/store)")
+    command.add_argument("--chunksize", type=int, default=1, help="files handed to a worker at a time")
+    _vectorOptions(command)
+    command.set_defaults(run=index)
+
+    command = commands.add_parser("evaluate", help="horizontal and vertical analysis of the cases")
+    _vectorOptions(command)
+    _rankerOptions(command)
+    command.add_argument("--seed", type=int, help="seed for drawing the baseline works, for repeatable results")
+    command.add_argument("--screen", action="store_true", help="decide each comparison with score bounds and early terminating scorers (same results)")
+    command.add_argument("--all-pairs", action="store_true", help="rank every counterpart among all works instead of against a random baseline")
+    command.add_argument("--checkpoint-dir", help="all pairs tiles are saved to and resumed from here (default: .cache/all_pairs)")
+    command.add_argument("--no-checkpoint", action="store_true", help="compute every all pairs tile, save none")
+    command.add_argument("--tile-size", type=int, default=32, help="works per side of an all pairs tile")
+    command.set_defaults(run=evaluate, check=checkEvaluate)
+
+    command = commands.add_parser("tune", help="grid search b and k of bm25 / pln")
+    _vectorOptions(command)
+    command.add_argument("--b-min", type=float, default=0.0)
+    command.add_argument("--b-max", type=float, default=1.0)
+    command.add_argument("--b-step", type=float, default=0.01)
+    command.add_argument("--k-min", type=float, default=0.0)
+    command.add_argument("--k-max", type=float, default=3.0)
+    command.add_argument("--k-step", type=float, default=0.01)
+    command.set_defaults(run=tune, check=checkTune)
+
+    command = commands.add_parser("query", help="rank the catalog against one work, or serve queries")
+    command.add_argument("file", nargs="?", help="MusicXML / MIDI file to query with")
+    command.add_argument("--intervals", type=int, nargs="+", help="query with an interval list instead of a file")
+    command.add_argument("--count", type=int, default=10, help="number of matches to print")
+    command.add_argument("--method", choices=["bm25", "pln", "fusion"], default="bm25", help="score to rank by, fusion combines bm25, pln, lcs and levenshtein")
+    command.add_argument("--fusion", choices=["rrf", "weighted"], default="rrf", help="how --method fusion combines the metrics (see fusion_ranker.py)")
+    command.add_argument("--rrf-k", type=float, default=60, help="rank offset of reciprocal rank fusion")
+    command.add_argument("--vertical", action="store_true", help="rank by measure words instead of intervals")
+    command.add_argument("--parts", choices=["max", "mean", "melody"], help="score every part of the works and aggregate the part scores this way (see part_index.AGGREGATES)")
+    command.add_argument("--serve", action="store_true", help="start the query server instead (see query_server.py)")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8765)
+    _vectorOptions(command)
+    _rankerOptions(command)
+    command.set_defaults(run=query, check=checkQuery)
+
+    command = commands.add_parser("passages", help="find passages of the catalog that align with a stretch of one work")
+    command.add_argument("file", help="MusicXML / MIDI file to search with")
+    command.add_argument("--count", type=int, default=10, help="number of passages to print")
+    command.add_argument("--exclude", nargs="+", help="catalog works not to search, by name or file, e.g. the query itself")
+    command.add_argument("--seed-length", type=int, default=4, help="intervals in a seed")
+    command.add_argument("--band", type=int, default=4, help="diagonals an alignment may stray from its seeds")
+    command.add_argument("--window", type=int, default=16, help="intervals aligned around a cluster of seeds")
+    command.set_defaults(run=passages)
+
+    command = commands.add_parser("bench", help="benchmark each stage on synthetic data")
+    command.add_argument("--works", type=int, default=20, help="number of works in the synthetic catalog")
+    command.add_argument("--length", type=int, default=200, help="notes per melody")
+    command.add_argument("--parts", type=int, default=1, help="parts per score")
+    command.add_argument("--repeat", type=int, default=3, help="timed repetitions of each stage")
+    command.add_argument("--seed", type=int, default=0)
+    command.add_argument("--stages", nargs="+", help="stages to run (default: all, see benchmark.STAGES)")
+    command.add_argument("--output", help="write the results to this json file")
+    command.add_argument("--compare", help="earlier results json to compare against")
+    command.set_defaults(run=bench, check=checkBench)
+
+    return parser
+
+def _inputErrors():
+    # problems with the files the user pointed us at, reported without a traceback.
+    # anything else is a bug and keeps its traceback
+    import zipfile
+    from lib.preprocess.score_reader import ArchiveError
+    from lib.evaluation.all_pairs import CheckpointMismatch
+
+    return (OSError, zipfile.BadZipFile, ArchiveError, CheckpointMismatch)
+
+def run(argv=None):
+    parser = buildParser()
+    args = parser.parse_args(argv)
+    if getattr(args, "check", None) is not None:
+        args.check(parser, args)
+    if args.profile:
+        from lib.instrumentation.profiler import PROFILER
+
+        PROFILER.profileTo(args.profile, memory=args.profile_memory)
+    try:
+        args.run(args)
+    except _inputErrors() as e:
+        print("error: {}".format(e), file=sys.stderr)
+        return 2
+    if args.profile:
+        PROFILER.report()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -4,5 +4,20 @@
 import os
 from pathlib import Path
 
-DATA_DIR = os.path.abspath("./data_clean")
-CASES_XML = Path(__file__).parent.parent / "data/dataset.xml"
\ No newline at end of file
+# the scores of the dataset, compressed MusicXML (.mxl) and midi files. the .mxl archives
+# are read in memory, an unzipped copy of the dataset works as well
+DATA_DIR = os.path.abspath("./data/cases")
+CASES_XML = Path(__file__).parent.parent / "data/dataset.xml"
+# derived features (intervals, measure words, ...) are cached here keyed by file hash
+CACHE_DIR = Path(__file__).parent.parent / ".cache/features"
+# memory mapped columnar store of the whole corpus (see lib/preprocess/feature_store.py)
+STORE_DIR = Path(__file__).parent.parent / ".cache/store"
+# corpus statistics (interval range, histograms, document lengths), one file per corpus
+STATS_DIR = Path(__file__).parent.parent / ".cache/stats"
+# finished tiles of the all pairs evaluation (see lib/evaluation/all_pairs.py)
+CHECKPOINT_DIR = Path(__file__).parent.parent / ".cache/all_pairs"
+# number of processes used to parse scores. None uses one per cpu, 1 disables the pool
+WORKERS = None
+# set MUSIC_PROFILE=profile.json to record the time, memory and cache use of every stage
+# of a run (see lib/instrumentation/profiler.py)
+PROFILE = os.environ.get("MUSIC_PROFILE")
@@ -0,0 +1,70 @@
+import argparse
+
+from lib.music_ranker.music_ranker import MusicRanker
+from lib.evaluation.all_pairs import allPairsMatrices, rankingMetrics, counterpartLists, formatMetrics
+
+# import logic to parse the case dataset
+from lib.preprocess.parse_cases import parseData
+from lib.preprocess.feature_cache import FeatureCache
+
+from vector_helpers import loadFeatures, intervalToVector, getMaxIntervals, FEATURE_CACHE, EXTRACTOR_VERSION
+
+from constants import CASES_XML, WORKERS, CHECKPOINT_DIR
+
+# main.py compares each case against one randomly drawn work, which makes the accuracy
+# depend on the draw. Here every work is scored against every other work and each true
+# counterpart is ranked among all of them.
+
+def evaluateAllPairs(vector_min=None, vector_max=None, b=0.75, k=1.2, tile_size=32, workers=WORKERS, cache=FEATURE_CACHE, checkpoint_dir=CHECKPOINT_DIR):
+    """rank the counterparts of every work among all other works with every metric and
+    print the ranking metrics.
+
+    :param tile_size: works per side of a tile (see allPairsMatrices)
+    :type tile_size: int
+    :param cache: feature cache to read the works from
+    :type cache: FeatureCache
+    :param checkpoint_dir: directory finished tiles are saved to and resumed from, or None
+    :type checkpoint_dir: str
+    :return: metric -> ranking metrics
+    :rtype: dict
+    """
+    files, partners = counterpartLists(CASES_XML)
+
+    if vector_min is None or vector_max is None:
+        # vectors as wide as the intervals of the corpus, from the persisted corpus statistics
+        low, high = getMaxIntervals(parseData(CASES_XML), workers=workers, cache=cache)
+        vector_min = low if vector_min is None else vector_min
+        vector_max = high if vector_max is None else vector_max
+
+    interval_corpus = [loadFeatures(file, cache=cache)["intervals"] for file in files]
+    vector_corpus = [intervalToVector(intervals, vector_min, vector_max) for intervals in interval_corpus]
+
+    ranker = MusicRanker(vector_corpus, b=b, k=k, reference_corpus=interval_corpus)
+
+    matrices = allPairsMatrices(interval_corpus, vector_corpus, ranker.engine, b=ranker.B, k=ranker.K, tile_size=tile_size,
+                                workers=workers, checkpoint_dir=None if checkpoint_dir is None else str(checkpoint_dir))
+    metrics = rankingMetrics(matrices, partners)
+
+    print("{} works, {} counterpart pairs".format(len(files), metrics["bm25"]["pairs"]))
+    for metric, result in metrics.items():
+        print("{:12} {}".format(metric, formatMetrics(result)))
+    return metrics
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rank the counterparts of every work among all other works")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="processes computing tiles (default: one per cpu, 1 disables the pool)")
+    parser.add_argument("--cache-dir", help="feature cache directory (default: .cache/features)")
+    parser.add_argument("--checkpoint-dir", default=str(CHECKPOINT_DIR), help="directory finished tiles are saved to and resumed from")
+    parser.add_argument("--no-checkpoint", action="store_true", help="compute every tile, save none")
+    parser.add_argument("--tile-size", type=int, default=32, help="works per side of a tile")
+    args = parser.parse_args(argv)
+    if args.tile_size < 1:
+        parser.error("--tile-size must be at least 1")
+
+    cache = FEATURE_CACHE if args.cache_dir is None else FeatureCache(args.cache_dir, EXTRACTOR_VERSION)
+    evaluateAllPairs(tile_size=args.tile_size, workers=args.workers, cache=cache,
+                     checkpoint_dir=None if args.no_checkpoint else args.checkpoint_dir)
+
+
+if __name__ == "__main__":
+    main()
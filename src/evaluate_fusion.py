@@ -0,0 +1,67 @@
+import time
+import argparse
+
+import numpy as np
+
+from lib.music_ranker.fusion_ranker import FUSIONS
+from lib.evaluation.all_pairs import rankingMetrics, counterpartLists, formatMetrics
+from lib.preprocess.feature_cache import FeatureCache
+
+# import logic to parse the case dataset
+from lib.preprocess.parse_cases import parseData
+
+from vector_helpers import buildFusionRanker, FEATURE_CACHE, EXTRACTOR_VERSION
+
+from constants import CASES_XML, WORKERS
+
+# compares bm25, pln, lcs and levenshtein on their own with their weighted sum and
+# reciprocal rank fusion (see fusion_ranker.py), on the intervals and on the measure
+# words. every work is a query and each true counterpart is ranked among all other works.
+# the metrics of a query are computed in one pass and fused both ways
+
+def evaluateFusion(b=0.75, k=1.2, rrf_k=60, workers=WORKERS, cache=FEATURE_CACHE):
+    """print the ranking metrics of every metric and of both fusions, on the intervals
+    and on the measure words.
+
+    :param rrf_k: rank offset of reciprocal rank fusion
+    :type rrf_k: float
+    :param cache: feature cache to read the works from
+    :type cache: FeatureCache
+    """
+    files, partners = counterpartLists(CASES_XML)
+    cases = parseData(CASES_XML)
+
+    for vertical in (False, True):
+        # every work of the counterparts, also those whose titles collide in the cases
+        ranker = buildFusionRanker(cases, vertical=vertical, rrf_k=rrf_k, b=b, k=k, workers=workers, cache=cache, files=files)
+        n = len(ranker)
+        matrices = {}
+        start = time.time()
+        for i in range(n):
+            candidates = [j for j in range(n) if j != i]
+            scores = ranker.scores(ranker.vectors[i], ranker.sequences[i], candidates)
+            fused = {fusion: ranker.fuse(scores, fusion) for fusion in FUSIONS}
+            for metric, values in list(scores.items()) + list(fused.items()):
+                # the diagonal is left out of the ranks
+                matrices.setdefault(metric, np.zeros((n, n)))[i, candidates] = values
+        elapsed = (time.time() - start) / n
+
+        print("{}: {} works, {:.1f} ms/query".format("measure words" if vertical else "intervals", n, 1000 * elapsed))
+        for metric, result in rankingMetrics(matrices, partners).items():
+            print("{:12} {}".format(metric, formatMetrics(result)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare each metric with their weighted sum and reciprocal rank fusion")
+    parser.add_argument("--b", type=float, default=0.75, help="length normalization of bm25 / pln")
+    parser.add_argument("--k", type=float, default=1.2, help="term frequency saturation of bm25 / pln")
+    parser.add_argument("--rrf-k", type=float, default=60, help="rank offset of reciprocal rank fusion")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="processes parsing scores missing from the cache")
+    parser.add_argument("--cache-dir", help="feature cache directory (default: .cache/features)")
+    args = parser.parse_args(argv)
+
+    cache = FEATURE_CACHE if args.cache_dir is None else FeatureCache(args.cache_dir, EXTRACTOR_VERSION)
+    evaluateFusion(args.b, args.k, args.rrf_k, args.workers, cache)
+
+
+if __name__ == "__main__":
+    main()
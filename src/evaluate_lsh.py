@@ -0,0 +1,105 @@
+import time
+import argparse
+
+from lib.music_ranker.lsh_index import NearDuplicateIndex
+from lib.sequence_similarity.sequence_similarity import lcsLength
+from lib.evaluation.all_pairs import counterpartLists
+from lib.preprocess.feature_cache import FeatureCache
+
+from vector_helpers import loadFeatures, FEATURE_CACHE, EXTRACTOR_VERSION
+
+from constants import CASES_XML
+
+# measures the recall / speed tradeoff of the MinHash / LSH candidate stage on the cases
+# in dataset.xml. every work is a query, and a counterpart is recalled when it is among
+# the candidates. the exhaustive LCS scan is the baseline for the time per query
+
+# (bands, rows), from strict to loose
+CONFIGS = [(8, 16), (16, 8), (32, 4), (64, 2), (128, 1)]
+
+def evaluateLSH(configs=CONFIGS, interval_n=4, word_n=2, num_perm=128, count=10, cache=FEATURE_CACHE):
+    """print the recall, candidate fraction and time per query of every band / row setting.
+
+    :param configs: (bands, rows) settings to evaluate
+    :type configs: list
+    :param interval_n: length of the interval n-grams
+    :type interval_n: int
+    :param word_n: length of the measure word n-grams
+    :type word_n: int
+    :param num_perm: number of hash functions of a signature
+    :type num_perm: int
+    :param count: a counterpart is a hit when it is among this many best works
+    :type count: int
+    :param cache: feature cache to read the works from
+    :type cache: FeatureCache
+    """
+    files, partners = counterpartLists(CASES_XML)
+    features = [loadFeatures(file, cache=cache) for file in files]
+    interval_corpus = [work["intervals"] for work in features]
+    word_corpus = [work["words"] for work in features]
+
+    def exhaustive(query):
+        scores = [(-lcsLength(interval_corpus[query], melody), doc_id) for doc_id, melody in enumerate(interval_corpus) if doc_id != query]
+        return [doc_id for _, doc_id in sorted(scores)[:count]]
+
+    start = time.time()
+    exact_top = [exhaustive(query) for query in range(len(files))]
+    exact_time = (time.time() - start) / len(files)
+
+    pairs = sum(len(others) for others in partners)
+    exact_hits = sum(1 for query, others in enumerate(partners) for other in others if other in exact_top[query])
+    print("{} works, {} counterpart pairs, interval {}-grams, measure word {}-grams, {} hashes".format(
+        len(files), pairs, interval_n, word_n, num_perm))
+    print("exhaustive LCS: {:.2f} ms per query, counterpart in top {} {:.3f}".format(1000 * exact_time, count, exact_hits / pairs))
+
+    for bands, rows in configs:
+        lsh = NearDuplicateIndex(interval_corpus, word_corpus, interval_n=interval_n, word_n=word_n, num_perm=num_perm, bands=bands, rows=rows)
+        recalled = 0
+        top_hits = 0
+        n_candidates = 0
+        start = time.time()
+        for query, others in enumerate(partners):
+            candidates = {doc_id for doc_id, _ in lsh.candidates(interval_corpus[query], word_corpus[query])}
+            candidates.discard(query)
+            top = [doc_id for doc_id, _ in lsh.search(interval_corpus[query], word_corpus[query], count=count + 1) if doc_id != query][:count]
+            n_candidates += len(candidates)
+            for other in others:
+                recalled += other in candidates
+                top_hits += other in top
+        elapsed = (time.time() - start) / len(files)
+        print("bands {:3} rows {:2}: recall {:.3f}  counterpart in top {} {:.3f}  candidates {:.1%}  {:.2f} ms per query".format(
+            bands, rows, recalled / pairs, count, top_hits / pairs, n_candidates / (len(files) * (len(files) - 1)), 1000 * elapsed))
+
+def _config(text):
+    # BANDSxROWS, e.g. 32x4
+    try:
+        bands, rows = (int(part) for part in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected BANDSxROWS, e.g. 32x4, got {}".format(text))
+    if bands < 1 or rows < 1:
+        raise argparse.ArgumentTypeError("bands and rows must be positive, got {}".format(text))
+    return bands, rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recall and speed of the MinHash / LSH candidate stage on the cases")
+    parser.add_argument("--configs", type=_config, nargs="+", default=CONFIGS, metavar="BANDSxROWS",
+                        help="band / row settings to evaluate (default: {})".format(" ".join("{}x{}".format(*config) for config in CONFIGS)))
+    parser.add_argument("--num-perm", type=int, default=128, help="hash functions per signature")
+    parser.add_argument("--interval-n", type=int, default=4, help="length of the interval n-grams")
+    parser.add_argument("--word-n", type=int, default=2, help="length of the measure word n-grams")
+    parser.add_argument("--count", type=int, default=10, help="a counterpart is a hit among this many best works")
+    parser.add_argument("--cache-dir", help="feature cache directory (default: .cache/features)")
+    args = parser.parse_args(argv)
+    for name in ("num_perm", "interval_n", "word_n", "count"):
+        if getattr(args, name) < 1:
+            parser.error("--{} must be at least 1".format(name.replace("_", "-")))
+    too_long = ["{}x{}".format(bands, rows) for bands, rows in args.configs if bands * rows > args.num_perm]
+    if too_long:
+        parser.error("{} need more than --num-perm {} hashes".format(", ".join(too_long), args.num_perm))
+
+    cache = FEATURE_CACHE if args.cache_dir is None else FeatureCache(args.cache_dir, EXTRACTOR_VERSION)
+    evaluateLSH(args.configs, args.interval_n, args.word_n, args.num_perm, args.count, cache)
+
+
+if __name__ == "__main__":
+    main()
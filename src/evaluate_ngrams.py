@@ -0,0 +1,70 @@
+import time
+import argparse
+
+import numpy as np
+
+from lib.music_ranker.music_ranker import MusicRanker
+from lib.music_ranker.scoring_engine import ScoringEngine
+from lib.preprocess.hashed_features import NgramFeatures
+from lib.evaluation.all_pairs import rankingMetrics, counterpartLists, formatMetrics
+from lib.preprocess.feature_cache import FeatureCache
+
+# import logic to parse the case dataset
+from lib.preprocess.parse_cases import parseData
+
+from vector_helpers import loadFeatures, intervalToVector, getMaxIntervals, FEATURE_CACHE, EXTRACTOR_VERSION
+
+from constants import CASES_XML
+
+# compares the single interval vectors of intervalToVector with hashed n-gram vectors
+# (see hashed_features.py). every work is a query and each true counterpart is ranked
+# among all other works by bm25
+
+CONFIGS = [
+    ("interval 1-3 grams", NgramFeatures(ngrams=(1, 2, 3), contour=0, rhythm=False)),
+    ("interval 1-3 grams + rhythm", NgramFeatures(ngrams=(1, 2, 3), contour=0, rhythm=True)),
+    ("interval 1-3 grams + contour", NgramFeatures(ngrams=(1, 2, 3), contour=4, rhythm=False)),
+    ("all, 4096 slots", NgramFeatures()),
+    ("all, 512 slots", NgramFeatures(width=512))
+]
+
+def _evaluate(name, vectors, partners, b):
+    # a work is as long as the sum of its counts: its number of intervals or of tokens
+    engine = ScoringEngine.fromStream((vector, sum(vector)) for vector in vectors)
+    ranker = MusicRanker(vectors, b=b, engine=engine)
+    matrix = np.array([ranker.bm25Batch(vector, vectors) for vector in vectors])
+    result = rankingMetrics({"bm25": matrix}, partners)["bm25"]
+    print("{:46} {}".format(name, formatMetrics(result)))
+
+def evaluateNgrams(configs=CONFIGS, b=0.75, cache=FEATURE_CACHE):
+    """print the ranking metrics of the interval vectors and of every hashed n-gram setting.
+
+    :param configs: (name, NgramFeatures) settings to evaluate
+    :type configs: list
+    :param cache: feature cache to read the works from
+    :type cache: FeatureCache
+    """
+    files, partners = counterpartLists(CASES_XML)
+    features = [loadFeatures(file, cache=cache) for file in files]
+
+    vector_min, vector_max = getMaxIntervals(parseData(CASES_XML), cache=cache)
+    _evaluate("intervals", [intervalToVector(work["intervals"], vector_min, vector_max) for work in features], partners, b)
+
+    for name, hasher in configs:
+        start = time.time()
+        vectors = [hasher.vector(work) for work in features]
+        elapsed = (time.time() - start) / len(features)
+        _evaluate("{} ({:.2f} ms/work)".format(name, 1000 * elapsed), vectors, partners, b)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare interval vectors with hashed n-gram vectors")
+    parser.add_argument("--b", type=float, default=0.75, help="length normalization of bm25")
+    parser.add_argument("--cache-dir", help="feature cache directory (default: .cache/features)")
+    args = parser.parse_args(argv)
+
+    cache = FEATURE_CACHE if args.cache_dir is None else FeatureCache(args.cache_dir, EXTRACTOR_VERSION)
+    evaluateNgrams(b=args.b, cache=cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+from functools import partial
+
+import numpy as np
+
+from lib.music_ranker.part_index import PartIndex, AGGREGATES
+from lib.evaluation.all_pairs import rankingMetrics, counterpartLists, formatMetrics
+from lib.preprocess.feature_cache import FeatureCache
+
+from vector_helpers import loadFeatures, intervalToVector, FEATURE_CACHE, EXTRACTOR_VERSION
+
+from constants import CASES_XML
+
+# compares scoring only the first part of every work (what main.py does) with scoring every
+# part as its own sub-document and aggregating the part scores per work (see part_index.py).
+# every work is a query and each true counterpart is ranked among all other works
+
+def evaluateParts(b=0.75, k=1.2, cache=FEATURE_CACHE):
+    """print the ranking metrics of the first part against every aggregate of the part scores.
+
+    :param cache: feature cache to read the works from
+    :type cache: FeatureCache
+    """
+    files, partners = counterpartLists(CASES_XML)
+    features = [loadFeatures(file, cache=cache) for file in files]
+    intervals = [interval for work in features for part in work["parts"] for interval in part["intervals"]]
+    vectorize = partial(intervalToVector, start=min(intervals), end=max(intervals))
+
+    # the first part only, every work is a single document
+    first = PartIndex([(file, {"parts": work["parts"][:1]}) for file, work in zip(files, features)], vectorize, b=b, k=k)
+    parts = PartIndex(zip(files, features), vectorize, b=b, k=k)
+
+    print("{} works, {} parts, {} works with more than one part".format(
+        len(files), sum(len(work["parts"]) for work in features), sum(1 for work in features if len(work["parts"]) > 1)))
+    for method in ("bm25", "pln"):
+        runs = [("first part", first, "max")] + [(aggregate, parts, aggregate) for aggregate in AGGREGATES]
+        for name, part_index, aggregate in runs:
+            matrix = np.array([part_index.scores(work, method, aggregate) for work in features])
+            result = rankingMetrics({method: matrix}, partners)[method]
+            print("{:5} {:11} {}".format(method, name, formatMetrics(result)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare scoring the first part with scoring every part of the works")
+    parser.add_argument("--b", type=float, default=0.75, help="length normalization of bm25 / pln")
+    parser.add_argument("--k", type=float, default=1.2, help="term frequency saturation of bm25 / pln")
+    parser.add_argument("--cache-dir", help="feature cache directory (default: .cache/features)")
+    args = parser.parse_args(argv)
+
+    cache = FEATURE_CACHE if args.cache_dir is None else FeatureCache(args.cache_dir, EXTRACTOR_VERSION)
+    evaluateParts(args.b, args.k, cache)
+
+
+if __name__ == "__main__":
+    main()
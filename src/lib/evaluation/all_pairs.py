@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from lib.sequence_similarity.sequence_similarity import lcsLength, levenshteinDistance
+from lib.preprocess.parse_cases import buildCounterparts
+
+"""
+This file contains the all pairs evaluation. Instead of comparing each complaintant
+with its defendant and one randomly drawn work, every work in the catalog is scored
+against every other work with BM25, PLN, LCS and Levenshtein, and the accuracy
+metrics are read off the resulting N x N matrices.
+
+matrix[i][j] is the score of work i as the query (dwork) against work j as the
+candidate (cwork). LCS and Levenshtein are symmetric, so only the upper triangle
+of tiles is computed and mirrored. BM25 and PLN are not, but each row of a tile is
+a single batched call to the ScoringEngine (equal to MusicRanker.bm25 and
+pivoted_length_normalization up to the last bit of float rounding).
+
+The matrix is computed in square tiles spread over a process pool. When a
+checkpoint directory is given every finished tile is saved there, and a later run
+with the same inputs only computes the tiles that are missing.
+
+For the ranking metrics higher is better for BM25, PLN and LCS, and lower is better
+for the Levenshtein distance.
+"""
+
+METRICS = ("bm25", "pln", "lcs", "levenshtein")
+HIGHER_IS_BETTER = {
+    "bm25": True,
+    "pln": True,
+    "lcs": True,
+    "levenshtein": False
+}
+
+# set in every worker process by _initWorker so the corpus is sent once per worker, not per tile
+_STATE = None
+
+
+class CheckpointMismatch(ValueError):
+    # the checkpoint directory holds tiles computed from other inputs
+    pass
+
+
+def _initWorker(state):
+    global _STATE
+    _STATE = state
+
+def _tileRange(tile, tile_size, n):
+    return range(tile * tile_size, min(n, (tile + 1) * tile_size))
+
+def _computeTile(ti, tj):
+    intervals, vectors, engine, b, k, tile_size = _STATE
+    n = len(intervals)
+    rows = _tileRange(ti, tile_size, n)
+    cols = _tileRange(tj, tile_size, n)
+
+    lcs = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    lev = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    for r, i in enumerate(rows):
+        for c, j in enumerate(cols):
+            # on a diagonal tile the lower triangle is the mirror of the upper one
+            if ti == tj and j < i:
+                continue
+            lcs[r, c] = lcsLength(intervals[i], intervals[j])
+            lev[r, c] = levenshteinDistance(intervals[i], intervals[j])
+    if ti == tj:
+        lcs = np.triu(lcs) + np.triu(lcs, 1).T
+        lev = np.triu(lev) + np.triu(lev, 1).T
+
+    col_vectors = vectors[cols.start:cols.stop]
+    tile = {
+        "lcs": lcs,
+        "levenshtein": lev,
+        "bm25": np.array([engine.bm25Batch(vectors[i], col_vectors, b) for i in rows]),
+        "pln": np.array([engine.pivotedLengthNormalizationBatch(vectors[i], col_vectors, b, k) for i in rows])
+    }
+    if ti != tj:
+        # the mirrored tile of the asymmetric scores
+        row_vectors = vectors[rows.start:rows.stop]
+        tile["bm25_t"] = np.array([engine.bm25Batch(vectors[j], row_vectors, b) for j in cols])
+        tile["pln_t"] = np.array([engine.pivotedLengthNormalizationBatch(vectors[j], row_vectors, b, k) for j in cols])
+    return ti, tj, tile
+
+
+def _fingerprint(intervals, vectors, b, k, tile_size):
+    # identifies the inputs of a run so a checkpoint is never resumed with different data
+    digest = hashlib.sha256()
+    digest.update(json.dumps([b, k, tile_size, len(intervals)]).encode())
+    for melody in intervals:
+        digest.update(json.dumps(np.asarray(melody).tolist()).encode())
+    digest.update(np.ascontiguousarray(vectors, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def _tilePath(checkpoint_dir, ti, tj):
+    return os.path.join(checkpoint_dir, "tile_{0}_{1}.npz".format(ti, tj))
+
+def _saveTile(checkpoint_dir, ti, tj, tile):
+    # write then rename so an interrupted run never leaves a half written tile behind
+    fd, tmp = tempfile.mkstemp(dir=checkpoint_dir, suffix=".npz")
+    os.close(fd)
+    np.savez(tmp, **tile)
+    os.replace(tmp, _tilePath(checkpoint_dir, ti, tj))
+
+def _openCheckpoint(checkpoint_dir, fingerprint):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest = os.path.join(checkpoint_dir, "manifest.json")
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            if json.load(f).get("fingerprint") != fingerprint:
+                raise CheckpointMismatch("{0} holds tiles for different inputs. Use another directory or clear it".format(checkpoint_dir))
+    else:
+        with open(manifest, "w") as f:
+            json.dump({"fingerprint": fingerprint}, f)
+
+
+def allPairsMatrices(intervals, vectors, engine, b=0.75, k=1.2, tile_size=32, workers=None, checkpoint_dir=None):
+    """score every work against every other work with every metric.
+
+    :param intervals: interval list of every work
+    :type intervals: list
+    :param vectors: interval vector of every work
+    :type vectors: list
+    :param engine: scoring engine built over the vectors (MusicRanker.engine)
+    :type engine: ScoringEngine
+    :param b: length normalization parameter
+    :type b: float
+    :param k: term frequency saturation parameter
+    :type k: float
+    :param tile_size: works per side of a tile
+    :type tile_size: int
+    :param workers: number of processes. None uses one per cpu, 1 computes in this process
+    :type workers: int
+    :param checkpoint_dir: optional directory finished tiles are saved to and resumed from
+    :type checkpoint_dir: str
+    :return: metric -> N x N matrix
+    :rtype: dict
+    """
+    n = len(intervals)
+    vectors = np.asarray(vectors)
+    matrices = {metric: np.zeros((n, n)) for metric in METRICS}
+    n_tiles = (n + tile_size - 1) // tile_size
+    # symmetric deduplication: tile (tj, ti) is the transpose of tile (ti, tj)
+    tiles = [(ti, tj) for ti in range(n_tiles) for tj in range(ti, n_tiles)]
+
+    def place(ti, tj, tile):
+        rows = _tileRange(ti, tile_size, n)
+        cols = _tileRange(tj, tile_size, n)
+        for metric in METRICS:
+            matrices[metric][rows.start:rows.stop, cols.start:cols.stop] = tile[metric]
+        if ti != tj:
+            matrices["lcs"][cols.start:cols.stop, rows.start:rows.stop] = tile["lcs"].T
+            matrices["levenshtein"][cols.start:cols.stop, rows.start:rows.stop] = tile["levenshtein"].T
+            matrices["bm25"][cols.start:cols.stop, rows.start:rows.stop] = tile["bm25_t"]
+            matrices["pln"][cols.start:cols.stop, rows.start:rows.stop] = tile["pln_t"]
+
+    todo = tiles
+    if checkpoint_dir is not None:
+        _openCheckpoint(checkpoint_dir, _fingerprint(intervals, vectors, b, k, tile_size))
+        todo = []
+        for ti, tj in tiles:
+            path = _tilePath(checkpoint_dir, ti, tj)
+            if os.path.exists(path):
+                with np.load(path) as saved:
+                    place(ti, tj, {key: saved[key] for key in saved.files})
+            else:
+                todo.append((ti, tj))
+
+    state = (intervals, vectors, engine, b, k, tile_size)
+    if workers == 1 or len(todo) <= 1:
+        _initWorker(state)
+        finished = (_computeTile(ti, tj) for ti, tj in todo)
+        for ti, tj, tile in finished:
+            place(ti, tj, tile)
+            if checkpoint_dir is not None:
+                _saveTile(checkpoint_dir, ti, tj, tile)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(state,)) as pool:
+            futures = [pool.submit(_computeTile, ti, tj) for ti, tj in todo]
+            # save tiles as they finish so an interrupted run loses as little as possible
+            for future in as_completed(futures):
+                ti, tj, tile = future.result()
+                place(ti, tj, tile)
+                if checkpoint_dir is not None:
+                    _saveTile(checkpoint_dir, ti, tj, tile)
+
+    return matrices
+
+
+def counterpartLists(filePath):
+    """every distinct work of the case dataset, in the order it first appears, and for
+    each of them the indices of the works it was litigated with. This is the query set of
+    the all pairs evaluations. buildFileList is keyed by title, so songs sharing a title
+    would overwrite each other there.
+
+    :param filePath: path to the case data
+    :type filePath: str
+    :return: (files, counterparts), counterparts as passed to rankingMetrics
+    :rtype: tuple
+    """
+    counterparts = buildCounterparts(filePath)
+    files = list(counterparts)
+    index = {file: i for i, file in enumerate(files)}
+    return files, [[index[other] for other in counterparts[file]] for file in files]
+
+def counterpartRanks(matrix, counterparts, higher_is_better=True):
+    """rank of every true counterpart among all other works, for each work as the query.
+    Ties are counted as half a place, so a constant score does not look like a hit.
+
+    :param matrix: N x N scores, matrix[i][j] = query i against candidate j
+    :type matrix: np.ndarray
+    :param counterparts: for each work, the indices of the works it was litigated with
+    :type counterparts: list
+    :param higher_is_better: whether a higher score means more similar
+    :type higher_is_better: bool
+    :return: list of (query, counterpart, rank) with rank 1 being the best
+    :rtype: list
+    """
+    scores = matrix if higher_is_better else -matrix
+    ranks = []
+    for i, partners in enumerate(counterparts):
+        row = np.delete(scores[i], i)
+        for j in partners:
+            if j == i:
+                continue
+            target = scores[i][j]
+            better = int(np.sum(row > target))
+            # the counterpart itself is one of the ties
+            ties = int(np.sum(row == target)) - 1
+            ranks.append((i, j, 1 + better + ties / 2.0))
+    return ranks
+
+def rankingMetrics(matrices, counterparts):
+    """accuracy metrics of every scoring method from the all pairs matrices.
+
+    :param matrices: metric -> N x N matrix (see allPairsMatrices). Scores not named
+    after a metric, e.g. a fused score, are taken as higher is better
+    :type matrices: dict
+    :param counterparts: for each work, the indices of the works it was litigated with
+    :type counterparts: list
+    :return: metric -> mean reciprocal rank, mean and median rank of the counterparts,
+    and the fraction of counterparts ranked first
+    :rtype: dict
+    """
+    results = {}
+    for metric, matrix in matrices.items():
+        ranks = np.array([rank for _, _, rank in counterpartRanks(matrix, counterparts, HIGHER_IS_BETTER.get(metric, True))])
+        if len(ranks) == 0:
+            continue
+        results[metric] = {
+            "mrr": float(np.mean(1.0 / ranks)),
+            "mean_rank": float(np.mean(ranks)),
+            "median_rank": float(np.median(ranks)),
+            "top1": float(np.mean(ranks == 1)),
+            "pairs": int(len(ranks))
+        }
+    return results
+
+def formatMetrics(result):
+    """one line summary of the ranking metrics of a scoring method.
+
+    :param result: ranking metrics of one method, see rankingMetrics
+    :type result: dict
+    :rtype: str
+    """
+    return "MRR {:.3f}  mean rank {:.1f}  median rank {:.1f}  top-1 {:.3f}".format(
+        result["mrr"], result["mean_rank"], result["median_rank"], result["top1"])
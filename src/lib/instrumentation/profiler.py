@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+import statistics
+import tracemalloc
+from collections import defaultdict
+
+"""
+This file contains the instrumentation layer of the pipeline. Stages (parsing,
+extractParts, corpus building, the rankers, the string scores) report to a
+single Profiler, PROFILER, which records for each stage and each file:
+
+    wall time and call count
+    counters such as feature cache hits and misses
+    peak memory allocated while the stage ran (only with memory=True, tracemalloc
+    slows python down a lot)
+    annotations such as the number of notes of a score
+
+When the profiler is disabled, which is the default, a stage costs one attribute
+check. Enable it with PROFILER.enable() or PROFILER.profileTo(path), the latter
+also writes the results when the process exits. The result file is json with a
+summary per stage, the outlier files, and a "traceEvents" list, so the same file
+can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+Outliers are files whose time in a stage (or annotation, e.g. notes) is more than
+OUTLIER_FACTOR times the median over all files, usually very long scores.
+
+usage:
+
+    with PROFILER.stage("parse", file=path):
+        ...
+
+    @instrument("lcs")
+    def lcsLength(a, b): ...
+
+    PROFILER.count("feature_cache", "hit")
+"""
+
+OUTLIER_FACTOR = 5.0
+# files need at least this many milliseconds in a stage to be flagged, so that a
+# 0.1ms call next to a 0.01ms median is not reported
+OUTLIER_MIN_MS = 1.0
+
+
+class _NullStage(object):
+    # shared by every stage while the profiler is disabled
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+
+    def __init__(self, profiler, name, file):
+        self.profiler = profiler
+        self.name = name
+        self.file = file
+
+    def __enter__(self):
+        self.profiler._push(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.profiler._pop(self, end)
+        return False
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.reset()
+
+    def reset(self):
+        """forget everything recorded so far."""
+        self.stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_bytes": 0})
+        self.files = defaultdict(lambda: defaultdict(float))
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.annotations = defaultdict(dict)
+        self.events = []
+        self._local = threading.local()
+
+    def enable(self, memory=False):
+        """start recording.
+
+        :param memory: also record the peak memory of every stage with tracemalloc
+        :type memory: bool
+        """
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.memory = False
+
+    def profileTo(self, path, memory=False):
+        """enable the profiler and write the results to path when the process exits.
+
+        :param path: json file for the summary and chrome trace
+        :type path: str
+        :param memory: also record peak memory
+        :type memory: bool
+        """
+        self.enable(memory)
+        atexit.register(self.save, path)
+
+    def stage(self, name, file=None):
+        """context manager timing one run of a stage.
+
+        :param name: stage name
+        :type name: str
+        :param file: optional file the stage is working on, for the per file report
+        :type file: str
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, file)
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _push(self, stage):
+        stack = self._stack()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak counter is shared, hand what was seen so far to the enclosing stage
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            stage.base = current
+            stage.peak = current
+        stack.append(stage)
+
+    def _pop(self, stage, end):
+        stack = self._stack()
+        stack.pop()
+        elapsed = end - stage.start
+        record = self.stages[stage.name]
+        record["calls"] += 1
+        record["seconds"] += elapsed
+        record["max_seconds"] = max(record["max_seconds"], elapsed)
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            stage.peak = max(stage.peak, peak)
+            record["peak_bytes"] = max(record["peak_bytes"], stage.peak - stage.base)
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, stage.peak)
+        if stage.file is not None:
+            self.files[stage.file][stage.name] += elapsed
+        self.events.append({
+            "name": stage.name,
+            "ph": "X",
+            # perf_counter is the system wide monotonic clock, so events of worker processes line up
+            "ts": 1e6 * stage.start,
+            "dur": 1e6 * elapsed,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {"file": stage.file} if stage.file is not None else {}
+        })
+
+    def count(self, name, key, amount=1):
+        """increment a counter, e.g. count("feature_cache", "hit").
+
+        :type name: str
+        :type key: str
+        :type amount: int
+        """
+        if self.enabled:
+            self.counters[name][key] += amount
+
+    def annotate(self, file, **values):
+        """attach numbers to a file, e.g. annotate(path, notes=1200). Annotations take
+        part in the outlier detection like stage times.
+
+        :param file: file the values belong to
+        :type file: str
+        """
+        if self.enabled and file is not None:
+            self.annotations[file].update(values)
+
+    def drain(self):
+        """hand over everything recorded in this process and start over. Used by worker
+        processes, the parent passes the result to merge.
+
+        :rtype: dict
+        """
+        state = {
+            "stages": dict(self.stages),
+            "files": {file: dict(times) for file, times in self.files.items()},
+            "counters": {name: dict(keys) for name, keys in self.counters.items()},
+            "annotations": dict(self.annotations),
+            "events": self.events
+        }
+        self.reset()
+        return state
+
+    def merge(self, state):
+        """add the records of another process (see drain).
+
+        :type state: dict
+        """
+        for name, other in state["stages"].items():
+            record = self.stages[name]
+            record["calls"] += other["calls"]
+            record["seconds"] += other["seconds"]
+            record["max_seconds"] = max(record["max_seconds"], other["max_seconds"])
+            record["peak_bytes"] = max(record["peak_bytes"], other["peak_bytes"])
+        for file, times in state["files"].items():
+            for name, seconds in times.items():
+                self.files[file][name] += seconds
+        for name, keys in state["counters"].items():
+            for key, amount in keys.items():
+                self.counters[name][key] += amount
+        for file, values in state["annotations"].items():
+            self.annotations[file].update(values)
+        # worker events keep their own pid, so they show up as separate processes in the trace
+        self.events.extend(state["events"])
+
+    def outliers(self, factor=OUTLIER_FACTOR):
+        """files that took far longer than the others in some stage, or have far
+        larger annotations.
+
+        :param factor: how many times the median counts as an outlier
+        :type factor: float
+        :return: list of {"file", "measure", "value", "median"}, largest ratio first
+        :rtype: list
+        """
+        measures = defaultdict(dict)
+        for file, times in self.files.items():
+            for name, seconds in times.items():
+                measures[name][file] = 1000 * seconds
+        for file, values in self.annotations.items():
+            for name, value in values.items():
+                measures[name][file] = value
+
+        flagged = []
+        for name, values in measures.items():
+            if len(values) < 3:
+                continue
+            median = statistics.median(values.values())
+            for file, value in values.items():
+                is_time = name in self.stages
+                if value > factor * median and (not is_time or value >= OUTLIER_MIN_MS):
+                    flagged.append({"file": file, "measure": name + ("_ms" if is_time else ""), "value": value, "median": median})
+        return sorted(flagged, key=lambda f: -f["value"] / f["median"] if f["median"] else float("-inf"))
+
+    def summary(self):
+        """everything recorded, json serializable.
+
+        :rtype: dict
+        """
+        return {
+            "stages": {
+                name: {
+                    "calls": record["calls"],
+                    "total_ms": 1000 * record["seconds"],
+                    "mean_ms": 1000 * record["seconds"] / record["calls"] if record["calls"] else 0.0,
+                    "max_ms": 1000 * record["max_seconds"],
+                    "peak_bytes": record["peak_bytes"] if self.memory or record["peak_bytes"] else None
+                }
+                for name, record in self.stages.items()
+            },
+            "counters": {name: dict(keys) for name, keys in self.counters.items()},
+            "files": {
+                file: dict({name + "_ms": 1000 * seconds for name, seconds in times.items()}, **self.annotations.get(file, {}))
+                for file, times in self.files.items()
+            },
+            "outliers": self.outliers()
+        }
+
+    def save(self, path):
+        """write the summary together with the chrome trace events.
+
+        :param path: json file
+        :type path: str
+        """
+        result = self.summary()
+        result["traceEvents"] = self.events
+        with open(path, "w") as f:
+            json.dump(result, f, indent=1)
+
+    def report(self):
+        """print the stages, slowest first, the counters and the outlier files."""
+        summary = self.summary()
+        print("{:32} {:>8} {:>12} {:>10} {:>10} {:>12}".format("stage", "calls", "total ms", "mean ms", "max ms", "peak KiB"))
+        for name, record in sorted(summary["stages"].items(), key=lambda s: -s[1]["total_ms"]):
+            peak = "{:.1f}".format(record["peak_bytes"] / 1024.0) if record["peak_bytes"] is not None else "-"
+            print("{:32} {:8d} {:12.2f} {:10.3f} {:10.2f} {:>12}".format(
+                name, record["calls"], record["total_ms"], record["mean_ms"], record["max_ms"], peak))
+        for name, keys in summary["counters"].items():
+            print("{}: {}".format(name, ", ".join("{} {}".format(key, amount) for key, amount in sorted(keys.items()))))
+        for outlier in summary["outliers"]:
+            print("outlier {}: {} {:.1f} (median {:.1f})".format(outlier["file"], outlier["measure"], outlier["value"], outlier["median"]))
+
+
+PROFILER = Profiler()
+
+
+def instrument(name):
+    """decorator recording every call of a function as a stage. While the profiler
+    is disabled the only cost is one attribute check per call.
+
+    :param name: stage name
+    :type name: str
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            with _Stage(PROFILER, name, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
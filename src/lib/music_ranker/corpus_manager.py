@@ -0,0 +1,247 @@
+from bisect import bisect_left
+
+from lib.music_ranker.music_ranker import MusicRanker
+from lib.music_ranker.scoring_engine import ScoringEngine
+from lib.music_ranker.inverted_index import InvertedIndex
+from lib.preprocess.vocabulary import Vocabulary
+
+"""
+This file contains the incremental corpus. Adding a work to the dataset used to mean
+reparsing every file and building a new MusicRanker, which recounts the document
+frequencies and the average document length over the whole corpus. CorpusManager
+keeps those statistics up to date as works are added, removed or replaced, touching
+only the terms of the work that changed:
+
+    document frequencies: +/- 1 for the slots (or measure words) of the work
+    avdl: running total of the reference lengths divided by the number of works
+    vocabulary: new measure words get the next term id. ids are never reused, a word
+    whose last work was removed keeps its id with a document frequency of 0
+    inverted index: the work's entries are inserted into / deleted from its postings
+
+The idf of the ScoringEngine depends on the number of works, so an update only drops
+it and it is recomputed when the next query needs it (see ScoringEngine._changed).
+
+Scores from the managed rankers are identical to a MusicRanker built from scratch over
+the works currently in the corpus, in the same order. For measure words the term ids of
+a rebuilt Vocabulary can differ from the incremental ones, so the shared terms are summed
+in a different order and the scores can differ in the last bit.
+"""
+
+class IncrementalCorpus(object):
+
+    def __init__(self, b=0.75, k=1.2, dense=True):
+        """one representation of the catalog (interval vectors or measure word vectors)
+        with its scoring engine, inverted index and ranker.
+
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter
+        :type k: float
+        :param dense: whether the vectors are dense count vectors or term id -> count dicts
+        :type dense: bool
+        """
+        self.b = b
+        self.k = k
+        # vector and reference document of every slot, None once removed.
+        # slots double as the doc ids of the inverted index
+        self.vectors = []
+        self.references = []
+        # live slots in increasing order, and their vectors / references in the same order.
+        # the two lists are shared with the ranker
+        self.live = []
+        self.corpus = []
+        self.reference_corpus = []
+        self.total_length = 0
+        self.engine = ScoringEngine([], 0, 0.0)
+        self.index = InvertedIndex([], dense=dense)
+        self._ranker = None
+
+    def __len__(self):
+        return len(self.live)
+
+    @property
+    def avdl(self):
+        return float(self.total_length) / len(self.live) if self.live else 0.0
+
+    @property
+    def ranker(self):
+        """MusicRanker over the live works. It is built on first use and kept up to date
+        after that, it shares the engine and corpus lists of this object.
+
+        :rtype: MusicRanker
+        """
+        if self._ranker is None:
+            if not self.live:
+                raise ValueError("Can not build a ranker over an empty corpus")
+            # the engine is already up to date, the ranker does not count the corpus again
+            self._ranker = MusicRanker(self.corpus, b=self.b, k=self.k, reference_corpus=self.reference_corpus, engine=self.engine)
+        return self._ranker
+
+    def _sync(self):
+        self.engine.avdl = self.avdl
+        if self._ranker is not None:
+            self._ranker.avdl = self.avdl
+
+    def _position(self, slot):
+        position = bisect_left(self.live, slot)
+        if position == len(self.live) or self.live[position] != slot:
+            raise KeyError("Slot {0} is not in the corpus".format(slot))
+        return position
+
+    def add(self, vector, reference):
+        """
+        :param vector: count vector or term id -> count dict of the work
+        :type vector: list or dict
+        :param reference: the document avdl is computed over (interval list or measure words)
+        :type reference: list
+        :return: slot of the new work
+        :rtype: int
+        """
+        slot = self.index.addDocument(vector)
+        self.vectors.append(vector)
+        self.references.append(reference)
+        # new slots are always the largest, the live lists stay sorted
+        self.live.append(slot)
+        self.corpus.append(vector)
+        self.reference_corpus.append(reference)
+        self.total_length += len(reference)
+        self.engine.addDocument(vector)
+        self._sync()
+        return slot
+
+    def remove(self, slot):
+        position = self._position(slot)
+        self.index.removeDocument(slot)
+        self.engine.removeDocument(self.vectors[slot])
+        self.total_length -= len(self.references[slot])
+        del self.live[position]
+        del self.corpus[position]
+        del self.reference_corpus[position]
+        self.vectors[slot] = None
+        self.references[slot] = None
+        self._sync()
+
+    def replace(self, slot, vector, reference):
+        position = self._position(slot)
+        self.index.replaceDocument(slot, vector)
+        self.engine.removeDocument(self.vectors[slot])
+        self.engine.addDocument(vector)
+        self.total_length += len(reference) - len(self.references[slot])
+        self.corpus[position] = vector
+        self.reference_corpus[position] = reference
+        self.vectors[slot] = vector
+        self.references[slot] = reference
+        self._sync()
+
+    def topK(self, query, count=10, method="bm25"):
+        """see MusicRanker.topK.
+
+        :return: list of (slot, score), best first
+        :rtype: list
+        """
+        return self.ranker.topK(query, self.index, count=count, method=method)
+
+
+class CorpusManager(object):
+
+    def __init__(self, vectorize, b=0.75, k=1.2):
+        """
+        :param vectorize: function turning an interval list into a count vector,
+        e.g. partial(intervalToVector, start=-20, end=20)
+        :type vectorize: callable
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter
+        :type k: float
+        """
+        self.vectorize = vectorize
+        self.features = {}
+        self.slots = {}
+        self.names = []
+        self.vocab = Vocabulary()
+        # interval vectors, avdl over the interval lists like main.py
+        self.horizontal = IncrementalCorpus(b, k, dense=True)
+        # measure word vectors, avdl over the measure words
+        self.vertical = IncrementalCorpus(b, k, dense=False)
+
+    def __len__(self):
+        return len(self.features)
+
+    def __contains__(self, name):
+        return name in self.features
+
+    def _vectors(self, features):
+        self.vocab.add(features["words"])
+        return self.vectorize(features["intervals"]), self.vocab.toSparse(features["words"])
+
+    def add(self, name, features):
+        """add a work to the corpus.
+
+        :param name: unique name of the work, usually its file
+        :type name: str
+        :param features: features of the work (see extractFeatures / loadFeatures)
+        :type features: dict
+        """
+        if name in self.features:
+            raise ValueError("{0} is already in the corpus, use replace".format(name))
+        vector, word_vector = self._vectors(features)
+        slot = self.horizontal.add(vector, features["intervals"])
+        # both representations hand out slots in the same order
+        self.vertical.add(word_vector, features["words"])
+        self.features[name] = features
+        self.slots[name] = slot
+        self.names.append(name)
+
+    def remove(self, name):
+        """remove a work from the corpus.
+
+        :param name: name the work was added with
+        :type name: str
+        """
+        if name not in self.features:
+            raise KeyError("{0} is not in the corpus".format(name))
+        slot = self.slots.pop(name)
+        self.horizontal.remove(slot)
+        self.vertical.remove(slot)
+        del self.features[name]
+        self.names[slot] = None
+
+    def replace(self, name, features):
+        """replace the features of a work, e.g. after its score was corrected.
+        The work keeps its place in the corpus.
+
+        :param name: name the work was added with
+        :type name: str
+        :param features: new features of the work
+        :type features: dict
+        """
+        if name not in self.features:
+            raise KeyError("{0} is not in the corpus".format(name))
+        slot = self.slots[name]
+        vector, word_vector = self._vectors(features)
+        self.horizontal.replace(slot, vector, features["intervals"])
+        self.vertical.replace(slot, word_vector, features["words"])
+        self.features[name] = features
+
+    def works(self):
+        """names of the works in the corpus, in corpus order.
+
+        :rtype: list
+        """
+        return [self.names[slot] for slot in self.horizontal.live]
+
+    def topK(self, features, count=10, method="bm25", vertical=False):
+        """works in the corpus that score highest against a query work.
+
+        :param features: features of the query work
+        :type features: dict
+        :param vertical: rank by measure words instead of intervals
+        :type vertical: bool
+        :return: list of (name, score), best first
+        :rtype: list
+        """
+        if vertical:
+            results = self.vertical.topK(self.vocab.toSparse(features["words"]), count, method)
+        else:
+            results = self.horizontal.topK(self.vectorize(features["intervals"]), count, method)
+        return [(self.names[slot], score) for slot, score in results]
@@ -0,0 +1,247 @@
+from collections import defaultdict
+
+import numpy as np
+
+from lib.sequence_similarity.sequence_similarity import lcsAndLevenshtein, matchMasks
+from lib.instrumentation.profiler import instrument
+
+"""
+This file contains the fusion ranker. main.py and the query server score a query with
+BM25, PLN, LCS and Levenshtein one metric at a time, each pass decoding the candidates,
+looking up the idf and computing the length normalizers again. Here everything that
+does not depend on the query is done once when the ranker is built:
+
+    vectors       decoded into one dense matrix, or an inverted list of (work, count)
+                  per term for sparse vectors (measure words), so a query only reads
+                  the counts of its own terms
+    normalizers   1 - b + b * |cwork| / avdl of every candidate, shared by BM25 and PLN
+    sequences     converted to plain lists
+
+and per query the idf, the counts of its terms and the mask of the shared terms serve
+both BM25 and PLN (ScoringEngine.termScores), while LCS and Levenshtein come out of a
+single bit-parallel pass per candidate over bit masks of the query built once
+(lcsAndLevenshtein). Metrics with a weight of 0 are not computed at all. Every score
+equals the one of MusicRanker.bm25 / pivoted_length_normalization, lcsLength and
+levenshteinDistance.
+
+The metrics are combined with one of
+
+    weighted    the weighted sum of the scores, each rescaled to [0, 1] over the
+                candidates (min-max, 1 being the best)
+    rrf         reciprocal rank fusion, the sum of weight / (rrf_k + rank) with rank 1
+                for the best candidate of a metric. Tied candidates share the best rank
+
+Higher is better for BM25, PLN and LCS, lower is better for the Levenshtein distance.
+
+usage:
+
+    ranker = FusionRanker(vectors, intervals, engine, fusion="rrf", names=files)
+    ranker.rank(intervalToVector(query, vector_min, vector_max), query, count=5)
+
+    ranker = buildFusionRanker(cases, fusion="weighted")
+    ranker.rankSequence(loadFeatures("new_song.mid")["intervals"], count=5)
+"""
+
+METRICS = ("bm25", "pln", "lcs", "levenshtein")
+HIGHER_IS_BETTER = {
+    "bm25": True,
+    "pln": True,
+    "lcs": True,
+    "levenshtein": False
+}
+FUSIONS = ("weighted", "rrf")
+
+
+def _plain(sequence):
+    # memory mapped rows come in as numpy arrays, see sequence_similarity._asList
+    return sequence.tolist() if hasattr(sequence, "tolist") else list(sequence)
+
+
+class FusionRanker(object):
+
+    def __init__(self, vectors, sequences, engine, b=0.75, k=1.2, fusion="rrf", weights=None, rrf_k=60, names=None, vectorize=None):
+        """
+        :param vectors: vector of every candidate work, all dense or all sparse dicts
+        :type vectors: list
+        :param sequences: sequence of every candidate work compared with LCS and
+        Levenshtein, e.g. its intervals
+        :type sequences: list
+        :param engine: scoring engine built over the vectors
+        :type engine: ScoringEngine
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter
+        :type k: float
+        :param fusion: 'weighted' or 'rrf'
+        :type fusion: str
+        :param weights: metric -> weight, metrics left out get a weight of 0. Every
+        metric counts the same by default
+        :type weights: dict
+        :param rrf_k: rank offset of reciprocal rank fusion
+        :type rrf_k: float
+        :param names: name of every candidate, e.g. its file. rank reports indices without them
+        :type names: list
+        :param vectorize: function turning a sequence into a vector like those of the
+        candidates, needed by rankSequence
+        :type vectorize: callable
+        """
+        if fusion not in FUSIONS:
+            raise ValueError("fusion must be one of {0}".format(", ".join(FUSIONS)))
+        weights = dict.fromkeys(METRICS, 1.0) if weights is None else dict(weights)
+        unknown = sorted(set(weights) - set(METRICS))
+        if unknown:
+            raise ValueError("unknown metrics {0}, use {1}".format(", ".join(unknown), ", ".join(METRICS)))
+        if any(weight < 0 for weight in weights.values()):
+            raise ValueError("weights must not be negative")
+        if not any(weights.values()):
+            raise ValueError("at least one metric needs a weight")
+        if len(vectors) != len(sequences):
+            raise ValueError("every candidate needs both a vector and a sequence")
+        if names is not None and len(names) != len(vectors):
+            raise ValueError("every candidate needs a name")
+        self.engine = engine
+        self.B = b
+        self.K = k
+        self.fusion = fusion
+        self.weights = {metric: weights.get(metric, 0) for metric in METRICS}
+        self.rrf_k = rrf_k
+        self.names = names
+        self.vectorize = vectorize
+        self.vectors = vectors
+        self.sequences = [_plain(sequence) for sequence in sequences]
+        self.sparse = bool(len(vectors)) and isinstance(vectors[0], dict)
+        if self.sparse:
+            lengths = [float(sum(vector.values())) for vector in vectors]
+            # term -> (candidates, counts), the candidates ascending
+            postings = defaultdict(lambda: ([], []))
+            for row, vector in enumerate(vectors):
+                for term, count in vector.items():
+                    if count != 0:
+                        postings[term][0].append(row)
+                        postings[term][1].append(count)
+            self.postings = {term: (np.array(rows, dtype=np.int64), np.array(counts, dtype=float)) for term, (rows, counts) in postings.items()}
+        else:
+            self.matrix = np.asarray(vectors, dtype=float).reshape(len(vectors), -1)
+            lengths = self.matrix.sum(axis=1, dtype=float)
+        self.normalizer = engine.lengthNormalizer(lengths, b)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def _counts(self, query, rows):
+        # (terms, query counts, candidate counts) over the terms of the query that have an idf
+        if self.sparse:
+            terms = sorted(term for term, count in query.items() if count != 0 and term < self.engine.width)
+            # one row per distinct candidate, the postings are looked up in them so a
+            # restricted candidate list never pays for the rest of the catalog
+            distinct, inverse = np.unique(rows, return_inverse=True)
+            counts = np.zeros((len(distinct), len(terms)))
+            for column, term in enumerate(terms):
+                if term in self.postings and len(distinct):
+                    candidates, values = self.postings[term]
+                    positions = np.minimum(np.searchsorted(distinct, candidates), len(distinct) - 1)
+                    found = distinct[positions] == candidates
+                    counts[positions[found], column] = values[found]
+            return terms, [query[term] for term in terms], counts[inverse.reshape(-1)]
+        query = np.asarray(query, dtype=float)
+        if len(query) != self.matrix.shape[1]:
+            raise ValueError("the query vector must be as long as the candidate vectors")
+        terms = np.flatnonzero(query)
+        return terms, query[terms], self.matrix[np.ix_(rows, terms)]
+
+    @instrument("fusionScores")
+    def scores(self, query_vector, query_sequence, candidates=None):
+        """every metric with a weight, for one query against the candidates.
+
+        :param query_vector: vector of the query, dense or sparse like the candidates
+        :type query_vector: list or dict
+        :param query_sequence: sequence of the query
+        :type query_sequence: list
+        :param candidates: indices of the candidates to score, all by default
+        :type candidates: list
+        :return: metric -> one score per candidate
+        :rtype: dict
+        """
+        rows = np.arange(len(self)) if candidates is None else np.asarray(candidates, dtype=np.int64)
+        scores = {}
+        if self.weights["bm25"] or self.weights["pln"]:
+            terms, query, counts = self._counts(query_vector, rows)
+            bm25, pln = self.engine.termScores(terms, query, counts, self.normalizer[rows], self.K)
+            scores["bm25"] = bm25
+            scores["pln"] = pln
+        if self.weights["lcs"] or self.weights["levenshtein"]:
+            query_sequence = _plain(query_sequence)
+            masks = matchMasks(query_sequence)
+            pairs = [lcsAndLevenshtein(query_sequence, self.sequences[row], masks) for row in rows.tolist()]
+            scores["lcs"] = np.array([lcs for lcs, _ in pairs], dtype=np.int64)
+            scores["levenshtein"] = np.array([distance for _, distance in pairs], dtype=np.int64)
+        return {metric: values for metric, values in scores.items() if self.weights[metric]}
+
+    def fuse(self, scores, fusion=None):
+        """combine the metric scores of the candidates into one score, higher is better.
+
+        :param scores: metric -> one score per candidate, see scores
+        :type scores: dict
+        :param fusion: 'weighted' or 'rrf', the fusion of the ranker by default
+        :type fusion: str
+        :rtype: np.ndarray
+        """
+        fusion = self.fusion if fusion is None else fusion
+        if fusion not in FUSIONS:
+            raise ValueError("fusion must be one of {0}".format(", ".join(FUSIONS)))
+        fused = None
+        for metric, values in scores.items():
+            values = np.asarray(values, dtype=float)
+            oriented = values if HIGHER_IS_BETTER[metric] else -values
+            if fused is None:
+                fused = np.zeros(len(oriented))
+            if not len(oriented):
+                continue
+            if fusion == "weighted":
+                low, high = oriented.min(), oriented.max()
+                # a metric that scores every candidate the same tells them nothing apart
+                part = (oriented - low) / (high - low) if high > low else np.zeros(len(oriented))
+            else:
+                # rank 1 + the number of candidates scoring strictly better
+                better = len(oriented) - np.searchsorted(np.sort(oriented), oriented, side="right")
+                part = 1.0 / (self.rrf_k + 1 + better)
+            fused += self.weights[metric] * part
+        return fused if fused is not None else np.zeros(0)
+
+    @instrument("fusionRank")
+    def rank(self, query_vector, query_sequence, count=10, candidates=None):
+        """the candidates that score best against a query under the fused score.
+
+        :param query_vector: vector of the query, dense or sparse like the candidates
+        :type query_vector: list or dict
+        :param query_sequence: sequence of the query
+        :type query_sequence: list
+        :param count: number of works to return
+        :type count: int
+        :param candidates: indices of the candidates to rank, all by default
+        :type candidates: list
+        :return: list of (name or index, fused score, metric -> score), best first
+        :rtype: list
+        """
+        rows = list(range(len(self))) if candidates is None else list(candidates)
+        scores = self.scores(query_vector, query_sequence, rows)
+        fused = self.fuse(scores)
+        # the candidate order breaks ties so the ranking is deterministic
+        order = sorted(range(len(rows)), key=lambda i: (-fused[i], rows[i]))[:count]
+        return [(
+            self.names[rows[i]] if self.names is not None else rows[i],
+            float(fused[i]),
+            {metric: values[i].item() for metric, values in scores.items()}
+        ) for i in order]
+
+    def rankSequence(self, sequence, count=10, candidates=None):
+        """rank the candidates against a work given by its sequence only, its vector is
+        made with the vectorize function of the ranker.
+
+        :param sequence: sequence of the query, e.g. its intervals
+        :type sequence: list
+        :rtype: list
+        """
+        if self.vectorize is None:
+            raise ValueError("the ranker was built without a vectorize function, use rank")
+        return self.rank(self.vectorize(sequence), sequence, count, candidates)
@@ -0,0 +1,290 @@
+import math
+import heapq
+from bisect import bisect_left
+from collections import Counter
+
+"""
+This file contains an inverted index over the catalog so that we can answer
+"which works are most similar to this melody?" without scoring every work.
+
+A term is either a vector slot (when the index is built from interval vectors)
+or a measure word (when it is built from the output of parseMeasures). For each
+term we keep a postings list of (doc id, term frequency) sorted by doc id, along
+with the length of every document and the idf of every term.
+
+Retrieval is document at a time with MaxScore pruning. Every term gets an upper
+bound on the score it can contribute to any document. Terms whose bounds add up to
+less than the current k-th best score are "non essential": a document that only
+contains those terms can never make it into the top k, so we only walk the postings
+of the essential terms and probe the others for the documents we do visit.
+
+Works can be added, removed and replaced in place (see CorpusManager). Doc ids are
+never reused, a removed work simply disappears from its postings lists, and the idf
+and bounds are recomputed lazily for the terms the next query touches.
+"""
+
+# slack used when comparing score bounds with the threshold, the bounds are summed
+# in a different order than the scores so they can be off in the last bit
+BOUND_SLACK = 1e-9
+
+
+class InvertedIndex(object):
+
+    def __init__(self, documents, dense=False):
+        """
+        :param documents: list of documents, each either a vector of term counts
+        (dense=True) or a list of tokens
+        :type documents: list
+        :param dense: whether the documents are count vectors where the term is the slot
+        :type dense: bool
+        """
+        self.dense = dense
+        self.postings = {}
+        # length of every document, None once it has been removed
+        self.doc_lengths = []
+        # terms of every document, so it can be taken out of the postings again
+        self.doc_terms = []
+        self.n_docs = 0
+        self._total_length = 0
+        # idf of the terms seen by a query since the last update, filled on demand
+        self.idf = {}
+        # upper bounds are cached per (method, b, k, avdl)
+        self._bounds = {}
+        for doc in documents:
+            self.addDocument(doc)
+
+    @classmethod
+    def fromVectors(cls, vectors):
+        """build an index from interval vectors (see intervalToVector).
+
+        :param vectors: list of count vectors
+        :type vectors: list
+        :rtype: InvertedIndex
+        """
+        return cls(vectors, dense=True)
+
+    @classmethod
+    def fromDocuments(cls, documents):
+        """build an index from tokenized documents such as measure words (see parseMeasures).
+
+        :param documents: list of token lists
+        :type documents: list
+        :rtype: InvertedIndex
+        """
+        return cls(documents, dense=False)
+
+    @property
+    def avdl(self):
+        return float(self._total_length) / self.n_docs if self.n_docs else 0.0
+
+    def _changed(self):
+        # N changed, so every idf and bound is stale. they are rebuilt per term when needed
+        self.idf = {}
+        self._bounds = {}
+
+    def _insertPostings(self, doc_id, counts):
+        for term, tf in counts.items():
+            docs, tfs = self.postings.setdefault(term, ([], []))
+            if not docs or docs[-1] < doc_id:
+                docs.append(doc_id)
+                tfs.append(tf)
+            else:
+                # a replaced document keeps its id, keep the list sorted
+                position = bisect_left(docs, doc_id)
+                docs.insert(position, doc_id)
+                tfs.insert(position, tf)
+        self.doc_terms[doc_id] = list(counts)
+        self.doc_lengths[doc_id] = sum(counts.values())
+        self._total_length += self.doc_lengths[doc_id]
+
+    def _deletePostings(self, doc_id):
+        for term in self.doc_terms[doc_id]:
+            docs, tfs = self.postings[term]
+            position = bisect_left(docs, doc_id)
+            del docs[position]
+            del tfs[position]
+            if not docs:
+                del self.postings[term]
+        self._total_length -= self.doc_lengths[doc_id]
+        self.doc_terms[doc_id] = None
+        self.doc_lengths[doc_id] = None
+
+    def addDocument(self, doc):
+        """add a document to the index in O(number of its terms). A new document gets the
+        largest id, so its postings are appended. Removing or replacing a document
+        costs more, see removeDocument and replaceDocument.
+
+        :param doc: count vector, token list or term -> count dict
+        :type doc: list or dict
+        :return: id of the new document
+        :rtype: int
+        """
+        doc_id = len(self.doc_lengths)
+        self.doc_lengths.append(None)
+        self.doc_terms.append(None)
+        self._insertPostings(doc_id, {term: tf for term, tf in self.termCounts(doc).items() if tf != 0})
+        self.n_docs += 1
+        self._changed()
+        return doc_id
+
+    def removeDocument(self, doc_id):
+        """remove a document from the index. Its id is not reused. Deleting it from the
+        middle of a posting list costs O(length of the list) per term.
+
+        :param doc_id: id returned by addDocument
+        :type doc_id: int
+        """
+        if doc_id >= len(self.doc_lengths) or self.doc_lengths[doc_id] is None:
+            raise KeyError("Document {0} is not in the index".format(doc_id))
+        self._deletePostings(doc_id)
+        self.n_docs -= 1
+        self._changed()
+
+    def replaceDocument(self, doc_id, doc):
+        """replace the contents of a document, keeping its id. The kept id is inserted
+        into the middle of the posting lists, which costs O(length of the list) per term
+        of the old and the new contents.
+
+        :param doc_id: id returned by addDocument
+        :type doc_id: int
+        :param doc: count vector, token list or term -> count dict
+        :type doc: list or dict
+        """
+        if doc_id >= len(self.doc_lengths) or self.doc_lengths[doc_id] is None:
+            raise KeyError("Document {0} is not in the index".format(doc_id))
+        self._deletePostings(doc_id)
+        self._insertPostings(doc_id, {term: tf for term, tf in self.termCounts(doc).items() if tf != 0})
+        self._changed()
+
+    def termIdf(self, term):
+        """same idf as the ranker: log10((N + 1) / df).
+
+        :rtype: float
+        """
+        if term not in self.idf:
+            self.idf[term] = math.log((self.n_docs + 1) / len(self.postings[term][0]), 10)
+        return self.idf[term]
+
+    def termCounts(self, doc):
+        """term -> count for a document or query in the representation of this index.
+
+        :param doc: count vector or token list
+        :type doc: list
+        :rtype: dict
+        """
+        if isinstance(doc, dict):
+            return doc
+        if self.dense:
+            return {i: count for i, count in enumerate(doc) if count != 0}
+        return Counter(doc)
+
+    def _weight(self, method, tf, length, b, k, avdl):
+        # the per document part of a term's contribution, same formulas as MusicRanker
+        normalizer = 1 - b + b * (float(length) / avdl)
+        if method == "bm25":
+            return math.log(1 + math.log(1 + tf)) / normalizer
+        if method == "pln":
+            return ((k + 1) * tf) / (tf + k * normalizer)
+        raise ValueError("Unknown scoring method {0}. Use 'bm25' or 'pln'".format(method))
+
+    def termBound(self, term, method, b, k, avdl):
+        """largest weight * idf the term contributes to any document in the index.
+
+        :rtype: float
+        """
+        key = (method, b, k, avdl)
+        if key not in self._bounds:
+            self._bounds[key] = {}
+        bounds = self._bounds[key]
+        if term not in bounds:
+            docs, tfs = self.postings[term]
+            bounds[term] = max(
+                self._weight(method, tf, self.doc_lengths[doc], b, k, avdl) for doc, tf in zip(docs, tfs)
+            ) * self.termIdf(term)
+        return bounds[term]
+
+    def search(self, query, count=10, method="bm25", b=0.75, k=1.2, avdl=None):
+        """return the count highest scoring documents for a query.
+
+        :param query: count vector, token list or term -> count dict
+        :type query: list or dict
+        :param count: number of results to return
+        :type count: int
+        :param method: 'bm25' or 'pln', same formulas as MusicRanker
+        :type method: str
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter (pln only)
+        :type k: float
+        :param avdl: average document length, defaults to the average over the index
+        :type avdl: float
+        :return: list of (doc id, score), best first. ties go to the lower doc id and
+        documents that share no term with the query are never returned
+        :rtype: list
+        """
+        if avdl is None:
+            avdl = self.avdl
+        if count <= 0:
+            return []
+
+        # only terms that occur in the index can contribute
+        terms = []
+        for term, q_tf in self.termCounts(query).items():
+            if q_tf == 0 or term not in self.postings:
+                continue
+            terms.append((q_tf * self.termBound(term, method, b, k, avdl), q_tf, term, self.termIdf(term)))
+        # ascending upper bound, so the non essential terms are a prefix of the list
+        terms.sort(key=lambda t: t[0])
+        bounds = [t[0] for t in terms]
+        # prefix[i] is the most the first i terms can add up to
+        prefix = [0.0]
+        for bound in bounds:
+            prefix.append(prefix[-1] + bound)
+
+        lists = [self.postings[term] for _, _, term, _ in terms]
+        cursors = [0] * len(terms)
+        heap = []
+        threshold = -math.inf
+        # index of the first essential term
+        first = 0
+
+        while True:
+            # next candidate is the smallest doc id among the essential lists
+            doc = None
+            for i in range(first, len(terms)):
+                docs = lists[i][0]
+                if cursors[i] < len(docs) and (doc is None or docs[cursors[i]] < doc):
+                    doc = docs[cursors[i]]
+            if doc is None:
+                break
+
+            length = self.doc_lengths[doc]
+            score = 0.0
+            for i in range(first, len(terms)):
+                docs, tfs = lists[i]
+                if cursors[i] < len(docs) and docs[cursors[i]] == doc:
+                    score += terms[i][1] * self._weight(method, tfs[cursors[i]], length, b, k, avdl) * terms[i][3]
+                    cursors[i] += 1
+
+            # probe the non essential terms, best bound first, while the doc can still make it
+            for i in range(first - 1, -1, -1):
+                if score + prefix[i + 1] <= threshold - BOUND_SLACK * abs(threshold):
+                    break
+                docs, tfs = lists[i]
+                cursors[i] = bisect_left(docs, doc, cursors[i])
+                if cursors[i] < len(docs) and docs[cursors[i]] == doc:
+                    score += terms[i][1] * self._weight(method, tfs[cursors[i]], length, b, k, avdl) * terms[i][3]
+            else:
+                # every term was visited, doc holds its exact score. docs come in increasing
+                # id order, so on a tie the document already in the heap wins
+                if len(heap) < count:
+                    heapq.heappush(heap, (score, -doc))
+                elif score > threshold:
+                    heapq.heapreplace(heap, (score, -doc))
+                if len(heap) == count:
+                    threshold = heap[0][0]
+                    # move terms that can no longer lift a document into the top k to the non essential set
+                    while first < len(terms) and prefix[first + 1] < threshold - BOUND_SLACK * abs(threshold):
+                        first += 1
+
+        return [(-neg_doc, score) for score, neg_doc in sorted(heap, key=lambda e: (-e[0], -e[1]))]
@@ -0,0 +1,244 @@
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from lib.sequence_similarity.sequence_similarity import lcsLength, levenshteinDistance
+
+"""
+This file contains the candidate generation stage for screening a new work against a
+large catalog. Scoring a query with LCS or Levenshtein against every work is linear in
+the catalog (and quadratic in the melody length per work), so instead:
+
+    1. every work is shingled into n-grams of its intervals (see streamToIntervals) and
+    of its measure words (see parseMeasures)
+    2. each shingle set gets a MinHash signature: for each of num_perm hash functions the
+    smallest hash over the shingles. Two signatures agree in a slot with probability
+    equal to the Jaccard similarity of the two shingle sets
+    3. the signatures are cut into bands of rows slots and every band is a key into a
+    hash table (LSH). Works that agree on a whole band with the query are candidates
+
+A query only looks up one bucket per band, so the cost does not grow with the catalog
+beyond the size of the buckets it hits. The candidates are then re-ranked with the exact
+scores.
+
+The tradeoff is set by bands and rows (bands * rows <= num_perm). A pair with Jaccard
+similarity s becomes a candidate with probability 1 - (1 - s^rows)^bands, an S curve
+with its steepest point around (1 / bands)^(1 / rows). More bands / fewer rows catch
+less similar pairs (higher recall, more candidates), fewer bands / more rows do the
+opposite. src/evaluate_lsh.py measures both against the cases in dataset.xml.
+"""
+
+MAX_HASH = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def shingles(sequence, n):
+    """the set of n-grams of a sequence. Sequences shorter than n are one shingle.
+
+    :param sequence: interval list, measure words, ...
+    :type sequence: list
+    :param n: n-gram size
+    :type n: int
+    :rtype: set
+    """
+    sequence = list(sequence)
+    if len(sequence) < n:
+        return {tuple(sequence)} if sequence else set()
+    return {tuple(sequence[i:i + n]) for i in range(len(sequence) - n + 1)}
+
+def _shingleHash(shingle):
+    # python's hash of strings changes between processes, crc32 of the repr does not
+    return zlib.crc32(repr(shingle).encode("utf-8"))
+
+
+class MinHasher(object):
+
+    def __init__(self, num_perm=128, seed=1):
+        """
+        :param num_perm: number of hash functions, the length of a signature
+        :type num_perm: int
+        :param seed: seed of the hash functions. signatures are only comparable with the same seed
+        :type seed: int
+        """
+        self.num_perm = num_perm
+        random = np.random.RandomState(seed)
+        # hash function i is the splitmix64 mixer applied to x + offsets[i]
+        self.offsets = random.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    def _mix(self, values):
+        # splitmix64 finalizer, the multiplications wrap around modulo 2^64
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return values ^ (values >> np.uint64(31))
+
+    def signature(self, shingle_set):
+        """MinHash signature of a set of shingles.
+
+        :param shingle_set: set of hashable shingles
+        :type shingle_set: set
+        :return: num_perm hashes, all MAX_HASH for an empty set
+        :rtype: np.ndarray
+        """
+        if not shingle_set:
+            return np.full(self.num_perm, MAX_HASH, dtype=np.uint64)
+        hashes = np.array([_shingleHash(s) for s in shingle_set], dtype=np.uint64)
+        # one row per shingle, one column per hash function
+        return self._mix(hashes[:, None] + self.offsets).min(axis=0)
+
+
+def jaccardEstimate(a, b):
+    """estimated Jaccard similarity of the shingle sets behind two signatures.
+
+    :rtype: float
+    """
+    return float(np.mean(a == b))
+
+
+class LSHIndex(object):
+
+    def __init__(self, bands=32, rows=4):
+        """
+        :param bands: number of bands a signature is cut into
+        :type bands: int
+        :param rows: signature slots per band
+        :type rows: int
+        """
+        self.bands = bands
+        self.rows = rows
+        self.tables = [defaultdict(list) for _ in range(bands)]
+
+    def _keys(self, signature):
+        if len(signature) < self.bands * self.rows:
+            raise ValueError("Signatures of length {0} can not be cut into {1} bands of {2} rows".format(
+                len(signature), self.bands, self.rows))
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, doc_id, signature):
+        for table, key in zip(self.tables, self._keys(signature)):
+            table[key].append(doc_id)
+
+    def query(self, signature):
+        """ids of every document that shares at least one band with the signature.
+
+        :rtype: set
+        """
+        candidates = set()
+        for table, key in zip(self.tables, self._keys(signature)):
+            candidates.update(table.get(key, ()))
+        return candidates
+
+
+class NearDuplicateIndex(object):
+
+    def __init__(self, intervals, words=None, vectors=None, interval_n=4, word_n=2, num_perm=128, bands=32, rows=4, seed=1):
+        """MinHash / LSH index over the works of a catalog.
+
+        :param intervals: interval list of every work
+        :type intervals: list
+        :param words: optional measure words of every work, indexed separately from the intervals
+        :type words: list
+        :param vectors: optional interval vectors of every work, needed to re-rank with bm25 / pln
+        :type vectors: list
+        :param interval_n: n-gram size of the interval shingles
+        :type interval_n: int
+        :param word_n: n-gram size of the measure word shingles
+        :type word_n: int
+        :param num_perm: length of the MinHash signatures
+        :type num_perm: int
+        :param bands: LSH bands, see the top of this file
+        :type bands: int
+        :param rows: LSH rows per band
+        :type rows: int
+        :param seed: seed of the hash functions
+        :type seed: int
+        """
+        self.intervals = intervals
+        self.words = words
+        self.vectors = vectors
+        self.interval_n = interval_n
+        self.word_n = word_n
+        self.hasher = MinHasher(num_perm, seed)
+        self.interval_index = LSHIndex(bands, rows)
+        self.word_index = LSHIndex(bands, rows) if words is not None else None
+        self.interval_signatures = []
+        self.word_signatures = []
+        for doc_id, melody in enumerate(intervals):
+            self.interval_signatures.append(self._index(self.interval_index, doc_id, shingles(melody, interval_n)))
+            if words is not None:
+                self.word_signatures.append(self._index(self.word_index, doc_id, shingles(words[doc_id], word_n)))
+
+    def _index(self, index, doc_id, shingle_set):
+        signature = self.hasher.signature(shingle_set)
+        # a work without shingles is similar to nothing, keep it out of the buckets
+        if shingle_set:
+            index.add(doc_id, signature)
+        return signature
+
+    def candidates(self, intervals, words=None):
+        """works that collide with the query in at least one band of either index.
+
+        :param intervals: interval list of the query
+        :type intervals: list
+        :param words: optional measure words of the query
+        :type words: list
+        :return: list of (doc id, estimated jaccard), most similar first. The estimate is
+        the larger of the interval and measure word estimates
+        :rtype: list
+        """
+        found = {}
+        queries = [(self.interval_index, self.interval_signatures, shingles(intervals, self.interval_n))]
+        if words is not None and self.word_index is not None:
+            queries.append((self.word_index, self.word_signatures, shingles(words, self.word_n)))
+        for index, signatures, shingle_set in queries:
+            if not shingle_set:
+                continue
+            signature = self.hasher.signature(shingle_set)
+            for doc_id in index.query(signature):
+                found[doc_id] = max(found.get(doc_id, 0.0), jaccardEstimate(signature, signatures[doc_id]))
+        return sorted(found.items(), key=lambda c: (-c[1], c[0]))
+
+    def search(self, intervals, words=None, vector=None, count=10, metric="lcs", ranker=None, limit=None):
+        """candidate generation followed by an exact re-rank of the candidates.
+
+        :param intervals: interval list of the query
+        :type intervals: list
+        :param words: optional measure words of the query
+        :type words: list
+        :param vector: interval vector of the query, needed for bm25 / pln
+        :type vector: list
+        :param count: number of results
+        :type count: int
+        :param metric: 'lcs', 'levenshtein', 'bm25' or 'pln'
+        :type metric: str
+        :param ranker: MusicRanker used for bm25 / pln, its vectors must match the index vectors
+        :type ranker: MusicRanker
+        :param limit: optional cap on the number of candidates re-ranked, the ones with the
+        highest estimated similarity are kept
+        :type limit: int
+        :return: list of (doc id, exact score), best first. ties go to the lower doc id
+        :rtype: list
+        """
+        candidates = [doc_id for doc_id, _ in self.candidates(intervals, words)]
+        if limit is not None:
+            candidates = candidates[:limit]
+        if not candidates:
+            return []
+
+        if metric == "lcs":
+            scores = [lcsLength(intervals, self.intervals[doc_id]) for doc_id in candidates]
+        elif metric == "levenshtein":
+            # lower is better, sort on the negated distance below
+            scores = [-levenshteinDistance(intervals, self.intervals[doc_id]) for doc_id in candidates]
+        elif metric in ("bm25", "pln"):
+            if ranker is None or vector is None or self.vectors is None:
+                raise ValueError("Re-ranking with {0} needs the index vectors, a query vector and a ranker".format(metric))
+            matrix = [self.vectors[doc_id] for doc_id in candidates]
+            batch = ranker.bm25Batch if metric == "bm25" else ranker.pivotedLengthNormalizationBatch
+            scores = batch(vector, matrix).tolist()
+        else:
+            raise ValueError("Unknown metric {0}. Use 'lcs', 'levenshtein', 'bm25' or 'pln'".format(metric))
+
+        ranked = sorted(zip(candidates, scores), key=lambda c: (-c[1], c[0]))[:count]
+        if metric == "levenshtein":
+            return [(doc_id, -score) for doc_id, score in ranked]
+        return ranked
@@ -2,75 +2,96 @@ import math
 import nltk
 
 from lib.document_ranker.algorithms.document_ranker import Ranker
+from lib.music_ranker.scoring_engine import ScoringEngine
+from lib.instrumentation.profiler import instrument
 
 class UsageError(Exception):
     pass
 
+def _width(cworks):
+    # number of vector slots of a candidate matrix, without densifying a CsrMatrix
+    return cworks.width if hasattr(cworks, "width") else len(cworks[0])
+
 class MusicRanker(Ranker):
 
     # overide init method to take a second corpus and calculate avdl
     # we do this because our vectors will all be the same length and we want a
     # a way to reference the original corpus
     def __init__(self, *args, **kwargs):
+        # an engine built beforehand, e.g. in one streaming pass over a LazyCorpus
+        # (see ScoringEngine.fromStream), already knows the doc freq and avdl
+        engine = kwargs.pop("engine", None)
         super(MusicRanker, self).__init__(*args, **kwargs)
         if kwargs.get("reference_corpus"):
             self.reference_corpus = kwargs.get("reference_corpus")
-            self.avdl = self.setAVDL(corpus=self.reference_corpus)
+            if engine is None:
+                self.avdl = self.setAVDL(corpus=self.reference_corpus)
+        if engine is not None:
+            self.avdl = engine.avdl
+            self.engine = engine
+            return
+        # document frequencies and idf only depend on the corpus, so compute them once here
+        # instead of rescanning the corpus for every vector slot of every query.
+        # the corpus can hold dense vectors, sparse dicts or be a CsrMatrix
+        self.engine = ScoringEngine.fromCorpus(self.corpus, self.avdl)
 
     # self.k and self.b will need to be tuned
     # In the case of this project, all docs are the same len, so B has no effect.
     # Due to PLN structure, the score increases as K increases, so we can pick anything reasonable.
 
     # override bm25 method based on the representation we have of the music
+    @instrument("bm25")
     def bm25(self, dwork, cwork):
         # input will be two vectors of the same length representing "term frequency" of each interval
+        # or two sparse vectors (term id -> count), in which case only the shared terms are visited
+        if isinstance(dwork, dict) and isinstance(cwork, dict):
+            return self.engine.bm25Sparse(dwork, cwork, self.B)
         if len(cwork) != len(dwork):
             raise UsageError("Incorrect usage. Input must be two vectors (lists) of the same length")
-        
-        score = 0
-
-        for i in range(len(dwork)):
-            # ensure the interval is in both works
-            if dwork[i] == 0 or cwork[i] == 0:
-                continue
-            # get the "document frequency" (count of works that contain the target interval)
-            doc_freq = 0
-            for work in self.corpus:
-                # increment doc freq if the work contains the target interval
-                if work[i] != 0:
-                    doc_freq += 1
-            # carefully build each term
-            numerator = math.log(1 + math.log(1 + cwork[i]))
-            denominator = 1 - self.B + self.B * (float(sum(cwork))/self.avdl)
-            log_term = math.log((len(self.corpus) + 1) / doc_freq, 10)
-
-            # add the result for the current vector position to score
-            score += dwork[i] * (numerator / denominator) * log_term
-        return score
+        return self.engine.bm25(dwork, cwork, self.B)
 
     # override the pivoted length normalization method based on the representation we have of the music
+    @instrument("pln")
     def pivoted_length_normalization(self, dwork, cwork):
         # input will be two vectors of the same length representing "term frequency" of each interval
+        # or two sparse vectors (term id -> count), in which case only the shared terms are visited
+        if isinstance(dwork, dict) and isinstance(cwork, dict):
+            return self.engine.pivotedLengthNormalizationSparse(dwork, cwork, self.B, self.K)
         if len(cwork) != len(dwork):
             raise UsageError("Incorrect usage. Input must be two vectors (lists) of the same length")
-        
-        score = 0
+        return self.engine.pivotedLengthNormalization(dwork, cwork, self.B, self.K)
+
+    # score one query against many candidate works at once.
+    # cworks is a matrix (list of vectors) or a memory mapped CsrMatrix from the
+    # feature store, the result holds one score per row
+    @instrument("bm25Batch")
+    def bm25Batch(self, dwork, cworks):
+        if len(cworks) and _width(cworks) != len(dwork):
+            raise UsageError("Incorrect usage. Every candidate vector must be the same length as the query")
+        return self.engine.bm25Batch(dwork, cworks, self.B)
 
-        for i in range(len(dwork)):
-            # ensure the interval is in both works
-            if dwork[i] == 0 or cwork[i] == 0:
-                continue
-            # get the "document frequency" (count of works that contain the target interval)
-            doc_freq = 0
-            for work in self.corpus:
-                # increment doc freq if the work contains the target interval
-                if work[i] != 0:
-                    doc_freq += 1
-            # carefully build each term
-            numerator = (self.K + 1) * cwork[i]
-            denominator = cwork[i] + self.K * (1 - self.B + self.B * (float(sum(cwork))/self.avdl))
-            log_term = math.log((len(self.corpus) + 1) / doc_freq, 10)
+    @instrument("plnBatch")
+    def pivotedLengthNormalizationBatch(self, dwork, cworks):
+        if len(cworks) and _width(cworks) != len(dwork):
+            raise UsageError("Incorrect usage. Every candidate vector must be the same length as the query")
+        return self.engine.pivotedLengthNormalizationBatch(dwork, cworks, self.B, self.K)
 
-            # add the result for the current vector position to score
-            score += dwork[i] * (numerator / denominator) * log_term
-        return score
+    # retrieve the works in an inverted index that score highest against a query.
+    # uses this ranker's b, k and avdl so the scores line up with bm25 / pivoted_length_normalization
+    @instrument("topK")
+    def topK(self, dwork, index, count=10, method="bm25"):
+        """
+        :param dwork: query as a vector, list of measure words or term -> count dict
+        :type dwork: list or dict
+        :param index: index over the catalog
+        :type index: InvertedIndex
+        :param count: number of works to return
+        :type count: int
+        :param method: 'bm25' or 'pln'
+        :type method: str
+        :return: list of (doc id, score), best first
+        :rtype: list
+        """
+        if index.dense and not isinstance(dwork, dict) and len(dwork) != self.engine.width:
+            raise UsageError("Incorrect usage. Query vector must be the same length as the corpus vectors")
+        return index.search(dwork, count=count, method=method, b=self.B, k=self.K, avdl=self.avdl)
@@ -0,0 +1,164 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+"""
+This file contains the parameter sweep used to tune b and k for MusicRanker.
+Instead of building a new ranker per value and scoring one hand picked pair
+through the per slot loop, the corpus statistics (document frequency, idf,
+document lengths) are computed once and every case is scored against every
+other work for a whole row of the (b, k) grid with a few matrix products.
+
+For each case the defendant is the query and the complaintant the candidate,
+like main.py. The related score is score(defendant, complaintant) and the
+baseline scores are score(work, complaintant) for every work that is not one
+of the two works of the case.
+
+Objectives (higher is better):
+
+    accuracy: fraction of (case, baseline work) comparisons where the related
+    score is strictly greater, i.e. how often main.py would count the case as
+    correct averaged over every possible random baseline
+    margin: mean over cases of related score - mean baseline score
+    a callable objective(related, baselines, valid) -> float, where related has one
+    score per case, baselines one row per case with a score for every work, and
+    valid marks the works that count as baselines for each case
+"""
+
+METHODS = ("bm25", "pln")
+
+
+def _accuracy(related, baselines, valid):
+    # related: (..., cases), baselines: (..., cases, works)
+    wins = (related[..., None] > baselines) & valid
+    return (wins.sum(axis=-1) / valid.sum(axis=-1)).mean(axis=-1)
+
+def _margin(related, baselines, valid):
+    mean_baseline = np.where(valid, baselines, 0).sum(axis=-1) / valid.sum(axis=-1)
+    return (related - mean_baseline).mean(axis=-1)
+
+OBJECTIVES = {
+    "accuracy": _accuracy,
+    "margin": _margin
+}
+
+
+class ParameterSweep(object):
+
+    def __init__(self, corpus, idf, avdl, pairs, names=None):
+        """
+        :param corpus: dense term count vectors of every work
+        :type corpus: list or np.ndarray
+        :param idf: idf of every vector slot (see ScoringEngine)
+        :type idf: np.ndarray
+        :param avdl: average document length
+        :type avdl: float
+        :param pairs: (query index, candidate index) of every case, usually (defendant, complaintant)
+        :type pairs: list
+        :param names: optional name (file) of every work. works with the same name as
+        either work of a case are not used as baselines for that case
+        :type names: list
+        """
+        self.counts = np.asarray(corpus, dtype=float)
+        self.idf = np.asarray(idf, dtype=float)
+        self.avdl = float(avdl)
+        self.lengths = self.counts.sum(axis=1)
+        # log(1 + log(1 + c)) is the same for every b, compute it once
+        self.log_log = np.log(1 + np.log(1 + self.counts))
+        self.queries = np.array([q for q, _ in pairs])
+        self.candidates = np.array([c for _, c in pairs])
+
+        n_docs = len(self.counts)
+        if names is None:
+            names = list(range(n_docs))
+        names = np.array(names, dtype=object)
+        valid = np.ones((len(pairs), n_docs), dtype=bool)
+        for case, (q, c) in enumerate(pairs):
+            valid[case] = (names != names[q]) & (names != names[c])
+        self.valid = valid
+
+    @classmethod
+    def fromRanker(cls, ranker, pairs, names=None):
+        """reuse the corpus, idf and avdl of an existing MusicRanker.
+
+        :type ranker: MusicRanker
+        :rtype: ParameterSweep
+        """
+        return cls(ranker.corpus, ranker.engine.idf, ranker.avdl, pairs, names)
+
+    def _weights(self, method, b, k_values):
+        # per document weight of every slot for one b and every k: (len(k), docs, slots)
+        normalizer = (1 - b + b * (self.lengths / self.avdl))[:, None]
+        if method == "bm25":
+            # bm25 does not use k, every k gets the same weights
+            weights = (self.log_log / normalizer) * self.idf
+            return np.broadcast_to(weights, (len(k_values),) + weights.shape)
+        k = np.asarray(k_values, dtype=float)[:, None, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = ((k + 1) * self.counts) / (self.counts + k * normalizer) * self.idf
+        # empty slots contribute nothing (with k = 0 they would be 0 / 0)
+        return np.where(self.counts > 0, weights, 0)
+
+    def scoreRow(self, method, b, k_values):
+        """related and baseline scores of every case for one b and every k.
+
+        :return: related (len(k), cases) and baselines (len(k), cases, works)
+        :rtype: tuple of np.ndarray
+        """
+        if method not in METHODS:
+            raise ValueError("Unknown scoring method {0}. Use one of {1}".format(method, METHODS))
+        weights = self._weights(method, b, k_values)
+        # scores[k, q, c] = score of query work q against candidate work c
+        candidate_weights = weights[:, self.candidates, :]
+        baselines = np.einsum("qv,kcv->kcq", self.counts, candidate_weights)
+        related = baselines[:, np.arange(len(self.candidates)), self.queries]
+        return related, baselines
+
+    def _objectiveRow(self, method, b, k_values, objective):
+        related, baselines = self.scoreRow(method, b, k_values)
+        if callable(objective):
+            return np.array([objective(related[i], baselines[i], self.valid) for i in range(len(k_values))])
+        return OBJECTIVES[objective](related, baselines, self.valid)
+
+    def run(self, method, b_values, k_values=(1.2,), objective="accuracy", workers=1):
+        """evaluate the whole (b, k) grid.
+
+        :param method: 'bm25' or 'pln'
+        :type method: str
+        :param b_values: values of b to try
+        :type b_values: list
+        :param k_values: values of k to try (ignored by bm25, pass one value)
+        :type k_values: list
+        :param objective: 'accuracy', 'margin' or a callable, see the top of this file
+        :type objective: str or callable
+        :param workers: number of processes the rows of the grid are spread over
+        :type workers: int
+        :return: dict with the "surface" (len(b) x len(k) objective values), the grid and
+        the "best" parameters. ties go to the smallest b, then the smallest k
+        :rtype: dict
+        """
+        if not callable(objective) and objective not in OBJECTIVES:
+            raise ValueError("Unknown objective {0}. Use one of {1} or a callable".format(objective, list(OBJECTIVES)))
+        b_values = list(b_values)
+        k_values = list(k_values)
+        if workers == 1 or len(b_values) == 1:
+            rows = [self._objectiveRow(method, b, k_values, objective) for b in b_values]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                n = len(b_values)
+                rows = list(pool.map(self._objectiveRow, [method] * n, b_values, [k_values] * n, [objective] * n))
+        surface = np.vstack(rows)
+
+        best_b, best_k = np.unravel_index(np.argmax(surface), surface.shape)
+        return {
+            "method": method,
+            "objective": objective if not callable(objective) else getattr(objective, "__name__", "custom"),
+            "b_values": b_values,
+            "k_values": k_values,
+            "surface": surface,
+            "best": {
+                "b": b_values[best_b],
+                "k": k_values[best_k],
+                "score": float(surface[best_b, best_k])
+            }
+        }
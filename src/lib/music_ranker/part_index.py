@@ -0,0 +1,112 @@
+import numpy as np
+
+from lib.music_ranker.music_ranker import MusicRanker
+
+"""
+This file contains an index where every part (or midi track) of a work is a document
+of its own. The tune of a work is not always in its first part, so comparing only the
+first parts misses works whose melody sits in another voice or on another track.
+
+Each part is a sub-document with its own interval vector, and the document frequencies
+and avdl are those of the parts. A query work is scored part by part against every
+part of the catalog in one batch, and the part scores are aggregated per work:
+
+    max         the best scoring pair of a query part and a candidate part
+    mean        every query part is matched with its best candidate part, averaged
+                over the query parts
+    melody      only the melody parts of the two works (see melodyPart)
+
+usage:
+
+    index = PartIndex([(file, loadFeatures(file)) for file in files], vectorize)
+    index.topK(loadFeatures("new_song.mid"), count=10, aggregate="max")
+"""
+
+AGGREGATES = ("max", "mean", "melody")
+
+
+def _parts(features):
+    # features extracted before the parts were recorded only know their first part
+    parts = features.get("parts") or [{"intervals": features["intervals"]}]
+    return parts, features.get("melody", 0)
+
+
+class PartIndex(object):
+
+    def __init__(self, works, vectorize, b=0.75, k=1.2):
+        """
+        :param works: (name, features) of every work, see extractFeatures
+        :type works: iterable
+        :param vectorize: function turning an interval list into a count vector,
+        e.g. partial(intervalToVector, start=-20, end=20)
+        :type vectorize: callable
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter
+        :type k: float
+        """
+        self.vectorize = vectorize
+        self.names = []
+        # sub-document of the melody part of every work
+        self.melody = []
+        # the parts of work i are sub-documents offsets[i] to offsets[i + 1]
+        offsets = [0]
+        intervals = []
+        for name, features in works:
+            parts, melody = _parts(features)
+            self.names.append(name)
+            self.melody.append(offsets[-1] + melody)
+            intervals.extend([part["intervals"] for part in parts])
+            offsets.append(len(intervals))
+        if not intervals:
+            raise ValueError("A part index needs at least one work")
+        self.offsets = np.array(offsets)
+        self.melody = np.array(self.melody)
+        self.ranker = MusicRanker([vectorize(part) for part in intervals], b=b, k=k, reference_corpus=intervals)
+        self.vectors = np.asarray(self.ranker.corpus, dtype=float)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _partScores(self, vectors, method):
+        # scores of every query part (rows) against every part of the catalog (columns)
+        if method == "bm25":
+            return np.array([self.ranker.bm25Batch(vector, self.vectors) for vector in vectors])
+        if method == "pln":
+            return np.array([self.ranker.pivotedLengthNormalizationBatch(vector, self.vectors) for vector in vectors])
+        raise ValueError("Unknown method {0}. Use 'bm25' or 'pln'".format(method))
+
+    def scores(self, features, method="bm25", aggregate="max"):
+        """score a query work against every work of the index.
+
+        :param features: features of the query work, see extractFeatures
+        :type features: dict
+        :param method: 'bm25' or 'pln'
+        :type method: str
+        :param aggregate: how the part scores make up the score of a work, see AGGREGATES
+        :type aggregate: str
+        :return: one score per work, in index order
+        :rtype: np.ndarray
+        """
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate {0}. Use one of {1}".format(aggregate, AGGREGATES))
+        parts, melody = _parts(features)
+        if aggregate == "melody":
+            return self._partScores([self.vectorize(parts[melody]["intervals"])], method)[0][self.melody]
+        matrix = self._partScores([self.vectorize(part["intervals"]) for part in parts], method)
+        # best candidate part of every work, for every query part
+        best = np.maximum.reduceat(matrix, self.offsets[:-1], axis=1)
+        if aggregate == "max":
+            return best.max(axis=0)
+        return best.mean(axis=0)
+
+    def topK(self, features, count=10, method="bm25", aggregate="max"):
+        """works of the index that score highest against a query work.
+
+        :return: list of (name, score), best first
+        :rtype: list
+        """
+        scores = self.scores(features, method, aggregate)
+        # stable sort, so ties keep index order
+        order = np.argsort(-scores, kind="stable")[:count]
+        return [(self.names[i], float(scores[i])) for i in order]
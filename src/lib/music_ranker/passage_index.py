@@ -0,0 +1,234 @@
+from collections import defaultdict
+
+from lib.instrumentation.profiler import instrument
+
+"""
+This file contains the passage finder. LCS and Levenshtein give one number for two
+whole works, but a dispute is usually about a short phrase that was borrowed, and a
+full local alignment of a query against every work of the catalog is far too slow in
+python. So the alignment is only run where the works share a run of intervals, the
+seed and extend approach of BLAST:
+
+    1. seeds: every k consecutive intervals (k-mer) of every work in the catalog is
+    indexed with its position. Intervals do not change when a phrase is transposed,
+    so neither do the seeds. Seeds occurring more than max_seed_hits times (repeated
+    notes, scales) are left out of the lookup, they match everywhere
+    2. clusters: the seeds a query shares with a work are grouped by diagonal (position
+    in the work minus position in the query). Seeds on nearby diagonals (at most band
+    apart, a few inserted or dropped notes) and at most window apart along the query
+    make up one candidate passage
+    3. extend: the clusters with the most seeds are extended with Smith-Waterman local
+    alignment, restricted to the band of diagonals around the cluster and a window of
+    intervals before and after it, so each extension costs O(length * band)
+
+A query only touches the works it shares seeds with, so the cost depends on the number
+of hits rather than on the size of the catalog. Every passage is reported with the
+interval positions of both works and, through the "measures" of their features (see
+extractFeatures), the measures it spans.
+
+usage:
+
+    index = PassageIndex([(file, loadFeatures(file)) for file in files])
+    index.search(loadFeatures("new_song.mid"), count=5)
+"""
+
+
+def _span(measures, start, end):
+    # intervals start to end (exclusive) join the pitches start to end
+    if not measures or end >= len(measures):
+        return None
+    return measures[start], measures[end]
+
+
+class PassageIndex(object):
+
+    def __init__(self, works, k=4, band=4, window=16, match=2, mismatch=-1, gap=-2, max_seed_hits=1000):
+        """
+        :param works: (name, features) of every work, see extractFeatures
+        :type works: iterable
+        :param k: number of intervals in a seed
+        :type k: int
+        :param band: how far an alignment may stray from the diagonals of its seeds
+        :type band: int
+        :param window: intervals aligned before and after a cluster of seeds, seeds further
+        apart than this along the query make separate clusters
+        :type window: int
+        :param match: score of two equal intervals
+        :type match: int
+        :param mismatch: score of two different intervals
+        :type mismatch: int
+        :param gap: score of an interval left out of either work
+        :type gap: int
+        :param max_seed_hits: seeds with more occurrences in the catalog are not looked up
+        :type max_seed_hits: int
+        """
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        if match <= 0:
+            raise ValueError("match must be positive")
+        self.k = k
+        self.band = band
+        self.window = window
+        self.match = match
+        self.mismatch = mismatch
+        self.gap = gap
+        self.max_seed_hits = max_seed_hits
+        self.names = []
+        self.intervals = []
+        self.measures = []
+        # k-mer -> [(work, position), ...]
+        self.seeds = defaultdict(list)
+        for name, features in works:
+            self.add(name, features)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, features):
+        """index one more work.
+
+        :param name: name of the work, e.g. its file
+        :type name: str
+        :param features: features of the work, see extractFeatures
+        :type features: dict
+        """
+        work = len(self.names)
+        intervals = list(features["intervals"])
+        self.names.append(name)
+        self.intervals.append(intervals)
+        # features extracted before the measures were recorded can not report them
+        self.measures.append(features.get("measures"))
+        for position in range(len(intervals) - self.k + 1):
+            self.seeds[tuple(intervals[position:position + self.k])].append((work, position))
+
+    def _clusters(self, query, exclude):
+        # seeds the query shares with every work, grouped into candidate passages
+        hits = defaultdict(list)
+        for position in range(len(query) - self.k + 1):
+            occurrences = self.seeds.get(tuple(query[position:position + self.k]), ())
+            if len(occurrences) > self.max_seed_hits:
+                continue
+            for work, target in occurrences:
+                if work not in exclude:
+                    hits[work].append((target - position, position))
+        clusters = []
+        for work, seeds in hits.items():
+            seeds.sort()
+            # runs of diagonals at most band from the first one of the run, then split
+            # them where the seeds are far apart along the query
+            runs = [[seeds[0]]]
+            for seed in seeds[1:]:
+                if seed[0] - runs[-1][0][0] <= self.band:
+                    runs[-1].append(seed)
+                else:
+                    runs.append([seed])
+            for run in runs:
+                run.sort(key=lambda seed: seed[1])
+                cluster = [run[0]]
+                for seed in run[1:]:
+                    if seed[1] - cluster[-1][1] > self.window:
+                        clusters.append((work, cluster))
+                        cluster = []
+                    cluster.append(seed)
+                clusters.append((work, cluster))
+        # most seeds first, the position breaks ties so the order is deterministic
+        clusters.sort(key=lambda cluster: (-len(cluster[1]), cluster[0], cluster[1][0][1], cluster[1][0][0]))
+        return clusters
+
+    def _extend(self, query, target, cluster):
+        """banded Smith-Waterman around a cluster of seeds.
+
+        :return: (score, query start, query end, target start, target end), the ends exclusive
+        :rtype: tuple
+        """
+        low = min(diagonal for diagonal, _ in cluster) - self.band
+        high = max(diagonal for diagonal, _ in cluster) + self.band
+        first = max(0, min(position for _, position in cluster) - self.window)
+        last = min(len(query), max(position for _, position in cluster) + self.k + self.window)
+        width = high - low + 1
+        # row i holds the cells (i, i + low) to (i + high), indexed by diagonal. a cell
+        # is (score, start of the alignment ending there), cells outside the works are empty
+        empty = (0, None)
+        previous = [empty] * (width + 1)
+        best = (0, None, None)
+        for i in range(first, last):
+            symbol = query[i]
+            current = [empty] * (width + 1)
+            for t in range(width):
+                j = i + low + t
+                if j < 0 or j >= len(target):
+                    continue
+                # diagonal step from (i - 1, j - 1), same diagonal in the previous row
+                score, start = previous[t]
+                score += self.match if symbol == target[j] else self.mismatch
+                if start is None:
+                    start = (i, j)
+                cell = (score, start)
+                # gap in the target, from (i - 1, j): one diagonal up in the previous row
+                up = previous[t + 1]
+                if up[1] is not None and up[0] + self.gap > cell[0]:
+                    cell = (up[0] + self.gap, up[1])
+                # gap in the query, from (i, j - 1): one diagonal down in this row
+                if t > 0:
+                    left = current[t - 1]
+                    if left[1] is not None and left[0] + self.gap > cell[0]:
+                        cell = (left[0] + self.gap, left[1])
+                if cell[0] <= 0:
+                    continue
+                current[t] = cell
+                if cell[0] > best[0]:
+                    best = (cell[0], cell[1], (i, j))
+            previous = current
+        score, start, end = best
+        if start is None:
+            return None
+        return score, start[0], end[0] + 1, start[1], end[1] + 1
+
+    @instrument("passageSearch")
+    def search(self, features, count=10, exclude=(), max_extensions=100, min_score=None):
+        """the passages of the catalog that align best with a stretch of the query.
+
+        :param features: features of the query work, see extractFeatures
+        :type features: dict
+        :param count: number of passages to return
+        :type count: int
+        :param exclude: names of works not to search, e.g. the query itself
+        :type exclude: iterable
+        :param max_extensions: number of seed clusters extended, those with the most seeds
+        :type max_extensions: int
+        :param min_score: smallest alignment score reported, by default that of two seeds
+        in a row
+        :type min_score: int
+        :return: one dict per passage, best first: the "name" of the work, the alignment
+        "score", the interval positions "query" and "match" (start, end exclusive) in the
+        two works and the first and last measure number they span, "query_measures" and
+        "measures", or None when the features have no measures
+        :rtype: list
+        """
+        query = list(features["intervals"])
+        if min_score is None:
+            min_score = 2 * self.k * self.match
+        exclude = set(exclude)
+        exclude = set(work for work, name in enumerate(self.names) if name in exclude)
+        passages = []
+        for work, cluster in self._clusters(query, exclude)[:max_extensions]:
+            found = self._extend(query, self.intervals[work], cluster)
+            if found is not None and found[0] >= min_score:
+                passages.append((work,) + found)
+        # stretches found from several clusters are only reported once, for the best of them
+        passages.sort(key=lambda passage: (-passage[1], passage[0], passage[2], passage[4]))
+        results = []
+        for work, score, query_start, query_end, start, end in passages:
+            if any(other[0] == work and start < other[5] and other[4] < end for other in results):
+                continue
+            results.append((work, score, query_start, query_end, start, end))
+            if len(results) == count:
+                break
+        return [{
+            "name": self.names[work],
+            "score": score,
+            "query": (query_start, query_end),
+            "match": (start, end),
+            "query_measures": _span(features.get("measures"), query_start, query_end),
+            "measures": _span(self.measures[work], start, end)
+        } for work, score, query_start, query_end, start, end in results]
@@ -0,0 +1,449 @@
+import math
+import numpy as np
+
+"""
+This file contains the array based scoring used by MusicRanker. The loop version
+of bm25 and pivoted length normalization rescanned the whole corpus for every vector
+slot to get its document frequency and recomputed the length of the candidate work
+on every iteration. Here the document frequency and the idf term of every slot are
+computed once when the engine is built, and each score is a handful of array operations.
+
+The formulas are exactly the ones from MusicRanker:
+
+    bm25: sum over shared slots of
+        dwork[i] * (log(1 + log(1 + cwork[i])) / (1 - b + b * |cwork| / avdl)) * log10((N + 1) / df[i])
+
+    pivoted length normalization: sum over shared slots of
+        dwork[i] * ((k + 1) * cwork[i] / (cwork[i] + k * (1 - b + b * |cwork| / avdl))) * log10((N + 1) / df[i])
+"""
+
+def _isSparse(corpus):
+    # CsrMatrix from lib.preprocess.feature_store
+    return hasattr(corpus, "indptr")
+
+class ScoringEngine(object):
+
+    def __init__(self, doc_freq, n_docs, avdl):
+        """
+        :param doc_freq: number of works in the corpus containing each vector slot
+        :type doc_freq: list or np.ndarray
+        :param n_docs: number of works in the corpus
+        :type n_docs: int
+        :param avdl: average document length
+        :type avdl: float
+        """
+        # plain python ints, so adding a work only touches the slots of that work
+        self.doc_freq = np.asarray(doc_freq, dtype=np.int64).tolist()
+        self.n_docs = n_docs
+        self.avdl = float(avdl)
+        self._changed()
+        # table of log(1 + log(1 + c)) for integer counts c, grown on demand
+        self._log_log = np.zeros(0)
+
+    def _changed(self):
+        # the idf of every slot depends on the number of works, so after an update it is
+        # recomputed when it is next needed: the whole array by the dense scoring, one
+        # term at a time by the sparse (dict) scoring
+        self._idf = None
+        self._term_idf = {}
+
+    def _termIdf(self, term):
+        # computed with math.log so the single pair scores match the loop version bit for bit.
+        # slots that never occur in the corpus get an idf of 0 (the loop version divided by zero)
+        if term not in self._term_idf:
+            df = self.doc_freq[term]
+            self._term_idf[term] = math.log((self.n_docs + 1) / df, 10) if df else 0.0
+        return self._term_idf[term]
+
+    @property
+    def idf(self):
+        """idf log10((N + 1) / df) of every slot, 0 for slots no work has.
+
+        :rtype: np.ndarray
+        """
+        if self._idf is None:
+            self._idf = np.array([self._termIdf(term) for term in range(len(self.doc_freq))])
+        return self._idf
+
+    @property
+    def width(self):
+        """number of vector slots / term ids the engine knows.
+
+        :rtype: int
+        """
+        return len(self.doc_freq)
+
+    @classmethod
+    def fromCorpus(cls, corpus, avdl):
+        """build an engine from a corpus of equal length vectors.
+
+        :param corpus: list of vectors, one per work
+        :type corpus: list or np.ndarray
+        :param avdl: average document length
+        :type avdl: float
+        :rtype: ScoringEngine
+        """
+        if _isSparse(corpus):
+            # memory mapped CsrMatrix from the feature store, never densify it
+            return cls(corpus.docFreq(), len(corpus), avdl)
+        if len(corpus) and isinstance(corpus[0], dict):
+            return cls.fromSparse(corpus, avdl)
+        matrix = np.asarray(corpus)
+        doc_freq = np.count_nonzero(matrix, axis=0)
+        return cls(doc_freq, len(matrix), avdl)
+
+    @classmethod
+    def fromSparse(cls, corpus, avdl, width=None):
+        """build an engine from a corpus of sparse vectors (term id -> count, see Vocabulary).
+
+        :param corpus: list of dicts, one per work
+        :type corpus: list
+        :param avdl: average document length
+        :type avdl: float
+        :param width: number of term ids, defaults to the largest id in the corpus + 1
+        :type width: int
+        :rtype: ScoringEngine
+        """
+        if width is None:
+            width = max([max(doc) + 1 for doc in corpus if doc] + [0])
+        doc_freq = [0] * width
+        for doc in corpus:
+            for term, count in doc.items():
+                if count != 0:
+                    doc_freq[term] += 1
+        return cls(doc_freq, len(corpus), avdl)
+
+    @classmethod
+    def fromStream(cls, documents):
+        """build an engine in a single pass over a stream of works, without holding
+        the corpus in memory (see LazyCorpus).
+
+        :param documents: iterable of (vector, length) pairs, the vector being a dense
+        vector or a sparse dict and length the length of the work it belongs to
+        :type documents: iterable
+        :rtype: ScoringEngine
+        """
+        counter = DocFreqCounter()
+        for vector, length in documents:
+            counter.add(vector, length)
+        return counter.engine()
+
+    def _terms(self, vector):
+        # slots / term ids present in a dense vector or a sparse dict, and the width they need
+        if isinstance(vector, dict):
+            terms = [term for term, count in vector.items() if count != 0]
+            return terms, max(terms) + 1 if terms else 0
+        return np.flatnonzero(np.asarray(vector)).tolist(), len(vector)
+
+    def _updateDocFreq(self, vector, delta):
+        terms, width = self._terms(vector)
+        if width > len(self.doc_freq):
+            # the first dense vector sets the width, new term ids (a grown Vocabulary) get their own slot
+            self.doc_freq.extend([0] * (width - len(self.doc_freq)))
+        for term in terms:
+            self.doc_freq[term] += delta
+        self.n_docs += delta
+        self._changed()
+
+    def addDocument(self, vector):
+        """account for a work added to the corpus. avdl is owned by the caller and
+        has to be updated separately.
+
+        :param vector: dense vector or sparse dict of the new work
+        :type vector: list or dict
+        """
+        self._updateDocFreq(vector, 1)
+
+    def removeDocument(self, vector):
+        """account for a work removed from the corpus, the reverse of addDocument.
+
+        :param vector: the vector the work was added with
+        :type vector: list or dict
+        """
+        self._updateDocFreq(vector, -1)
+
+    def _logLog(self, counts):
+        # np.log can differ from math.log in the last bit, so look the values up in a
+        # table built with math.log instead. counts are always non negative integers
+        top = int(counts.max()) if counts.size else 0
+        if top >= len(self._log_log):
+            size = max(top + 1, 2 * len(self._log_log))
+            self._log_log = np.array([math.log(1 + math.log(1 + c)) for c in range(size)])
+        return self._log_log[counts.astype(np.int64)]
+
+    def _lengthNormalizer(self, lengths, b):
+        return 1 - b + b * (lengths / self.avdl)
+
+    def lengthNormalizer(self, lengths, b):
+        """length normalizer 1 - b + b * |cwork| / avdl of bm25 and pln, for many works.
+
+        :param lengths: total count of every work
+        :type lengths: np.ndarray
+        :param b: length normalization parameter
+        :type b: float
+        :rtype: np.ndarray
+        """
+        return self._lengthNormalizer(np.asarray(lengths, dtype=float), b)
+
+    def _bm25Terms(self, dwork, cworks, b):
+        # cworks is a 2d array, one row per candidate work
+        denominator = self._lengthNormalizer(cworks.sum(axis=1, dtype=float), b)[:, None]
+        numerator = self._logLog(cworks)
+        return dwork * (numerator / denominator) * self.idf
+
+    def _plnTerms(self, dwork, cworks, b, k):
+        normalizer = self._lengthNormalizer(cworks.sum(axis=1, dtype=float), b)[:, None]
+        numerator = (k + 1) * cworks
+        # with k = 0 empty slots give 0 / 0, those slots are masked out by the callers
+        with np.errstate(divide="ignore", invalid="ignore"):
+            denominator = cworks + k * normalizer
+            return dwork * (numerator / denominator) * self.idf
+
+    def _sparseScores(self, dwork, cworks, weight):
+        # score every row of a CsrMatrix a block of rows at a time. weight maps
+        # (counts, row lengths) of the stored entries to their per document weight
+        dwork = np.asarray(dwork, dtype=float)
+        scores = np.zeros(len(cworks))
+        for start, indptr, indices, data in cworks.blocks():
+            n_rows = len(indptr) - 1
+            rows = np.repeat(np.arange(n_rows), np.diff(indptr))
+            counts = data.astype(float)
+            lengths = np.bincount(rows, weights=counts, minlength=n_rows)
+            # stored entries are never zero, so a slot is shared when the query has it
+            query = dwork[indices]
+            shared = query != 0
+            rows, indices, counts, query = rows[shared], indices[shared], counts[shared], query[shared]
+            terms = query * weight(counts, lengths[rows]) * self.idf[indices]
+            scores[start:start + n_rows] = np.bincount(rows, weights=terms, minlength=n_rows)
+        return scores
+
+    def _prepare(self, dwork, cworks):
+        dwork = np.asarray(dwork, dtype=float)
+        cworks = np.atleast_2d(np.asarray(cworks, dtype=float))
+        # only slots present in both works contribute to the score
+        shared = (dwork != 0) & (cworks != 0)
+        return dwork, cworks, shared
+
+    def _single(self, terms, shared):
+        # sum the surviving terms left to right in plain python so that a single pair
+        # scores exactly the same as the original loop
+        return sum(terms[0][shared[0]].tolist())
+
+    def bm25(self, dwork, cwork, b):
+        """bm25 score of one pair of works.
+
+        :param dwork: query vector
+        :type dwork: list or np.ndarray
+        :param cwork: candidate vector
+        :type cwork: list or np.ndarray
+        :param b: length normalization parameter
+        :type b: float
+        :rtype: float
+        """
+        dwork, cworks, shared = self._prepare(dwork, cwork)
+        return self._single(self._bm25Terms(dwork, cworks, b), shared)
+
+    def bm25Batch(self, dwork, cworks, b):
+        """bm25 scores of one query vector against every row of a matrix of candidates.
+
+        :param dwork: query vector
+        :type dwork: list or np.ndarray
+        :param cworks: candidate vectors, one per row, or a CsrMatrix
+        :type cworks: list, np.ndarray or CsrMatrix
+        :param b: length normalization parameter
+        :type b: float
+        :return: one score per candidate
+        :rtype: np.ndarray
+        """
+        if _isSparse(cworks):
+            return self._sparseScores(dwork, cworks, lambda counts, lengths: self._logLog(counts) / self._lengthNormalizer(lengths, b))
+        dwork, cworks, shared = self._prepare(dwork, cworks)
+        return np.where(shared, self._bm25Terms(dwork, cworks, b), 0).sum(axis=1)
+
+    def _sharedTerms(self, dwork, cwork):
+        # walk the smaller of the two sparse vectors. sorted so the terms are summed in the
+        # same order as the dense version, which keeps the scores identical
+        small, large = (dwork, cwork) if len(dwork) <= len(cwork) else (cwork, dwork)
+        shared = [term for term, count in small.items() if count != 0 and large.get(term, 0) != 0]
+        # terms the corpus has never seen have no idf (and no slot in a dense vector)
+        return sorted(term for term in shared if term < len(self.doc_freq) and self.doc_freq[term])
+
+    def bm25Sparse(self, dwork, cwork, b):
+        """bm25 score of one pair of sparse vectors (term id -> count). Only the terms the two
+        works share are touched, the vocabulary size does not matter.
+
+        :param dwork: query vector
+        :type dwork: dict
+        :param cwork: candidate vector
+        :type cwork: dict
+        :param b: length normalization parameter
+        :type b: float
+        :rtype: float
+        """
+        denominator = 1 - b + b * (float(sum(cwork.values())) / self.avdl)
+        score = 0
+        for term in self._sharedTerms(dwork, cwork):
+            numerator = math.log(1 + math.log(1 + cwork[term]))
+            score += dwork[term] * (numerator / denominator) * self._termIdf(term)
+        return score
+
+    def pivotedLengthNormalizationSparse(self, dwork, cwork, b, k):
+        """pivoted length normalization score of one pair of sparse vectors (term id -> count).
+
+        :param dwork: query vector
+        :type dwork: dict
+        :param cwork: candidate vector
+        :type cwork: dict
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter
+        :type k: float
+        :rtype: float
+        """
+        normalizer = 1 - b + b * (float(sum(cwork.values())) / self.avdl)
+        score = 0
+        for term in self._sharedTerms(dwork, cwork):
+            numerator = (k + 1) * cwork[term]
+            denominator = cwork[term] + k * normalizer
+            score += dwork[term] * (numerator / denominator) * self._termIdf(term)
+        return score
+
+    def pivotedLengthNormalization(self, dwork, cwork, b, k):
+        """pivoted length normalization score of one pair of works.
+
+        :param dwork: query vector
+        :type dwork: list or np.ndarray
+        :param cwork: candidate vector
+        :type cwork: list or np.ndarray
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter
+        :type k: float
+        :rtype: float
+        """
+        dwork, cworks, shared = self._prepare(dwork, cwork)
+        return self._single(self._plnTerms(dwork, cworks, b, k), shared)
+
+    def pivotedLengthNormalizationBatch(self, dwork, cworks, b, k):
+        """pivoted length normalization scores of one query vector against every row
+        of a matrix of candidates.
+
+        :param dwork: query vector
+        :type dwork: list or np.ndarray
+        :param cworks: candidate vectors, one per row, or a CsrMatrix
+        :type cworks: list, np.ndarray or CsrMatrix
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter
+        :type k: float
+        :return: one score per candidate
+        :rtype: np.ndarray
+        """
+        if _isSparse(cworks):
+            return self._sparseScores(dwork, cworks, lambda counts, lengths: ((k + 1) * counts) / (counts + k * self._lengthNormalizer(lengths, b)))
+        dwork, cworks, shared = self._prepare(dwork, cworks)
+        return np.where(shared, self._plnTerms(dwork, cworks, b, k), 0).sum(axis=1)
+
+    def termScores(self, terms, query, counts, normalizer, k):
+        """bm25 and pln of one query against many candidates together. The slots are
+        restricted to those of the query, and the idf, the candidates' length normalizers
+        and the mask of the shared slots are computed once for both scores. The terms are
+        summed left to right like the single pair versions, so every score is bit for bit
+        the one of bm25 / bm25Sparse and pivotedLengthNormalization(Sparse).
+
+        :param terms: the slots / term ids of the query, ascending
+        :type terms: list
+        :param query: count of the query for every term
+        :type query: list
+        :param counts: count of every candidate (rows) for every term (columns)
+        :type counts: np.ndarray
+        :param normalizer: length normalizer of every candidate, see lengthNormalizer
+        :type normalizer: np.ndarray
+        :param k: term frequency saturation parameter of pln
+        :type k: float
+        :return: (bm25, pln), one score per candidate each
+        :rtype: tuple
+        """
+        normalizer = np.asarray(normalizer, dtype=float)
+        if not len(terms):
+            return np.zeros(len(normalizer)), np.zeros(len(normalizer))
+        query = np.asarray(query, dtype=float)
+        counts = np.asarray(counts, dtype=float).reshape(len(normalizer), len(terms))
+        idf = self.idf[terms]
+        shared = counts != 0
+        column = normalizer[:, None]
+        bm25 = query * (self._logLog(counts) / column) * idf
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pln = query * (((k + 1) * counts) / (counts + k * column)) * idf
+        # cumsum adds up each row in order, where sum would pair the terms up
+        return np.where(shared, bm25, 0).cumsum(axis=1)[:, -1], np.where(shared, pln, 0).cumsum(axis=1)[:, -1]
+
+    def documentWeights(self, cworks, method, b, k=1.2):
+        """per document weight * idf of every slot, so that the scores of many queries
+        against the same candidates are one matrix product:
+
+            scores = np.dot(dworks, weights.T)
+
+        equal to the batch versions up to float rounding (the products are summed in a
+        different order).
+
+        :param cworks: candidate vectors, one per row
+        :type cworks: list or np.ndarray
+        :param method: 'bm25' or 'pln'
+        :type method: str
+        :param b: length normalization parameter
+        :type b: float
+        :param k: term frequency saturation parameter (pln only)
+        :type k: float
+        :return: one row of weights per candidate
+        :rtype: np.ndarray
+        """
+        cworks = np.atleast_2d(np.asarray(cworks, dtype=float))
+        ones = np.ones(cworks.shape[1])
+        if method == "bm25":
+            weights = self._bm25Terms(ones, cworks, b)
+        elif method == "pln":
+            weights = self._plnTerms(ones, cworks, b, k)
+        else:
+            raise ValueError("Unknown scoring method {0}. Use 'bm25' or 'pln'".format(method))
+        # slots the candidate does not have contribute nothing
+        return np.where(cworks != 0, weights, 0)
+
+
+class DocFreqCounter(object):
+    """document frequencies, number of works and total length accumulated one work
+    at a time, so several engines can be fed from the same pass over a corpus."""
+
+    def __init__(self, width=0):
+        """
+        :param width: number of slots to start with, vectors with more slots widen it
+        :type width: int
+        """
+        self.doc_freq = [0] * width
+        self.n_docs = 0
+        self.total_length = 0
+
+    def add(self, vector, length):
+        """
+        :param vector: dense vector or sparse dict of the work
+        :type vector: list or dict
+        :param length: length of the work, e.g. its number of intervals
+        :type length: int
+        """
+        if isinstance(vector, dict):
+            terms = [term for term, count in vector.items() if count != 0]
+            width = max(terms) + 1 if terms else 0
+        else:
+            terms = np.flatnonzero(np.asarray(vector)).tolist()
+            width = len(vector)
+        if width > len(self.doc_freq):
+            self.doc_freq.extend([0] * (width - len(self.doc_freq)))
+        for term in terms:
+            self.doc_freq[term] += 1
+        self.n_docs += 1
+        self.total_length += length
+
+    def engine(self):
+        # same average as setAVDL, the total length over the number of works
+        avdl = self.total_length / self.n_docs if self.n_docs else 0.0
+        return ScoringEngine(self.doc_freq, self.n_docs, avdl)
@@ -0,0 +1,205 @@
+import math
+from collections import Counter
+
+import numpy as np
+
+from lib.sequence_similarity.sequence_similarity import lcsLength, levenshteinDistance
+from lib.instrumentation.profiler import PROFILER
+
+"""
+This file contains early terminating versions of the comparisons main.py makes for
+every case. All the analysis needs to know is whether the related pair of works scores
+above the baseline pair, not the scores themselves, so each comparison starts with
+cheap bounds and only runs the full scorers when the bounds leave the outcome open:
+
+    lcs           the number of symbols two sequences share, counted with their
+                  multiplicity (histogram overlap), bounds the LCS from above, and the
+                  most often shared single symbol bounds it from below. Otherwise the
+                  baseline is computed and the related pair is cut off as soon as it
+                  can no longer beat it (see lcsLength's min_score)
+    levenshtein   the distance is at least the difference in length, and at least the
+                  longer length minus the histogram overlap, and at most the longer
+                  length. Otherwise the related pair is computed and the baseline is
+                  cut off as soon as it is sure to reach it (max_distance)
+    bm25 / pln    a term contributes at most the idf mass of the query term times the
+                  largest weight any term of the candidate can have (its highest count
+                  under the candidate's length normalizer). When this bound of the
+                  baseline stays below the related score the baseline is not scored
+
+Every function returns exactly what comparing the two full scores with > would, with
+main.py's convention that a larger Levenshtein distance counts as a pass. What was
+decided where is counted under "screening" in the profiler.
+
+usage:
+
+    screenLCS((c_melody, d_melody), (c_melody, random_melody))
+    bound = ScoreBound(ranker)
+    screenScore(ranker.bm25, bound.bm25, (d_vector, c_vector), (random_vector, c_vector))
+"""
+
+# relative slack between a float bound and a float score, so that rounding can never
+# make a bound that is tight in exact arithmetic decide a tie
+TOLERANCE = 1e-9
+
+
+def _histogramBounds(a_counts, b_counts):
+    # (most often shared single symbol, shared symbols counted with their multiplicity)
+    if len(a_counts) > len(b_counts):
+        a_counts, b_counts = b_counts, a_counts
+    shared = [min(count, b_counts[symbol]) for symbol, count in a_counts.items() if symbol in b_counts]
+    return max(shared, default=0), sum(shared)
+
+def _counts(sequence):
+    # memory mapped rows come in as numpy arrays, see sequence_similarity._asList
+    return Counter(sequence.tolist() if hasattr(sequence, "tolist") else sequence)
+
+def lcsBounds(a, b):
+    """lower and upper bound of the LCS length of two sequences, from their histograms.
+
+    :param a: first sequence
+    :type a: list
+    :param b: second sequence
+    :type b: list
+    :rtype: tuple
+    """
+    return _histogramBounds(_counts(a), _counts(b))
+
+def levenshteinBounds(a, b):
+    """lower and upper bound of the Levenshtein distance of two sequences, from their
+    lengths and histograms.
+
+    :param a: first sequence
+    :type a: list
+    :param b: second sequence
+    :type b: list
+    :rtype: tuple
+    """
+    longest = max(len(a), len(b))
+    # every symbol of the longer sequence that is not matched costs at least one edit
+    _, overlap = lcsBounds(a, b)
+    return max(abs(len(a) - len(b)), longest - overlap), longest
+
+def screenLCS(pair, base):
+    """whether the LCS of pair is greater than the LCS of base.
+
+    :param pair: the related sequences
+    :type pair: tuple
+    :param base: the baseline sequences
+    :type base: tuple
+    :rtype: bool
+    """
+    low, high = lcsBounds(*pair)
+    base_low, base_high = lcsBounds(*base)
+    if low > base_high:
+        PROFILER.count("screening", "lcs_bound")
+        return True
+    if high <= base_low:
+        PROFILER.count("screening", "lcs_bound")
+        return False
+    base_score = lcsLength(*base)
+    if high <= base_score:
+        PROFILER.count("screening", "lcs_bound")
+        return False
+    PROFILER.count("screening", "lcs_cutoff")
+    return lcsLength(*pair, min_score=base_score) is not None
+
+def screenLevenshtein(pair, base):
+    """whether the Levenshtein distance of pair is greater than that of base.
+
+    :param pair: the related sequences
+    :type pair: tuple
+    :param base: the baseline sequences
+    :type base: tuple
+    :rtype: bool
+    """
+    low, high = levenshteinBounds(*pair)
+    base_low, base_high = levenshteinBounds(*base)
+    if low > base_high:
+        PROFILER.count("screening", "levenshtein_bound")
+        return True
+    if high <= base_low:
+        PROFILER.count("screening", "levenshtein_bound")
+        return False
+    distance = levenshteinDistance(*pair)
+    if distance <= base_low:
+        PROFILER.count("screening", "levenshtein_bound")
+        return False
+    PROFILER.count("screening", "levenshtein_cutoff")
+    # None once the baseline is sure to be at least as far apart as the pair
+    return levenshteinDistance(*base, max_distance=distance - 1) is not None
+
+def screenScore(score, upper, pair, base):
+    """whether score(*pair) is greater than score(*base), scoring the baseline only
+    when its upper bound does not already stay below the related score.
+
+    :param score: pair score, e.g. ranker.bm25
+    :type score: callable
+    :param upper: upper bound of the same score, e.g. ScoreBound(ranker).bm25
+    :type upper: callable
+    :param pair: the related (dwork, cwork) vectors
+    :type pair: tuple
+    :param base: the baseline (dwork, cwork) vectors
+    :type base: tuple
+    :rtype: bool
+    """
+    related = score(*pair)
+    if upper(*base) * (1 + TOLERANCE) < related:
+        PROFILER.count("screening", "score_bound")
+        return True
+    PROFILER.count("screening", "score_full")
+    return related > score(*base)
+
+
+class ScoreBound(object):
+    """max contribution bounds of MusicRanker's bm25 and pivoted length normalization.
+    Both sum dwork[i] * weight(cwork[i]) * idf[i] over the shared slots, with a weight
+    that grows with the count, so the score is at most the idf mass of dwork times the
+    weight of the highest count of cwork. The bound costs one pass over each vector and
+    none of the logs or divisions per slot."""
+
+    def __init__(self, ranker):
+        """
+        :param ranker: the ranker whose scores are bounded
+        :type ranker: MusicRanker
+        """
+        self.engine = ranker.engine
+        self.b = ranker.B
+        self.k = ranker.K
+
+    def _mass(self, dwork):
+        # sum of dwork[i] * idf[i], terms without an idf contribute nothing
+        idf = self.engine.idf
+        if isinstance(dwork, dict):
+            return sum(count * idf[term] for term, count in dwork.items() if term < len(idf))
+        return float(np.dot(np.asarray(dwork, dtype=float), idf))
+
+    def _candidate(self, cwork):
+        # (highest count, length normalizer) of a candidate
+        counts = list(cwork.values()) if isinstance(cwork, dict) else np.asarray(cwork).tolist()
+        top = max(counts, default=0)
+        return top, 1 - self.b + self.b * (float(sum(counts)) / self.engine.avdl)
+
+    def bm25(self, dwork, cwork):
+        """upper bound of ranker.bm25(dwork, cwork).
+
+        :rtype: float
+        """
+        top, normalizer = self._candidate(cwork)
+        if top <= 0:
+            return 0.0
+        if normalizer <= 0:
+            # b above 1 can flip the sign of the weights, nothing to bound with
+            return math.inf
+        return self._mass(dwork) * math.log(1 + math.log(1 + top)) / normalizer
+
+    def pln(self, dwork, cwork):
+        """upper bound of ranker.pivoted_length_normalization(dwork, cwork).
+
+        :rtype: float
+        """
+        top, normalizer = self._candidate(cwork)
+        if top <= 0:
+            return 0.0
+        if normalizer <= 0 or self.k < 0:
+            return math.inf
+        return self._mass(dwork) * (self.k + 1) * top / (top + self.k * normalizer)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import tempfile
+from collections import Counter
+
+"""
+This file contains the corpus statistics we use to size the vector representation
+of the works. The statistics are collected from the features while they are being
+extracted (see extractCorpusFeatures), so they never cost an extra parse:
+
+    interval_min / interval_max     smallest and largest interval in the corpus
+    interval_histogram              occurrences of every interval
+    doc_lengths                     number of intervals and measure words of every work
+    vocab_size                      number of distinct measure words
+
+The vector width follows from interval_min and interval_max, so no interval is
+dropped by intervalToVector and no slot is always empty.
+
+The statistics are persisted as json together with a fingerprint of the corpus (the
+feature cache key of every work, which covers both the file contents and the
+extractor version). A later run over the same corpus reads them back instead of
+loading every work:
+
+{
+    "fingerprint": "...",
+    "stats": {
+        "works": 94,
+        "interval_min": -18,
+        ...
+    }
+}
+"""
+
+class CorpusStats(object):
+
+    def __init__(self):
+        self.interval_min = None
+        self.interval_max = None
+        self.interval_histogram = Counter()
+        self.doc_lengths = {}
+        self.words = Counter()
+        self._vocab_size = None
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, name, features):
+        """account for the features of one work. A work that was already added is
+        skipped, so every distinct file counts once.
+
+        :param name: file of the work
+        :type name: str
+        :param features: features of the work (see extractFeatures)
+        :type features: dict
+        """
+        if name in self.doc_lengths:
+            return
+        intervals = features["intervals"]
+        self.interval_histogram.update(intervals)
+        if intervals:
+            low = min(intervals)
+            high = max(intervals)
+            self.interval_min = low if self.interval_min is None else min(self.interval_min, low)
+            self.interval_max = high if self.interval_max is None else max(self.interval_max, high)
+        self.words.update(features["words"])
+        self.doc_lengths[name] = {"intervals": len(intervals), "words": len(features["words"])}
+
+    @property
+    def vocab_size(self):
+        # loaded statistics only know the size, not the words themselves
+        return len(self.words) if self._vocab_size is None else self._vocab_size
+
+    def intervalRange(self, default=(-20, 20)):
+        """(vector_min, vector_max) covering every interval of the corpus.
+
+        :param default: range used when the corpus holds no intervals at all
+        :type default: tuple
+        :rtype: tuple
+        """
+        if self.interval_min is None:
+            return default
+        return self.interval_min, self.interval_max
+
+    def summary(self):
+        """the statistics, json serializable.
+
+        :rtype: dict
+        """
+        interval_lengths = [lengths["intervals"] for lengths in self.doc_lengths.values()]
+        word_lengths = [lengths["words"] for lengths in self.doc_lengths.values()]
+        return {
+            "works": len(self),
+            "interval_min": self.interval_min,
+            "interval_max": self.interval_max,
+            # json keys are strings, sorted so the file is readable
+            "interval_histogram": {str(i): self.interval_histogram[i] for i in sorted(self.interval_histogram)},
+            "doc_lengths": self.doc_lengths,
+            "avg_intervals": sum(interval_lengths) / len(interval_lengths) if interval_lengths else 0.0,
+            "avg_words": sum(word_lengths) / len(word_lengths) if word_lengths else 0.0,
+            "vocab_size": self.vocab_size
+        }
+
+    @classmethod
+    def fromSummary(cls, summary):
+        stats = cls()
+        stats.interval_min = summary["interval_min"]
+        stats.interval_max = summary["interval_max"]
+        stats.interval_histogram = Counter({int(i): count for i, count in summary["interval_histogram"].items()})
+        stats.doc_lengths = dict(summary["doc_lengths"])
+        stats._vocab_size = summary["vocab_size"]
+        return stats
+
+    def save(self, path, fingerprint):
+        """write the statistics to a json file.
+
+        :param path: json file
+        :type path: str
+        :param fingerprint: fingerprint of the corpus they describe (see corpusFingerprint)
+        :type fingerprint: str
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # write to a temp file and rename so a concurrent reader never sees a partial file
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"fingerprint": fingerprint, "stats": self.summary()}, f, indent=1)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """read statistics written by save, or None when the file is missing, corrupt
+        or describes a different corpus.
+
+        :param path: json file
+        :type path: str
+        :param fingerprint: fingerprint of the current corpus
+        :type fingerprint: str
+        :rtype: CorpusStats or None
+        """
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("fingerprint") != fingerprint:
+            return None
+        return cls.fromSummary(entry["stats"])
+
+
+def corpusFingerprint(keys):
+    """fingerprint of a corpus from the feature cache keys of its works
+    (see FeatureCache.key). Order and duplicates do not matter.
+
+    :param keys: cache key of every work
+    :type keys: iterable
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for key in sorted(set(keys)):
+        digest.update(key.encode())
+    return digest.hexdigest()
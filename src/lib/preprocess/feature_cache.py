@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import tempfile
+
+from lib.instrumentation.profiler import PROFILER
+from lib.preprocess.score_reader import isArchive, openArchive
+
+"""
+This file contains a small on-disk cache for the features we derive from each
+score (interval lists, measure words, pitch arrays). Parsing a file with music21
+is by far the slowest part of the pipeline, and every entry point used to parse
+the same works several times per run.
+
+Entries are keyed by the sha256 of the file contents together with the version
+string of the extractor that produced them, so an entry is invalidated
+automatically when either the score or the extraction code changes. A compressed
+MusicXML archive is keyed by the score inside it, not by the zip, so the same work
+zipped twice (or zipped and unzipped) shares one entry, and works are never confused
+by their path or by the name of the score inside their archive. Each entry is a
+single json file under the cache directory:
+
+{
+    "version": "1",
+    "source": "light_myLife.xml",
+    "features": {
+        "intervals": [...],
+        "words": [...],
+        "pitches": [...]
+    }
+}
+"""
+
+class FeatureCache(object):
+
+    def __init__(self, cache_dir, version):
+        """
+        :param cache_dir: directory the cache entries are written to
+        :type cache_dir: str or Path
+        :param version: version of the feature extractor. bump this whenever the
+        extraction code changes so stale entries are ignored
+        :type version: str
+        """
+        self.cache_dir = str(cache_dir)
+        self.version = str(version)
+        # file hashes keyed by (path, mtime, size) so we only read each file once per process
+        self._hashes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fileHash(self, filePath):
+        """sha256 of the raw contents of a file, or of the score inside it for a
+        compressed MusicXML archive.
+
+        :param filePath: path to the score
+        :type filePath: str
+        :return: hex digest
+        :rtype: str
+        """
+        stat = os.stat(filePath)
+        memo_key = (os.path.abspath(filePath), stat.st_mtime_ns, stat.st_size)
+        if memo_key not in self._hashes:
+            digest = hashlib.sha256()
+            with (openArchive(filePath) if isArchive(filePath) else open(filePath, "rb")) as f:
+                for block in iter(lambda: f.read(1 << 16), b""):
+                    digest.update(block)
+            self._hashes[memo_key] = digest.hexdigest()
+        return self._hashes[memo_key]
+
+    def key(self, filePath):
+        """cache key for a file: the content hash combined with the extractor version.
+
+        :param filePath: path to the score
+        :type filePath: str
+        :rtype: str
+        """
+        return hashlib.sha256("{0}:{1}".format(self.version, self.fileHash(filePath)).encode()).hexdigest()
+
+    def entryPath(self, filePath):
+        return os.path.join(self.cache_dir, self.key(filePath) + ".json")
+
+    def get(self, filePath):
+        """return the cached features for a file, or None on a miss.
+
+        :param filePath: path to the score
+        :type filePath: str
+        :rtype: dict or None
+        """
+        try:
+            with open(self.entryPath(filePath)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            # missing or corrupt entries are just misses
+            self.misses += 1
+            PROFILER.count("feature_cache", "miss")
+            return None
+        if entry.get("version") != self.version:
+            self.misses += 1
+            PROFILER.count("feature_cache", "miss")
+            return None
+        self.hits += 1
+        PROFILER.count("feature_cache", "hit")
+        return entry["features"]
+
+    def put(self, filePath, features):
+        """store the features for a file.
+
+        :param filePath: path to the score
+        :type filePath: str
+        :param features: json serializable features
+        :type features: dict
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = {
+            "version": self.version,
+            "source": os.path.basename(filePath),
+            "features": features
+        }
+        # write to a temp file and rename so concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp, self.entryPath(filePath))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def getOrExtract(self, filePath, extractor):
+        """return the cached features for a file, calling extractor(filePath)
+        and storing the result on a miss.
+
+        :param filePath: path to the score
+        :type filePath: str
+        :param extractor: function from a file path to a features dict
+        :type extractor: callable
+        :rtype: dict
+        """
+        features = self.get(filePath)
+        if features is None:
+            features = extractor(filePath)
+            self.put(filePath, features)
+        return features
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import tempfile
+
+import numpy as np
+
+"""
+This file contains a compact on-disk, column oriented store for the features of a
+whole catalog. Everything is kept in flat binary arrays that are memory mapped when
+the store is opened, so opening is instant and only the pages we touch are read,
+even for catalogs much larger than RAM.
+
+A store directory holds
+
+    meta.json                   number of works, their names, vector bounds, dtypes
+    vocab.json                  the measure word of every word id
+    intervals.values.bin        int8, every interval list back to back
+    intervals.offsets.bin       int64, work i is values[offsets[i]:offsets[i + 1]]
+    words.values.bin            int32 word ids, same ragged layout as the intervals
+    words.offsets.bin
+    vectors.{indptr,indices,data}.bin       interval counts as a CSR sparse matrix,
+                                            column j is the interval vector_min + j
+    word_vectors.{indptr,indices,data}.bin  measure word counts as a CSR sparse matrix,
+                                            column j is word id j
+
+The ragged arrays and sparse matrices behave like read only lists (len() and
+indexing), so they can be handed to MusicRanker and the sequence similarity
+functions in place of the in memory corpora.
+"""
+
+STORE_VERSION = 1
+
+OFFSET_DTYPE = np.int64
+INTERVAL_DTYPE = np.int8
+ID_DTYPE = np.int32
+COUNT_DTYPE = np.int32
+
+
+def _openArray(path, dtype):
+    # np.memmap refuses empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class RaggedArray(object):
+    """variable length rows stored back to back with an offsets array."""
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("row {0} out of range".format(i))
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """length of every row.
+
+        :rtype: np.ndarray
+        """
+        return np.diff(self.offsets)
+
+
+class CsrMatrix(object):
+    """compressed sparse row matrix. Indexing a row returns it as a dense vector so the
+    matrix can stand in for a list of vectors, use row() to get the sparse form."""
+
+    # rows handled at a time by the whole matrix operations, keeps memory use flat
+    BLOCK_ROWS = 1 << 16
+
+    def __init__(self, indptr, indices, data, width):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.width = width
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        indices, data = self.row(i)
+        dense = np.zeros(self.width, dtype=COUNT_DTYPE)
+        dense[indices] = data
+        return dense
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def row(self, i):
+        """the non zero columns of a row and their values.
+
+        :rtype: tuple of np.ndarray
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("row {0} out of range".format(i))
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        return self.indices[lo:hi], self.data[lo:hi]
+
+    def blocks(self):
+        """yield (first row, indptr, indices, data) for consecutive blocks of rows. the
+        indptr of each block is rebased to start at 0."""
+        for start in range(0, len(self), self.BLOCK_ROWS):
+            stop = min(len(self), start + self.BLOCK_ROWS)
+            indptr = np.asarray(self.indptr[start:stop + 1], dtype=OFFSET_DTYPE)
+            lo, hi = indptr[0], indptr[-1]
+            yield start, indptr - lo, np.asarray(self.indices[lo:hi]), np.asarray(self.data[lo:hi])
+
+    def docFreq(self):
+        """number of rows with a non zero value in each column.
+
+        :rtype: np.ndarray
+        """
+        doc_freq = np.zeros(self.width, dtype=np.int64)
+        for _, _, indices, _ in self.blocks():
+            doc_freq += np.bincount(indices, minlength=self.width)
+        return doc_freq
+
+    def rowSums(self):
+        """sum of every row, the document length of a count vector.
+
+        :rtype: np.ndarray
+        """
+        sums = np.zeros(len(self), dtype=np.int64)
+        for start, indptr, _, data in self.blocks():
+            rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            sums[start:start + len(indptr) - 1] = np.bincount(rows, weights=data, minlength=len(indptr) - 1)
+        return sums
+
+
+class _ArrayWriter(object):
+    # appends numpy arrays to a raw binary file
+
+    def __init__(self, file, dtype):
+        self.dtype = dtype
+        self.file = file
+        self.size = 0
+
+    def write(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        self.file.write(values.tobytes())
+        self.size += len(values)
+
+    def close(self):
+        self.file.close()
+
+
+class FeatureStoreWriter(object):
+    """streams works into a new store one at a time, so building a store never
+    needs more than one work in memory (plus the offsets and the vocabulary).
+
+    Every file is written to a temporary file next to it and renamed into place on
+    close, meta.json last and after the old one is removed. A build that fails or is
+    interrupted leaves either the previous store or one that refuses to open, never
+    a store mixing old and new files."""
+
+    def __init__(self, directory, vector_min=-30, vector_max=30):
+        """
+        :param directory: directory to create the store in
+        :type directory: str
+        :param vector_min: smallest interval given its own vector column
+        :type vector_min: int
+        :param vector_max: largest interval given its own vector column
+        :type vector_max: int
+        """
+        self.directory = str(directory)
+        self.vector_min = vector_min
+        self.vector_max = vector_max
+        os.makedirs(self.directory, exist_ok=True)
+        self.names = []
+        self.vocab = {}
+        # final path -> temporary path of every file of the store
+        self.temporary = {}
+        self.writers = {}
+        try:
+            for name, dtype in [("intervals.values", INTERVAL_DTYPE), ("words.values", ID_DTYPE),
+                                ("vectors.indices", ID_DTYPE), ("vectors.data", COUNT_DTYPE),
+                                ("word_vectors.indices", ID_DTYPE), ("word_vectors.data", COUNT_DTYPE)]:
+                self.writers[name] = _ArrayWriter(self._open(name + ".bin", "wb"), dtype)
+            for name in ["intervals.offsets", "words.offsets", "vectors.indptr", "word_vectors.indptr"]:
+                self.writers[name] = _ArrayWriter(self._open(name + ".bin", "wb"), OFFSET_DTYPE)
+                self.writers[name].write([0])
+        except BaseException:
+            self.abort()
+            raise
+
+    def _open(self, name, mode):
+        # a temporary file in the store directory, renamed to name on close
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        self.temporary[os.path.join(self.directory, name)] = path
+        return os.fdopen(fd, mode)
+
+    def _writeCounts(self, prefix, ids):
+        columns, counts = np.unique(np.asarray(ids, dtype=np.int64), return_counts=True)
+        self.writers[prefix + ".indices"].write(columns)
+        self.writers[prefix + ".data"].write(counts)
+        self.writers[prefix + ".indptr"].write([self.writers[prefix + ".indices"].size])
+
+    def add(self, name, features):
+        """append a work to the store.
+
+        :param name: name of the work, usually its file name
+        :type name: str
+        :param features: features dict with "intervals" and "words" (see extractFeatures)
+        :type features: dict
+        """
+        intervals = np.asarray(features["intervals"], dtype=np.int64)
+        if len(intervals) and (intervals.min() < np.iinfo(INTERVAL_DTYPE).min or intervals.max() > np.iinfo(INTERVAL_DTYPE).max):
+            raise ValueError("{0} has an interval that does not fit in an int8".format(name))
+        word_ids = [self.vocab.setdefault(word, len(self.vocab)) for word in features["words"]]
+
+        self.writers["intervals.values"].write(intervals)
+        self.writers["intervals.offsets"].write([self.writers["intervals.values"].size])
+        self.writers["words.values"].write(word_ids)
+        self.writers["words.offsets"].write([self.writers["words.values"].size])
+
+        # intervals outside the vector bounds are dropped, same as intervalToVector
+        in_range = intervals[(intervals >= self.vector_min) & (intervals <= self.vector_max)]
+        self._writeCounts("vectors", in_range - self.vector_min)
+        self._writeCounts("word_vectors", word_ids)
+        self.names.append(name)
+
+    def close(self):
+        """finish the store and move its files into place."""
+        for writer in self.writers.values():
+            writer.close()
+        with self._open("vocab.json", "w") as f:
+            json.dump(sorted(self.vocab, key=self.vocab.get), f)
+        meta = {
+            "version": STORE_VERSION,
+            "n_docs": len(self.names),
+            "names": self.names,
+            "vector_min": self.vector_min,
+            "vector_max": self.vector_max
+        }
+        with self._open("meta.json", "w") as f:
+            json.dump(meta, f)
+
+        # without meta.json a store does not open, so it goes first and comes back last
+        meta_path = os.path.join(self.directory, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        for path, temporary in self.temporary.items():
+            os.replace(temporary, path)
+        self.temporary = {}
+
+    def abort(self):
+        """drop everything written so far, an existing store is left as it was."""
+        for writer in self.writers.values():
+            writer.close()
+        for temporary in self.temporary.values():
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        self.temporary = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FeatureStore(object):
+    """a store opened for reading. Every array is memory mapped."""
+
+    def __init__(self, directory):
+        """
+        :param directory: directory written by FeatureStoreWriter
+        :type directory: str
+        """
+        self.directory = str(directory)
+        with open(os.path.join(self.directory, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_VERSION:
+            raise ValueError("{0} was written by an incompatible version of the feature store".format(self.directory))
+        with open(os.path.join(self.directory, "vocab.json")) as f:
+            self.vocab = json.load(f)
+        self.names = meta["names"]
+        self.vector_min = meta["vector_min"]
+        self.vector_max = meta["vector_max"]
+
+        # interval lists and measure words (as word ids)
+        self.intervals = RaggedArray(self._open("intervals.values", INTERVAL_DTYPE), self._open("intervals.offsets", OFFSET_DTYPE))
+        self.words = RaggedArray(self._open("words.values", ID_DTYPE), self._open("words.offsets", OFFSET_DTYPE))
+        # term count vectors
+        self.vectors = self._openCsr("vectors", self.vector_max - self.vector_min + 1)
+        self.word_vectors = self._openCsr("word_vectors", len(self.vocab))
+
+    def _open(self, name, dtype):
+        return _openArray(os.path.join(self.directory, name + ".bin"), dtype)
+
+    def _openCsr(self, prefix, width):
+        return CsrMatrix(
+            self._open(prefix + ".indptr", OFFSET_DTYPE),
+            self._open(prefix + ".indices", ID_DTYPE),
+            self._open(prefix + ".data", COUNT_DTYPE),
+            width
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def wordList(self, i):
+        """the measure words of a work as strings, like parseMeasures returns them.
+
+        :rtype: list
+        """
+        return [self.vocab[word_id] for word_id in self.words[i].tolist()]
+
+    @classmethod
+    def build(cls, directory, names, documents, vector_min=-30, vector_max=30):
+        """write a store from a list of features dicts and open it.
+
+        :param directory: directory to create the store in
+        :type directory: str
+        :param names: name of every work
+        :type names: list
+        :param documents: features dict of every work (see extractFeatures)
+        :type documents: iterable
+        :rtype: FeatureStore
+        """
+        with FeatureStoreWriter(directory, vector_min, vector_max) as writer:
+            for name, features in zip(names, documents):
+                writer.add(name, features)
+        return cls(directory)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import zlib
+import math
+from functools import lru_cache
+
+"""
+This file contains the n-gram feature engine. intervalToVector only counts single
+intervals and the measure words ignore rhythm, so here a work becomes a bag of
+tokens of several kinds, all read off its intervals and note durations in one pass:
+
+    ("i", 2, -1, 3)         interval n-grams, for every n in ngrams. Intervals do not
+                            change when a melody is transposed, neither do the n-grams
+    ("r", 2, 1)             an interval together with the duration ratio of the two notes
+                            it joins, as log2(second / first) rounded and clipped to
+                            +-max_ratio. A ratio is as transposition proof as an interval
+                            and does not change with the tempo either
+    ("c", "U", "S", "D")    contour n-grams: every interval as up / down / same, leaps
+                            (more than a third) in capitals and steps in lower case
+
+Instead of giving every token a slot through a vocabulary, which needs a pass over the
+whole corpus first and grows with it, tokens are hashed into a fixed number of slots
+(the hashing trick). Colliding tokens share a slot, which only matters once width is
+small compared to the number of distinct tokens. crc32 is used rather than hash(),
+which changes between processes for strings.
+
+The vectors are term counts like intervalToVector's, so they can be scored by
+MusicRanker, dense (vector) or as sparse dicts (sparse). The length of a work is its
+number of tokens, the sum of its vector.
+
+usage:
+
+    hasher = NgramFeatures(width=4096)
+    vector = hasher.vector(loadFeatures(file))
+"""
+
+DEFAULT_WIDTH = 4096
+
+
+@lru_cache(maxsize=1 << 16)
+def _tokenHash(token):
+    # the same tokens come up over and over again in a corpus, so the hashes are memoized
+    return zlib.crc32(repr(token).encode("utf-8"))
+
+def _contour(interval):
+    if interval == 0:
+        return "s"
+    if interval > 0:
+        return "U" if interval > 2 else "u"
+    return "D" if interval < -2 else "d"
+
+
+class NgramFeatures(object):
+
+    def __init__(self, ngrams=(1, 2, 3), contour=4, rhythm=True, width=DEFAULT_WIDTH, max_ratio=3):
+        """
+        :param ngrams: sizes of the interval n-grams
+        :type ngrams: tuple
+        :param contour: size of the contour n-grams, 0 for none
+        :type contour: int
+        :param rhythm: add the interval / duration ratio tokens
+        :type rhythm: bool
+        :param width: number of slots of a vector
+        :type width: int
+        :param max_ratio: largest log2 duration ratio told apart
+        :type max_ratio: int
+        """
+        if width < 1:
+            raise ValueError("width must be at least 1")
+        self.ngrams = tuple(ngrams)
+        self.contour = contour
+        self.rhythm = rhythm
+        self.width = width
+        self.max_ratio = max_ratio
+
+    def _ratio(self, first, second):
+        # grace notes have no length, they get a ratio of their own
+        if first <= 0 or second <= 0:
+            return "g"
+        ratio = int(round(math.log2(second / first)))
+        return max(-self.max_ratio, min(self.max_ratio, ratio))
+
+    def tokens(self, features):
+        """yield every token of a work, see the top of this file.
+
+        :param features: features of the work, see extractFeatures. Works extracted before
+        durations were recorded get no rhythm tokens
+        :type features: dict
+        """
+        intervals = features["intervals"]
+        durations = features.get("durations") if self.rhythm else None
+        # durations belong to the pitches, interval i joins pitches i and i + 1
+        if durations is not None and len(durations) != len(intervals) + 1:
+            durations = None
+        contour = []
+        for i, interval in enumerate(intervals):
+            for n in self.ngrams:
+                if i + 1 >= n:
+                    yield ("i",) + tuple(intervals[i + 1 - n:i + 1])
+            if durations is not None:
+                yield ("r", interval, self._ratio(durations[i], durations[i + 1]))
+            if self.contour:
+                contour.append(_contour(interval))
+                if len(contour) > self.contour:
+                    del contour[0]
+                if len(contour) == self.contour:
+                    yield ("c",) + tuple(contour)
+
+    def sparse(self, features):
+        """hashed token counts of a work as a sparse vector (slot -> count).
+
+        :param features: features of the work, see extractFeatures
+        :type features: dict
+        :rtype: dict
+        """
+        vector = {}
+        width = self.width
+        for token in self.tokens(features):
+            slot = _tokenHash(token) % width
+            vector[slot] = vector.get(slot, 0) + 1
+        return vector
+
+    def vector(self, features):
+        """hashed token counts of a work as a dense vector of width slots.
+
+        :param features: features of the work, see extractFeatures
+        :type features: dict
+        :rtype: list
+        """
+        vector = [0] * self.width
+        for slot, count in self.sparse(features).items():
+            vector[slot] = count
+        return vector
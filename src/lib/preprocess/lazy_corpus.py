@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from operator import itemgetter
+
+"""
+This file contains a lazy corpus. Instead of lists holding every document of every
+representation, a LazyCorpus only keeps the file names, and the features of a work
+are loaded (from the feature cache, or by parsing the file) when the work is read.
+
+Each representation (intervals, measure words, interval vectors, word vectors, ...)
+is a CorpusView over the same corpus: a function applied to the features of a work
+as it is read. Views behave like read only lists (len(), indexing and iteration), so
+they can be handed to the rankers and the sequence similarity functions in place
+of the materialized corpora, and iterating over one holds a single work at a time.
+
+usage:
+
+    corpus = LazyCorpus(files, partial(loadFeatures, cache=FEATURE_CACHE))
+    intervals = corpus.view(itemgetter("intervals"))
+    vectors = corpus.view(partial(intervalToVector, ...))
+    # one pass over the works feeds any number of statistics
+    corpus.scan(lambda features: counter.add(...), ...)
+"""
+
+class CorpusView(object):
+    """one representation of every work of a LazyCorpus, computed when it is read."""
+
+    def __init__(self, corpus, transform):
+        """
+        :param corpus: corpus the view reads from
+        :type corpus: LazyCorpus
+        :param transform: function from the features of a work to its representation
+        :type transform: callable
+        """
+        self.corpus = corpus
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __getitem__(self, i):
+        return self.transform(self.corpus[i])
+
+    def __iter__(self):
+        for features in self.corpus:
+            yield self.transform(features)
+
+
+class LazyCorpus(object):
+
+    def __init__(self, files, load):
+        """
+        :param files: file of every work, in corpus order
+        :type files: list
+        :param load: function from a file to the features of the work (see loadFeatures)
+        :type load: callable
+        """
+        self.files = list(files)
+        self.load = load
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        return self.load(self.files[i])
+
+    def __iter__(self):
+        for file in self.files:
+            yield self.load(file)
+
+    def view(self, transform):
+        """a representation of the works, see CorpusView.
+
+        :param transform: function from the features of a work to its representation
+        :type transform: callable
+        :rtype: CorpusView
+        """
+        return CorpusView(self, transform)
+
+    def intervals(self):
+        return self.view(itemgetter("intervals"))
+
+    def words(self):
+        return self.view(itemgetter("words"))
+
+    def scan(self, *consumers):
+        """read every work once and hand its features to each consumer, so several
+        aggregate statistics (doc freq, avdl, vocabulary, ...) come out of a single
+        streaming pass.
+
+        :param consumers: functions called with the features of every work, in corpus order
+        :type consumers: callable
+        """
+        for features in self:
+            for consume in consumers:
+                consume(features)
@@ -153,3 +153,28 @@ def buildFileList(filePath):
         result[defendant_dict["song"]]["litigation"] = complaintant_dict
 
     return result
+
+def buildCounterparts(filePath):
+    """map every song file to the set of files it was litigated against. Unlike
+    parseData and buildFileList nothing is keyed by artist or title here, so works
+    involved in several cases (or sharing a title) keep all of their counterparts.
+
+    :param filePath: path to the case data
+    :type filePath: str
+    :return: file name -> set of file names
+    :rtype: defaultdict
+    """
+    result = defaultdict(set)
+
+    tree = ET.parse(filePath)
+    root = tree.getroot()
+
+    cases = root.findall("./case")
+    for case in cases:
+        complaintant_dict = parseCase(case.find("./cwork"))
+        defendant_dict = parseCase(case.find("./dwork"))
+
+        result[complaintant_dict["file"]].add(defendant_dict["file"])
+        result[defendant_dict["file"]].add(complaintant_dict["file"])
+
+    return result
@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import zipfile
+from collections import deque
+from fractions import Fraction
+from xml.etree.ElementTree import iterparse, fromstring
+
+"""
+This file contains light readers for the score formats of the dataset. Building a
+music21 stream is the slowest part of the pipeline, and all the feature extractors
+need from a score is, for every part, the notes of every measure:
+
+    [(measure number, [(diatonic note numbers, length in quarter notes), ...]), ...]
+
+readMusicXML reads that straight off the <measure> and <note> elements with a
+streaming xml parser, and readMidi off the note on / note off events of every track.
+A compressed MusicXML file (.mxl) is a zip archive whose META-INF/container.xml names
+the score inside it, openArchive streams that score out of the archive in memory so
+it is read like any other MusicXML file without being unzipped to disk.
+They reproduce what music21 makes of the same file (which parts a multi staff part is
+split into, the order of voices and chords, durations taken from the note type, how
+notes are grouped into chords and quantized, ...), see check_reader_parity.py.
+
+A construct the readers do not reproduce exactly (grace notes, chord symbols, midi
+notes that need voices of their own, ...) raises UnsupportedScore, and the caller
+parses the file with music21 instead (see extractFile).
+
+usage:
+
+    try:
+        parts = readScore("light_myLife.xml")
+    except UnsupportedScore:
+        ...
+"""
+
+# diatonic note number of step in octave 0, as music21 counts them (C0 is 1)
+STEPS = {"C": 1, "D": 2, "E": 3, "F": 4, "G": 5, "A": 6, "B": 7}
+
+# length in quarter notes of every musicxml note type
+TYPES = {
+    "maxima": Fraction(32), "long": Fraction(16), "breve": Fraction(8), "whole": Fraction(4),
+    "half": Fraction(2), "quarter": Fraction(1), "eighth": Fraction(1, 2), "16th": Fraction(1, 4),
+    "32nd": Fraction(1, 8), "64th": Fraction(1, 16), "128th": Fraction(1, 32), "256th": Fraction(1, 64),
+    "512th": Fraction(1, 128), "1024th": Fraction(1, 256)
+}
+
+# music21 starts counting divisions from this before a part sets its own
+DEFAULT_DIVISIONS = Fraction(10080)
+
+# elements holding pitches in a form the readers do not reproduce
+UNSUPPORTED_NOTES = ("grace", "cue", "unpitched")
+
+# diatonic step of every pitch class, music21 spells midi notes C C# D E- E F F# G G# A B- B
+MIDI_STEPS = (1, 1, 2, 3, 3, 4, 4, 5, 5, 6, 7, 7)
+
+# music21 snaps midi offsets and durations to sixteenths or eighth triplets
+QUANTIZE_DIVISORS = (4, 3)
+# largest denominator of the fractions music21 keeps offsets and lengths in
+DENOMINATOR_LIMIT = 65535
+
+# meta events music21 knows, any other stops it reading the track
+META_EVENTS = set([0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x20, 0x21, 0x2F, 0x51, 0x54, 0x58, 0x59, 0x7F])
+TIME_SIGNATURE = 0x58
+# meta events music21 turns into objects of the part (the names and program changes
+# become instruments), they count towards the length of the part
+PART_EVENTS = set([0x03, 0x04, 0x51, 0x58, 0x59])
+# meta events of the tracks without notes copied into every part
+CONDUCTOR_EVENTS = set([0x51, 0x58, 0x59])
+PROGRAM_CHANGE = 0xC0
+
+# manifest of a compressed MusicXML archive, its first MusicXML rootfile is the score
+CONTAINER = "META-INF/container.xml"
+# media types of a MusicXML rootfile. a rootfile without one is MusicXML as well
+MUSICXML_TYPES = ("application/vnd.recordare.musicxml+xml", "application/vnd.recordare.musicxml")
+
+
+class UnsupportedScore(Exception):
+    pass
+
+class ArchiveError(ValueError):
+    # a compressed MusicXML archive whose manifest names no score
+    pass
+
+
+def _text(element, tag):
+    child = element.find(tag)
+    if child is None or child.text is None or not child.text.strip():
+        return None
+    return child.text.strip()
+
+def _staff(element):
+    # staff of a note, harmony, forward or direction, 0 for none
+    staff = _text(element, "staff")
+    return int(staff) if staff is not None else 0
+
+def _measureNumber(raw, last):
+    # leading digits of the number attribute, music21 turns Finale's unnumbered
+    # measures X1, X2, ... into the number of the measure before them
+    if raw is None:
+        return 0
+    digits = "".join([char for char in raw if char.isdigit()])
+    suffix = "".join([char for char in raw if not char.isdigit()])
+    number = int(digits) if digits else 0
+    if suffix == "X" and number != last + 1:
+        number = last
+    return number
+
+def _pitch(note):
+    pitch = note.find("pitch")
+    step = _text(pitch, "step")
+    octave = _text(pitch, "octave")
+    if step not in STEPS or octave is None:
+        raise UnsupportedScore("note without a step or octave")
+    return int(octave) * 7 + STEPS[step]
+
+def _length(note, divisions):
+    # music21 takes the length of a typed note from its type, dots and tuplet, and only
+    # falls back to <duration> for untyped notes (mostly whole measure rests)
+    kind = _text(note, "type")
+    if kind is None:
+        duration = _text(note, "duration")
+        return Fraction(duration) / divisions if duration is not None else Fraction(0)
+    if kind not in TYPES:
+        raise UnsupportedScore("note type {}".format(kind))
+    dots = len(note.findall("dot"))
+    length = TYPES[kind] * (2 - Fraction(1, 2 ** dots))
+    modification = note.find("time-modification")
+    if modification is not None:
+        if modification.find("normal-type") is not None or modification.find("normal-dot") is not None:
+            raise UnsupportedScore("tuplet of a different note type")
+        length = length * int(_text(modification, "normal-notes")) / int(_text(modification, "actual-notes"))
+    return length
+
+
+class _Part(object):
+    """the measures of one <part> as they are read, split into staves at the end."""
+
+    def __init__(self):
+        self.divisions = DEFAULT_DIVISIONS
+        self.staves = 1
+        self.last_number = 0
+        self.measures = []
+        # staff numbers anything in the part was put on
+        self.staff_keys = set()
+
+    def addMeasure(self, measure):
+        number = _measureNumber(measure.get("number"), self.last_number)
+        self.last_number = number
+        voices = set([_text(note, "voice") for note in measure.findall("note")]) - set([None])
+        # music21 only splits a measure into voices when it has more than one
+        use_voices = len(voices) > 1
+        # (offset, order read, voice, staff, diatonic note numbers, length) of every note and chord
+        notes = []
+        offset = Fraction(0)
+        chord = []
+        elements = list(measure)
+        for i, element in enumerate(elements):
+            tag = element.tag
+            if tag == "note":
+                following = elements[i + 1] if i + 1 < len(elements) else None
+                next_in_chord = following is not None and following.tag == "note" and following.find("chord") is not None
+                if any(element.find(kind) is not None for kind in UNSUPPORTED_NOTES):
+                    raise UnsupportedScore("grace, cue or unpitched note")
+                if element.find("chord") is not None or next_in_chord:
+                    chord.append(element)
+                    if next_in_chord:
+                        continue
+                    if any(member.find("rest") is not None for member in chord):
+                        raise UnsupportedScore("rest in a chord")
+                    pitches = [_pitch(member) for member in chord]
+                    first = chord[0]
+                    voiced = [member for member in chord if member.find("voice") is not None]
+                    voice = _text(voiced[0] if voiced else element, "voice")
+                    chord = []
+                else:
+                    first = element
+                    voice = _text(element, "voice")
+                    pitches = None if element.find("rest") is not None else [_pitch(element)]
+                length = _length(first, self.divisions)
+                staff = _staff(first)
+                self.staff_keys.add(staff)
+                if pitches is not None:
+                    if use_voices and voice is None:
+                        raise UnsupportedScore("note without a voice in a measure with voices")
+                    notes.append((offset, len(notes), voice if use_voices else None, staff, pitches, length))
+                offset += length
+            elif tag == "backup" or tag == "forward":
+                duration = _text(element, "duration")
+                if duration is not None:
+                    change = Fraction(duration) / self.divisions
+                    offset += change if tag == "forward" else -change
+            elif tag == "attributes":
+                self.readAttributes(element)
+            elif tag == "direction":
+                self.staff_keys.add(_staff(element))
+            elif tag == "harmony":
+                raise UnsupportedScore("chord symbol")
+            elif tag == "print":
+                for layout in element.findall("staff-layout"):
+                    if layout.get("number") is not None:
+                        self.staff_keys.add(int(layout.get("number")))
+        self.measures.append((number, notes))
+
+    def readAttributes(self, attributes):
+        for element in attributes:
+            if element.tag == "divisions":
+                self.divisions = Fraction(element.text.strip())
+            elif element.tag == "staves":
+                self.staves = max(self.staves, int(element.text))
+            elif element.tag in ("clef", "key", "time", "staff-details"):
+                self.staff_keys.add(int(element.get("number", 0)))
+
+    def staffMeasures(self):
+        """the measures of every part music21 makes of this one: the part itself, or one
+        part per staff when it has several (notes without a staff go on every staff).
+
+        :rtype: list
+        """
+        if self.staves <= 1:
+            return [self._select(None)]
+        return [self._select(staff) for staff in sorted(self.staff_keys - set([0]))]
+
+    def _select(self, staff):
+        measures = []
+        for number, notes in self.measures:
+            if staff is not None:
+                notes = [note for note in notes if note[3] in (staff, 0)]
+            # voice by voice (music21 orders them by their name), each by offset then as read
+            notes = sorted(notes, key=lambda note: (note[2] or "", note[0], note[1]))
+            measures.append((number, [(note[4], float(note[5])) for note in notes]))
+        return measures
+
+
+def readMusicXML(source):
+    """read the notes of every part of a partwise MusicXML file, measure by measure.
+
+    :param source: path of the file, or a file object
+    :type source: str or file
+    :return: the measures of every part, [(number, [(diatonic note numbers, length), ...]), ...]
+    :rtype: list
+    """
+    parts = []
+    part = None
+    depth = 0
+    for event, element in iterparse(source, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1 and element.tag != "score-partwise":
+                raise UnsupportedScore("root element {}".format(element.tag))
+            if depth == 2 and element.tag == "part":
+                part = _Part()
+            continue
+        depth -= 1
+        if part is not None and depth == 2 and element.tag == "measure":
+            part.addMeasure(element)
+            # only the measure being read is held in memory
+            element.clear()
+        elif depth == 1 and element.tag == "part":
+            parts.extend(part.staffMeasures())
+            part = None
+            element.clear()
+    return parts
+
+
+def _opFrac(value):
+    # music21 keeps a float that is not a binary fraction as a Fraction
+    if value.as_integer_ratio()[1] > DENOMINATOR_LIMIT:
+        return Fraction(value).limit_denominator(DENOMINATOR_LIMIT)
+    return Fraction(value)
+
+def _nearestMultiple(value, unit):
+    # common.nearestMultiple, float for float, so ties round the same way
+    multiple = math.floor(value / unit)
+    low = unit * multiple
+    high = unit * (multiple + 1)
+    if low <= value <= low + unit / 2.0:
+        return round(value - low, 7), low
+    return round(high - value, 7), high
+
+def _quantize(value):
+    """the offset or length music21 snaps value (in quarter notes) to, see Stream.quantize.
+
+    :type value: Fraction
+    :rtype: Fraction
+    """
+    error, match = min([_nearestMultiple(float(value), 1 / divisor) for divisor in QUANTIZE_DIVISORS])
+    return _opFrac(match)
+
+def _variableLength(data, position):
+    number = 0
+    while position < len(data):
+        byte = data[position]
+        position += 1
+        number = (number << 7) + (byte & 0x7F)
+        if byte < 0x80:
+            break
+    return number, position
+
+def _trackEvents(data):
+    """(time in ticks, status, data 1, data 2, meta data) of every event of a track.
+    Channel messages have their status byte, meta events 0xFF and their type as data 1.
+
+    :param data: the bytes of the track, after its header
+    :type data: bytes
+    :rtype: list
+    """
+    events = []
+    time = 0
+    status = None
+    position = 0
+    while position < len(data):
+        delta, position = _variableLength(data, position)
+        time += delta
+        if len(data) - position < 2:
+            break
+        byte = data[position]
+        if byte >= 0x80:
+            status = byte
+            position += 1
+        elif status is None:
+            # music21 assumes a note on when a track starts with running status
+            status = 0x90
+        elif status >= 0xF0:
+            raise UnsupportedScore("running status after a meta or system event")
+        kind = status & 0xF0
+        if kind in (0xC0, 0xD0):
+            if data[position] > 127:
+                raise UnsupportedScore("program change or pressure out of range")
+            events.append((time, status, data[position], 0, None))
+            position += 1
+        elif kind < 0xF0:
+            events.append((time, status, data[position], data[position + 1] if position + 1 < len(data) else 0, None))
+            position += 2
+        elif status in (0xF0, 0xF7):
+            length, position = _variableLength(data, position)
+            position += length
+        elif status == 0xFF:
+            kind = data[position]
+            if kind not in META_EVENTS:
+                raise UnsupportedScore("unknown meta event {:02X}".format(kind))
+            length, position = _variableLength(data, position + 1)
+            events.append((time, status, kind, 0, data[position:position + length]))
+            position += length
+        else:
+            raise UnsupportedScore("unknown midi event {:02X}".format(status))
+    return events
+
+def _midiTracks(data):
+    # ticks per quarter note and the events of every track of a midi file
+    if data[:4] != b"MThd" or int.from_bytes(data[4:8], "big") != 6:
+        raise UnsupportedScore("not a midi file")
+    format_type = int.from_bytes(data[8:10], "big")
+    count = int.from_bytes(data[10:12], "big")
+    division = int.from_bytes(data[12:14], "big")
+    if format_type not in (0, 1) or division & 0x8000 or division == 0:
+        raise UnsupportedScore("midi format {} with division {}".format(format_type, division))
+    tracks = []
+    position = 14
+    for _ in range(count):
+        if data[position:position + 4] != b"MTrk":
+            raise UnsupportedScore("badly formed midi track")
+        length = int.from_bytes(data[position + 4:position + 8], "big")
+        tracks.append(_trackEvents(data[position + 8:position + 8 + length]))
+        position += 8 + length
+    return division, tracks
+
+def _isNoteOn(event):
+    return event[1] & 0xF0 == 0x90 and event[3] != 0
+
+def _isNoteOff(event):
+    return event[1] & 0xF0 == 0x80 or (event[1] & 0xF0 == 0x90 and event[3] == 0)
+
+def _notePairs(events):
+    # (on time, off time, pitch) of every note on matched with the first free note off
+    # of its pitch and channel after it, in the order of the note ons
+    pairs = []
+    pending = {}
+    for event in events:
+        key = (event[1] & 0x0F, event[2])
+        if _isNoteOn(event):
+            pair = [event[0], None, event[2]]
+            pairs.append(pair)
+            pending.setdefault(key, deque()).append(pair)
+        elif _isNoteOff(event) and pending.get(key):
+            pending[key].popleft()[1] = event[0]
+    return [pair for pair in pairs if pair[1] is not None]
+
+def _metaTimes(events, kinds, programs=False):
+    # times of the meta events of the given kinds (and of the program changes)
+    return [event[0] for event in events
+            if (event[1] == 0xFF and event[2] in kinds) or (programs and event[1] & 0xF0 == PROGRAM_CHANGE)]
+
+def _timeSignatures(events, division):
+    # (offset, length of a bar) of every time signature of a track
+    signatures = []
+    for event in events:
+        if event[1] == 0xFF and event[2] == TIME_SIGNATURE:
+            if len(event[4]) < 2 or event[4][0] == 0:
+                raise UnsupportedScore("empty time signature")
+            signatures.append((_quantize(_opFrac(event[0] / division)), Fraction(4 * event[4][0], 2 ** event[4][1])))
+    return signatures
+
+def _midiChords(pairs, division):
+    """the notes and chords music21 makes of the note pairs of a track, as
+    (offset, grace, order, diatonic note numbers, length), quantized.
+
+    :rtype: list
+    """
+    tolerance = division / 16
+    chords = []
+    gathered = set()
+    for i, (on, off, pitch) in enumerate(pairs):
+        if i in gathered:
+            continue
+        members = [i]
+        # notes starting together (within a 64th) make a chord when they also end together,
+        # otherwise music21 moves them into voices of their own
+        for j in range(i + 1, len(pairs)):
+            if abs(pairs[j][0] - on) > tolerance:
+                break
+            if abs(pairs[j][1] - off) > tolerance:
+                raise UnsupportedScore("notes that need voices")
+            members.append(j)
+        if len(members) > 1:
+            gathered.update(members)
+        # a chord lasts from the start of its last note to the end of its first
+        ticks = off - pairs[members[-1]][0]
+        if ticks < 0:
+            raise UnsupportedScore("chord ending before it starts")
+        grace = ticks == 0
+        length = Fraction(0) if grace else _quantize(_opFrac(float(ticks) / division))
+        if length == 0 and not grace:
+            length = Fraction(1, max(QUANTIZE_DIVISORS))
+        pitches = [(pairs[j][2] // 12 - 1) * 7 + MIDI_STEPS[pairs[j][2] % 12] for j in members]
+        chords.append((_quantize(_opFrac(on / division)), not grace, len(chords), pitches, length))
+    return chords
+
+def _midiMeasures(chords, signatures, end):
+    """the notes sounding in every measure music21 makes of a midi part (see
+    makeMeasures and makeTies): bars follow the time signature in effect where they start,
+    4/4 before the first one, up to the end of the part. A note held over a barline
+    sounds in both measures.
+
+    :return: the measures, and the number of the measure every chord starts in
+    :rtype: tuple
+    """
+    signatures = sorted(signatures, key=lambda signature: signature[0])
+    if not signatures or signatures[0][0] > 0:
+        signatures.insert(0, (Fraction(0), Fraction(4)))
+    bars = []
+    start = Fraction(0)
+    while True:
+        length = [bar for offset, bar in signatures if offset <= start][-1]
+        bars.append((start, start + length))
+        start += length
+        if start >= end:
+            break
+    measures = [[] for _ in bars]
+    starts = []
+    for chord in chords:
+        offset, length = chord[0], chord[4]
+        first = next((i for i, (low, high) in enumerate(bars) if low <= offset < high), None)
+        # a grace note right at the end of the part is kept after the last measure,
+        # it counts as part of the last one
+        if first is None:
+            starts.append(len(bars))
+            continue
+        starts.append(first + 1)
+        for i in range(first, len(bars)):
+            if i > first and bars[i][0] >= offset + length:
+                break
+            measures[i].append((chord[3], float(length)))
+    return [(i + 1, notes) for i, notes in enumerate(measures)], starts
+
+def readMidi(source):
+    """read the notes of every track of a midi file with notes, as music21 quantizes
+    and groups them, and the notes of the measures music21 would make of them.
+
+    :param source: path of the file, or a file object
+    :type source: str or file
+    :return: (measures, notes) of every part, see readScore
+    :rtype: list
+    """
+    if hasattr(source, "read"):
+        data = source.read()
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+    division, tracks = _midiTracks(data)
+    conductor = [event for events in tracks if not any(_isNoteOn(event) for event in events) for event in events]
+    conductor_times = [_quantize(_opFrac(time / division)) for time in _metaTimes(conductor, CONDUCTOR_EVENTS)]
+    conductor_signatures = _timeSignatures(conductor, division)
+    parts = []
+    for events in tracks:
+        if not any(_isNoteOn(event) for event in events):
+            continue
+        chords = _midiChords(_notePairs(events), division)
+        times = [_quantize(_opFrac(time / division)) for time in _metaTimes(events, PART_EVENTS, programs=True)]
+        # the measures reach to the end of the last note or object of the part
+        end = max([chord[0] + chord[4] for chord in chords] + times + conductor_times + [Fraction(0)])
+        # the time signatures of the track itself come first, so the conductor's win a tie
+        measures, starts = _midiMeasures(chords, _timeSignatures(events, division) + conductor_signatures, end)
+        order = sorted(range(len(chords)), key=lambda i: chords[i][:3])
+        parts.append((measures, [(chords[i][3], float(chords[i][4]), starts[i]) for i in order]))
+    return parts
+
+
+def rootFile(archive):
+    """name of the score in a compressed MusicXML archive, read from its manifest.
+
+    :param archive: the open archive
+    :type archive: zipfile.ZipFile
+    :rtype: str
+    """
+    try:
+        container = fromstring(archive.read(CONTAINER))
+    except KeyError:
+        raise ArchiveError("{} has no {}".format(archive.filename, CONTAINER))
+    for rootfile in container.iter("rootfile"):
+        if rootfile.get("full-path") and rootfile.get("media-type", MUSICXML_TYPES[0]) in MUSICXML_TYPES:
+            return rootfile.get("full-path")
+    raise ArchiveError("{} names no MusicXML score".format(archive.filename))
+
+def openArchive(source):
+    """open the score of a compressed MusicXML (.mxl) archive. It is decompressed as
+    it is read, nothing is written to disk.
+
+    :param source: path of the archive, or a file object
+    :type source: str or file
+    :return: binary file object of the score, close it when done
+    :rtype: file
+    """
+    # the member keeps the archive readable until it is closed itself
+    with zipfile.ZipFile(source) as archive:
+        return archive.open(rootFile(archive))
+
+def isArchive(path):
+    return os.path.splitext(path)[1].lower() == ".mxl"
+
+def readScore(path):
+    """read a score with the reader for its format.
+
+    :param path: path of a MusicXML, compressed MusicXML or midi file
+    :type path: str
+    :return: the parts of the score as (measures, notes) pairs. notes is None when the
+    notes of the part are those of its measures, and the notes in order, each with the
+    number of the measure it starts in, when the measures had to be made (midi files)
+    and split some of them
+    :rtype: list
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".xml", ".musicxml"):
+        return [(measures, None) for measures in readMusicXML(path)]
+    if isArchive(path):
+        with openArchive(path) as score:
+            return [(measures, None) for measures in readMusicXML(score)]
+    if extension in (".mid", ".midi"):
+        return readMidi(path)
+    raise UnsupportedScore("no reader for {} files".format(extension))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import Counter
+
+"""
+This file contains the vocabulary used for the "vertical" analysis, where each
+measure word (see parseMeasures) is a term. Every word gets an integer id in the
+order it is first seen, and documents are turned into sparse vectors that map
+term id -> count, so the cost of a document is the number of distinct words in
+it rather than the size of the whole vocabulary.
+"""
+
+class Vocabulary(object):
+
+    def __init__(self, documents=None):
+        """
+        :param documents: optional tokenized documents to build the vocabulary from
+        :type documents: list
+        """
+        self.ids = {}
+        self.words = []
+        if documents is not None:
+            for doc in documents:
+                self.add(doc)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def __iter__(self):
+        # words in id order, so a Vocabulary can be used anywhere the old vocab Counter was
+        return iter(self.words)
+
+    def add(self, doc):
+        """add every new word of a document to the vocabulary.
+
+        :param doc: tokenized document
+        :type doc: list
+        """
+        for word in doc:
+            if word not in self.ids:
+                self.ids[word] = len(self.words)
+                self.words.append(word)
+
+    def termId(self, word):
+        """id of a word, or None if it is not in the vocabulary.
+
+        :rtype: int
+        """
+        return self.ids.get(word)
+
+    def toSparse(self, doc):
+        """convert a tokenized document to a sparse vector. Words that are not in
+        the vocabulary are dropped, just like they have no slot in a dense vector.
+
+        :param doc: tokenized document
+        :type doc: list
+        :return: term id -> count
+        :rtype: dict
+        """
+        vector = {}
+        for word, count in Counter(doc).items():
+            term = self.ids.get(word)
+            if term is not None:
+                vector[term] = count
+        return vector
+
+    def toDense(self, doc):
+        """convert a tokenized document to a dense vector with one slot per word
+        in the vocabulary, the same as docToVector.
+
+        :param doc: tokenized document
+        :type doc: list
+        :rtype: list
+        """
+        vector = [0] * len(self.words)
+        for term, count in self.toSparse(doc).items():
+            vector[term] = count
+        return vector
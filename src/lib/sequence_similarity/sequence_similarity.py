@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains fast versions of the string matching scores we compute between
+two works: the length of the longest common subsequence and the Levenshtein
+(edit) distance with unit costs. They give exactly the same numbers as
+Music21Helper.lcsDP and Music21Helper.levenshteinDistanceDP, which fill the full
+len(a) x len(b) table one cell at a time in python.
+
+The sequences can be interval lists (see streamToIntervals), measure words
+(see parseMeasures) or rows of the feature store, anything hashable works as a symbol.
+
+Two implementations are available:
+
+    bitparallel: Hyyro's bit-vector LCS and Myers' bit-vector edit distance. One column
+    of the DP table is packed into a python int, so each symbol of the second sequence
+    costs a handful of big integer operations instead of len(a) python steps.
+
+    diagonal: the DP table is filled one anti-diagonal at a time with numpy. Every cell
+    on an anti-diagonal only depends on the two previous anti-diagonals, so each one is
+    a few vectorized array operations. Used for large alphabets.
+
+Both accept an optional cutoff so that a comparison can stop as soon as the score can
+no longer beat a baseline:
+
+    lcsLength(a, b, min_score=s) returns None once the LCS can not end up above s
+    levenshteinDistance(a, b, max_distance=t) returns None once the distance is sure to
+    be above t. The diagonal version also restricts itself to the band |i - j| <= t
+
+When both scores are needed, lcsAndLevenshtein computes them in a single bit-parallel
+pass: the match masks of a are built once (and can be reused for many b with
+matchMasks), and each symbol of b is looked up once for both recurrences.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from lib.instrumentation.profiler import instrument
+
+# above this many distinct symbols "auto" switches to the numpy anti-diagonal version
+SMALL_ALPHABET = 256
+# how many columns the bit-parallel versions process between cutoff checks
+CHECK_EVERY = 16
+
+
+def _popcount(x):
+    return bin(x).count("1")
+
+def _matchMasks(a):
+    # bit i of peq[symbol] is set when a[i] == symbol
+    peq = {}
+    for i, symbol in enumerate(a):
+        peq[symbol] = peq.get(symbol, 0) | (1 << i)
+    return peq
+
+def _pickMethod(a, b, method):
+    if method != "auto":
+        return method
+    if np is not None and len(set(a)) > SMALL_ALPHABET:
+        return "diagonal"
+    return "bitparallel"
+
+def _asList(sequence):
+    # memory mapped rows from the feature store come in as numpy arrays,
+    # plain python ints hash and compare much faster
+    if hasattr(sequence, "tolist"):
+        return sequence.tolist()
+    return list(sequence)
+
+def _orient(a, b):
+    # both scores are symmetric. pack the longer sequence into the bit vector and
+    # loop over the shorter one, fewer python iterations for the same total work
+    if len(a) < len(b):
+        return b, a
+    return a, b
+
+
+@instrument("lcs")
+def lcsLength(a, b, min_score=None, method="auto"):
+    """length of the longest common subsequence of two sequences.
+
+    :param a: first sequence
+    :type a: list
+    :param b: second sequence
+    :type b: list
+    :param min_score: optional baseline. once the LCS can not end up greater than
+    min_score the computation stops and None is returned
+    :type min_score: int
+    :param method: 'auto', 'bitparallel' or 'diagonal'
+    :type method: str
+    :return: LCS length, or None if it is certain to be <= min_score
+    :rtype: int or None
+    """
+    a, b = _orient(_asList(a), _asList(b))
+    if min_score is not None and min(len(a), len(b)) <= min_score:
+        return None
+    if not a or not b:
+        return 0
+    method = _pickMethod(a, b, method)
+    if method == "bitparallel":
+        return _lcsBitParallel(a, b, min_score)
+    if method == "diagonal":
+        return _lcsDiagonal(a, b, min_score)
+    raise ValueError("Unknown method {0}".format(method))
+
+@instrument("levenshtein")
+def levenshteinDistance(a, b, max_distance=None, method="auto"):
+    """Levenshtein distance (unit cost insert, delete and substitute) between two sequences.
+
+    :param a: first sequence
+    :type a: list
+    :param b: second sequence
+    :type b: list
+    :param max_distance: optional baseline. once the distance is certain to be greater
+    than max_distance the computation stops and None is returned
+    :type max_distance: int
+    :param method: 'auto', 'bitparallel' or 'diagonal'
+    :type method: str
+    :return: edit distance, or None if it is certain to be > max_distance
+    :rtype: int or None
+    """
+    a, b = _orient(_asList(a), _asList(b))
+    # the distance is at least the difference in length
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return None
+    if not b:
+        return len(a)
+    method = _pickMethod(a, b, method)
+    if method == "bitparallel":
+        return _levenshteinBitParallel(a, b, max_distance)
+    if method == "diagonal":
+        return _levenshteinDiagonal(a, b, max_distance)
+    raise ValueError("Unknown method {0}".format(method))
+
+
+def matchMasks(a):
+    """bit masks of where every symbol occurs in a sequence, see lcsAndLevenshtein.
+
+    :param a: sequence
+    :type a: list
+    :rtype: dict
+    """
+    return _matchMasks(_asList(a))
+
+@instrument("lcsAndLevenshtein")
+def lcsAndLevenshtein(a, b, masks=None):
+    """length of the longest common subsequence and Levenshtein distance of two
+    sequences in one pass over b, equal to lcsLength(a, b) and levenshteinDistance(a, b).
+
+    :param a: first sequence
+    :type a: list
+    :param b: second sequence
+    :type b: list
+    :param masks: matchMasks(a), to compare a with many sequences without packing it again
+    :type masks: dict
+    :return: (LCS length, edit distance)
+    :rtype: tuple
+    """
+    a = _asList(a)
+    b = _asList(b)
+    if not a or not b:
+        return 0, max(len(a), len(b))
+    m = len(a)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    peq = masks if masks is not None else _matchMasks(a)
+    # LCS state, see _lcsBitParallel
+    V = mask
+    # edit distance state, see _levenshteinBitParallel
+    Pv = mask
+    Mv = 0
+    score = m
+    for symbol in b:
+        Eq = peq.get(symbol, 0)
+        U = V & Eq
+        V = ((V + U) | (V - U)) & mask
+        Xv = Eq | Mv
+        Xh = ((((Eq & Pv) + Pv) & mask) ^ Pv) | Eq
+        Ph = (Mv | ~(Xh | Pv)) & mask
+        Mh = Pv & Xh
+        if Ph & high:
+            score += 1
+        elif Mh & high:
+            score -= 1
+        Ph = ((Ph << 1) | 1) & mask
+        Mh = (Mh << 1) & mask
+        Pv = (Mh | ~(Xv | Ph)) & mask
+        Mv = Ph & Xv
+    return m - _popcount(V), score
+
+
+def _lcsBitParallel(a, b, min_score):
+    m = len(a)
+    n = len(b)
+    mask = (1 << m) - 1
+    peq = _matchMasks(a)
+    # zero bits of V mark the rows where the LCS of a[:i] and b[:j] steps up
+    V = mask
+    for j, symbol in enumerate(b):
+        U = V & peq.get(symbol, 0)
+        V = ((V + U) | (V - U)) & mask
+        if min_score is not None and j % CHECK_EVERY == 0:
+            # every remaining symbol of b can add at most one to the LCS
+            if m - _popcount(V) + (n - j - 1) <= min_score:
+                return None
+    score = m - _popcount(V)
+    if min_score is not None and score <= min_score:
+        return None
+    return score
+
+def _levenshteinBitParallel(a, b, max_distance):
+    m = len(a)
+    n = len(b)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    peq = _matchMasks(a)
+    # vertical deltas of the current column, +1 (Pv) and -1 (Mv)
+    Pv = mask
+    Mv = 0
+    score = m
+    for j, symbol in enumerate(b):
+        Eq = peq.get(symbol, 0)
+        Xv = Eq | Mv
+        Xh = ((((Eq & Pv) + Pv) & mask) ^ Pv) | Eq
+        # horizontal deltas
+        Ph = (Mv | ~(Xh | Pv)) & mask
+        Mh = Pv & Xh
+        # the last row holds the distance between a and b[:j + 1]
+        if Ph & high:
+            score += 1
+        elif Mh & high:
+            score -= 1
+        # row 0 of the table increases by one per column
+        Ph = ((Ph << 1) | 1) & mask
+        Mh = (Mh << 1) & mask
+        Pv = (Mh | ~(Xv | Ph)) & mask
+        Mv = Ph & Xv
+        if max_distance is not None and j % CHECK_EVERY == 0:
+            # the last row changes by at most one per remaining column
+            if score - (n - j - 1) > max_distance:
+                return None
+    if max_distance is not None and score > max_distance:
+        return None
+    return score
+
+
+def _symbolIds(a, b):
+    # numpy needs numbers, map every distinct symbol to an int
+    ids = {}
+    a_ids = np.array([ids.setdefault(symbol, len(ids)) for symbol in a], dtype=np.int64)
+    b_ids = np.array([ids.setdefault(symbol, len(ids)) for symbol in b], dtype=np.int64)
+    return a_ids, b_ids
+
+def _lcsDiagonal(a, b, min_score):
+    m = len(a)
+    n = len(b)
+    a_ids, b_ids = _symbolIds(a, b)
+    b_rev = b_ids[::-1]
+    rows = np.arange(m + 1)
+    # each diagonal is stored by row index i, the column is j = d - i.
+    # cells outside the table and the first row/column are 0
+    prev2 = np.zeros(m + 1, dtype=np.int64)
+    prev1 = np.zeros(m + 1, dtype=np.int64)
+    cur = np.zeros(m + 1, dtype=np.int64)
+    for d in range(2, m + n + 1):
+        lo = max(1, d - n)
+        hi = min(m, d - 1)
+        cur[:] = 0
+        # a[i - 1] == b[d - i - 1] for i in lo..hi, b reversed makes that a slice
+        match = a_ids[lo - 1:hi] == b_rev[n - d + lo:n - d + hi + 1]
+        cur[lo:hi + 1] = np.where(match, prev2[lo - 1:hi] + 1, np.maximum(prev1[lo - 1:hi], prev1[lo:hi + 1]))
+        if min_score is not None and d % CHECK_EVERY == 0:
+            # best case every cell keeps matching until one of the sequences runs out
+            i = rows[lo:hi + 1]
+            if int(np.max(cur[lo:hi + 1] + np.minimum(m - i, n - (d - i)))) <= min_score:
+                return None
+        prev2, prev1, cur = prev1, cur, prev2
+    score = int(prev1[m])
+    if min_score is not None and score <= min_score:
+        return None
+    return score
+
+def _levenshteinDiagonal(a, b, max_distance):
+    m = len(a)
+    n = len(b)
+    a_ids, b_ids = _symbolIds(a, b)
+    b_rev = b_ids[::-1]
+    # anything outside the band counts as unreachable
+    far = m + n + 1
+    band = far if max_distance is None else max_distance
+    prev2 = np.full(m + 1, far, dtype=np.int64)
+    prev1 = np.full(m + 1, far, dtype=np.int64)
+    cur = np.full(m + 1, far, dtype=np.int64)
+    # diagonal 0 is the cell (0, 0), diagonal 1 the cells (0, 1) and (1, 0)
+    prev2[0] = 0
+    prev1[0] = 1
+    prev1[1] = 1
+    for d in range(2, m + n + 1):
+        # interior cells of this diagonal, restricted to |i - j| = |2i - d| <= band
+        lo = max(1, d - n, (d - band + 1) // 2)
+        hi = min(m, d - 1, (d + band) // 2)
+        cur[:] = far
+        # first row and first column
+        if d <= n and d <= band:
+            cur[0] = d
+        if d <= m and d <= band:
+            cur[d] = d
+        if lo <= hi:
+            mismatch = a_ids[lo - 1:hi] != b_rev[n - d + lo:n - d + hi + 1]
+            cur[lo:hi + 1] = np.minimum(
+                np.minimum(prev1[lo - 1:hi], prev1[lo:hi + 1]) + 1,
+                prev2[lo - 1:hi] + mismatch
+            )
+        if max_distance is not None:
+            # costs never go down along an alignment, and every alignment touches
+            # this diagonal or the one before it
+            if min(int(cur.min()), int(prev1.min())) > max_distance:
+                return None
+        prev2, prev1, cur = prev1, cur, prev2
+    score = int(prev1[m])
+    if max_distance is not None and score > max_distance:
+        return None
+    return score
@@ -9,241 +9,319 @@ from copy import copy
 import random
 from collections import defaultdict, Counter
 
-from music21.converter import Converter, parse
-
-from vector_helpers import streamToIntervals, intervalToVector, buildCorpus, parseMeasures, docToVector
+from vector_helpers import intervalToVector, buildLazyCorpora, loadFeatures, FEATURE_CACHE
 
 # import ranking classes
-from lib.midi_levenshtein_lcs.modules.composition_lcs_score import LCS
-from lib.midi_levenshtein_lcs.modules.composition_levenshtein_score import Levenshtein
-from lib.midi_levenshtein_lcs.lib.helpers import Music21Helper
 from lib.music_ranker.music_ranker import MusicRanker
+from lib.sequence_similarity.sequence_similarity import lcsLength, levenshteinDistance
+from lib.music_ranker.screening import ScoreBound, screenLCS, screenLevenshtein, screenScore
 
 # import logic to parse the case dataset
-from lib.preprocess.parse_cases import parseData, buildFileList
+from lib.preprocess.parse_cases import parseData
+from lib.preprocess.vocabulary import Vocabulary
+
+from lib.instrumentation.profiler import PROFILER
 
-from constants import DATA_DIR, CASES_XML
+from constants import DATA_DIR, CASES_XML, WORKERS, PROFILE
 
 # either posix path or pycache was causing a weird issue
 # where works in each case were being interpretted as identical
-# by music21.converter.parse
-# Only solution I could come to that worked was to unzip all the
-# data to pure xml or midi files and move them to a new directory
-# which I called data_clean. At that point I was able to get results as expected.
-
-helper = Music21Helper()
-
-# build the dict of case pairings
-cases = parseData(CASES_XML)
-# build the dict of songs without pairing by case
-all_songs = buildFileList(CASES_XML)
-
-# optimize the size of the vectors
-# vector_min, vector_max = getMaxIntervals(cases)
-# returns -18,14
-# will use -20,20 for now, static to save time
-vector_min = -20
-vector_max = 20
-
-scores = []
-results = defaultdict(defaultdict)
-lcs_correct = 0
-lev_correct = 0
-bm25_correct = 0
-pln_correct = 0
-# driver code for "horizontal" analysis
-# convert music into vectors, pretty straight forward setup
-
-# build a vector corpus
-vector_corpus = buildCorpus(cases, vectors=True, vector_min=vector_min, vector_max=vector_max)
-
-# build the melody (interval) corpus so we can account for doc length
-interval_corpus = buildCorpus(cases)
-
-# instantiate a 'document ranker'
-ranker = MusicRanker(vector_corpus, b=0.75, k=1.2, reference_corpus=interval_corpus)
-
-keys = list(cases.keys())
-
-for key, case in cases.items():
-    # get the file name and type or the defendant and complaintant
-    c_file = case["complaintant"]["file"]
-    c_type = case["complaintant"]["fileType"]
-    d_file = case["defendant"]["file"]
-    d_type = case["defendant"]["fileType"]
-
-    # get the complaintant as a list of intervals
-    complaintant = parse(DATA_DIR + "/" + c_file)
-    c_melody = streamToIntervals(complaintant)
-
-    # get the defendant as a list of intervals
-    defendant = parse(DATA_DIR + "/" + d_file)
-    d_melody = streamToIntervals(defendant)
-
-    # get the list of keys minus the current key
-    valid_keys = copy(keys)
-    valid_keys.remove(key)
-    # select an unrelated cases
-    random_case = random.choice(valid_keys)
-    # choose from comp or def
-    random_cd = random.choice(["complaintant", "defendant"])
-    # get the work and its melody
-    random_work = cases[random_case][random_cd]
-    random_file = random_work["file"]
-    random_work = parse(DATA_DIR + "/" + random_file)
-    random_melody = streamToIntervals(random_work)
-
-
-    # compute string matching similarities
-    lcs_score = helper.lcsDP(c_melody, d_melody)
-    lev_score = helper.levenshteinDistanceDP(c_melody, d_melody)
-    lcs_score_base = helper.lcsDP(c_melody, random_melody)
-    lev_score_base = helper.levenshteinDistanceDP(c_melody, random_melody)
-    # scores.append((lcs_score, lev_score))
-
-    # string matching results
-    results[key]["LCS"] = True if lcs_score > lcs_score_base else False
-    lcs_correct += 1 if lcs_score > lcs_score_base else 0
-    results[key]["Levenshtein"] = True if lev_score > lev_score_base else False
-    lev_correct += 1 if lev_score > lev_score_base else 0
-
-    # convert the interval list to a vector
-    c_vector = intervalToVector(c_melody, vector_min, vector_max)
-    d_vector = intervalToVector(d_melody, vector_min, vector_max)
-    random_vector = intervalToVector(random_melody, vector_min, vector_max)
-
-    # at this point we can use dot product, bm25, and pivoted length normalization with the vector representation
-    # will need to do a little more processing to use probabilistic models like JM smoothing and Dirichlet smoothing
-    
-    # text mining similarities
-    bm25_score = ranker.bm25(d_vector, c_vector)
-    bm25_score_base = ranker.bm25(random_vector, c_vector)
-    pln_score = ranker.pivoted_length_normalization(d_vector, c_vector)
-    pln_score_base = ranker.pivoted_length_normalization(random_vector, c_vector)
-
-    # text mining results
-    results[key]["BM25"] = True if bm25_score > bm25_score_base else False
-    bm25_correct += 1 if bm25_score > bm25_score_base else 0
-    results[key]["PLN"] = True if pln_score > pln_score_base else False
-    pln_correct += 1 if pln_score > pln_score_base else 0
-
-horizontal_statistics = defaultdict(defaultdict)
-horizontal_statistics["BM25"]["correct"] = bm25_correct / cases.__len__()
-horizontal_statistics["PLN"]["correct"] = pln_correct / cases.__len__()
-horizontal_statistics["LCS"]["correct"] = lcs_correct / cases.__len__()
-horizontal_statistics["Levenshtein"]["correct"] = lev_correct / cases.__len__()
-
-print("==========================")
-print("Horizontal results")
-print("==========================")
-print(horizontal_statistics)
-print("==========================")
-print("==========================")
-
-
-# driver code for "vertical" analysis
-# analyze groups of notes together. we will consider
-# the group of notes that occur in a measure to be a "word."
-# best approach is probably to get the notes, sort them, and
-# represent as intervals. not sure how to standardize.
-
-# build the 'vertical' corpus
-vertical_corpus = buildCorpus(cases, vertical=True)
-
-# at this point we have words, but we want to get vectors of c(w,d)
-# get a vocab so we know how to build each vector (one slot per word in the vocab)
-vocab = Counter()
-for doc in vertical_corpus:
-    vocab += Counter(doc)
-
-# declare a new var for the vectorized corpus
-vertical_corpus_vectors = []
-# for each work
-for doc in vertical_corpus:
-    vector = []
-    # for each word in the vocab
-    doc = Counter(doc)
-    for word in vocab:
-        vector.append(doc[word])
-    vertical_corpus_vectors.append(vector)
-
-# instantiate a 'document ranker' with the original corpus as a reference
-ranker = MusicRanker(vertical_corpus_vectors, b=0.75, k=1.2, reference_corpus=vertical_corpus)
-
-scores = []
-results = defaultdict(defaultdict)
-lcs_correct = 0
-lev_correct = 0
-bm25_correct = 0
-pln_correct = 0
-
-for key, case in cases.items():
-    # get the file name and type or the defendant and complaintant
-    c_file = case["complaintant"]["file"]
-    c_type = case["complaintant"]["fileType"]
-    d_file = case["defendant"]["file"]
-    d_type = case["defendant"]["fileType"]
-    
-    complaintant = parse(DATA_DIR + "/" + c_file)
-    defendant = parse(DATA_DIR + "/" + d_file)
-
-    # parse the works into measure words
-    c_words = parseMeasures(complaintant)
-    d_words = parseMeasures(defendant)
-
-    # get the list of keys minus the current key
-    valid_keys = copy(keys)
-    valid_keys.remove(key)
-    # select an unrelated cases
-    random_case = random.choice(valid_keys)
-    # choose from comp or def
-    random_cd = random.choice(["complaintant", "defendant"])
-    # get the work and its melody
-    random_work = cases[random_case][random_cd]
-    random_file = random_work["file"]
-    random_work = parse(DATA_DIR + "/" + random_file)
-    random_words = parseMeasures(random_work)
-
-    # score by string matching techniques
-    lcs_score = helper.lcsDP(c_words, d_words)
-    lev_score = helper.levenshteinDistanceDP(c_words, d_words)
-    lcs_score_base = helper.lcsDP(c_words, random_words)
-    lev_score_base = helper.levenshteinDistanceDP(c_words, random_words)
-
-    # get each work as a vector
-    c_vector = docToVector(c_words, vocab)
-    d_vector = docToVector(d_words, vocab)
-    random_vector = docToVector(random_words, vocab)
-
-    # vector text mining scores
-    bm25_score = ranker.bm25(d_vector, c_vector)
-    pln_score = ranker.pivoted_length_normalization(d_vector, c_vector)
-    bm25_score_base = ranker.bm25(c_vector, random_vector)
-    pln_score_base = ranker.pivoted_length_normalization(c_vector, random_vector)
-
-    # string matching results
-    results[key]["LCS"] = True if lcs_score > lcs_score_base else False
-    lcs_correct += 1 if lcs_score > lcs_score_base else 0
-    results[key]["Levenshtein"] = True if lev_score > lev_score_base else False
-    lev_correct += 1 if lev_score > lev_score_base else 0
-
-    # text mining results
-    results[key]["BM25"] = True if bm25_score > bm25_score_base else False
-    bm25_correct += 1 if bm25_score > bm25_score_base else 0
-    results[key]["PLN"] = True if pln_score > pln_score_base else False
-    pln_correct += 1 if pln_score > pln_score_base else 0
-
-    # scores.append((c_words, d_words))
-
-
-vertical_statistics = defaultdict(defaultdict)
-vertical_statistics["BM25"]["correct"] = bm25_correct / cases.__len__()
-vertical_statistics["PLN"]["correct"] = pln_correct / cases.__len__()
-vertical_statistics["LCS"]["correct"] = lcs_correct / cases.__len__()
-vertical_statistics["Levenshtein"]["correct"] = lev_correct / cases.__len__()
-
-print("Vertical results")
-print("==========================")
-print(vertical_statistics)
-print("==========================")
-print("==========================")
+# by music21.converter.parse, which is why the data used to be unzipped
+# to pure xml or midi files in a directory called data_clean.
+# The .mxl archives are now read in memory (see scorePath) and the features
+# are cached by the hash of the score inside them, never by path.
+
+def horizontalAnalysis(cases, corpora, vector_min=-20, vector_max=20, b=0.75, k=1.2, cache=FEATURE_CACHE, screen=False):
+    """score every case on the melody (intervals) of its works, against one
+    randomly drawn unrelated work as the baseline.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :param corpora: corpora of the cases (see buildCorpora or buildLazyCorpora)
+    :type corpora: dict
+    :param screen: decide every comparison with score bounds and early terminating
+    scorers (see lib/music_ranker/screening.py). The results are the same
+    :type screen: bool
+    :return: per case results and the fraction of correct cases per method
+    :rtype: tuple
+    """
+    results = defaultdict(defaultdict)
+    lcs_correct = 0
+    lev_correct = 0
+    bm25_correct = 0
+    pln_correct = 0
+    # driver code for "horizontal" analysis
+    # convert music into vectors, pretty straight forward setup
+
+    # the vector corpus
+    vector_corpus = corpora["vectors"]
+
+    # the melody (interval) corpus so we can account for doc length
+    interval_corpus = corpora["intervals"]
+
+    # instantiate a 'document ranker'. lazy corpora come with the doc freq and avdl
+    # computed in their streaming pass, so the ranker does not read the corpus again
+    ranker = MusicRanker(vector_corpus, b=b, k=k, reference_corpus=interval_corpus,
+                         engine=corpora.get("engines", {}).get("vectors"))
+    bound = ScoreBound(ranker)
+
+    keys = list(cases.keys())
+
+    for key, case in cases.items():
+        # get the file name and type or the defendant and complaintant
+        c_file = case["complaintant"]["file"]
+        c_type = case["complaintant"]["fileType"]
+        d_file = case["defendant"]["file"]
+        d_type = case["defendant"]["fileType"]
+
+        # get the complaintant as a list of intervals
+        c_melody = loadFeatures(c_file, cache=cache)["intervals"]
+
+        # get the defendant as a list of intervals
+        d_melody = loadFeatures(d_file, cache=cache)["intervals"]
+
+        # get the list of keys minus the current key
+        valid_keys = copy(keys)
+        valid_keys.remove(key)
+        # select an unrelated cases
+        random_case = random.choice(valid_keys)
+        # choose from comp or def
+        random_cd = random.choice(["complaintant", "defendant"])
+        # get the work and its melody
+        random_work = cases[random_case][random_cd]
+        random_file = random_work["file"]
+        random_melody = loadFeatures(random_file, cache=cache)["intervals"]
+
+
+        # convert the interval list to a vector
+        c_vector = intervalToVector(c_melody, vector_min, vector_max)
+        d_vector = intervalToVector(d_melody, vector_min, vector_max)
+        random_vector = intervalToVector(random_melody, vector_min, vector_max)
+
+        if screen:
+            lcs_pass = screenLCS((c_melody, d_melody), (c_melody, random_melody))
+            lev_pass = screenLevenshtein((c_melody, d_melody), (c_melody, random_melody))
+            bm25_pass = screenScore(ranker.bm25, bound.bm25, (d_vector, c_vector), (random_vector, c_vector))
+            pln_pass = screenScore(ranker.pivoted_length_normalization, bound.pln, (d_vector, c_vector), (random_vector, c_vector))
+        else:
+            # compute string matching similarities
+            lcs_score = lcsLength(c_melody, d_melody)
+            lev_score = levenshteinDistance(c_melody, d_melody)
+            lcs_score_base = lcsLength(c_melody, random_melody)
+            lev_score_base = levenshteinDistance(c_melody, random_melody)
+            lcs_pass = lcs_score > lcs_score_base
+            lev_pass = lev_score > lev_score_base
+
+            # at this point we can use dot product, bm25, and pivoted length normalization with the vector representation
+            # will need to do a little more processing to use probabilistic models like JM smoothing and Dirichlet smoothing
+
+            # text mining similarities
+            bm25_score = ranker.bm25(d_vector, c_vector)
+            bm25_score_base = ranker.bm25(random_vector, c_vector)
+            pln_score = ranker.pivoted_length_normalization(d_vector, c_vector)
+            pln_score_base = ranker.pivoted_length_normalization(random_vector, c_vector)
+            bm25_pass = bm25_score > bm25_score_base
+            pln_pass = pln_score > pln_score_base
+
+        # string matching results
+        results[key]["LCS"] = lcs_pass
+        lcs_correct += 1 if lcs_pass else 0
+        results[key]["Levenshtein"] = lev_pass
+        lev_correct += 1 if lev_pass else 0
+
+        # text mining results
+        results[key]["BM25"] = bm25_pass
+        bm25_correct += 1 if bm25_pass else 0
+        results[key]["PLN"] = pln_pass
+        pln_correct += 1 if pln_pass else 0
+
+    horizontal_statistics = defaultdict(defaultdict)
+    horizontal_statistics["BM25"]["correct"] = bm25_correct / cases.__len__()
+    horizontal_statistics["PLN"]["correct"] = pln_correct / cases.__len__()
+    horizontal_statistics["LCS"]["correct"] = lcs_correct / cases.__len__()
+    horizontal_statistics["Levenshtein"]["correct"] = lev_correct / cases.__len__()
+
+    return results, horizontal_statistics
+
+def verticalAnalysis(cases, corpora, b=0.75, k=1.2, cache=FEATURE_CACHE, screen=False):
+    """score every case on the measure words of its works, against one
+    randomly drawn unrelated work as the baseline.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :param corpora: corpora of the cases (see buildCorpora or buildLazyCorpora)
+    :type corpora: dict
+    :param screen: decide every comparison with score bounds and early terminating
+    scorers (see lib/music_ranker/screening.py). The results are the same
+    :type screen: bool
+    :return: per case results and the fraction of correct cases per method
+    :rtype: tuple
+    """
+    # driver code for "vertical" analysis
+    # analyze groups of notes together. we will consider
+    # the group of notes that occur in a measure to be a "word."
+    # best approach is probably to get the notes, sort them, and
+    # represent as intervals. not sure how to standardize.
+
+    # the 'vertical' corpus
+    vertical_corpus = corpora["words"]
+
+    if "vocab" in corpora:
+        # lazy corpora built the vocab and the word vector view in their streaming pass
+        vocab = corpora["vocab"]
+        vertical_corpus_vectors = corpora["word_vectors"]
+    else:
+        # at this point we have words, but we want to get vectors of c(w,d)
+        # get a vocab so every word has a term id
+        vocab = Vocabulary(vertical_corpus)
+
+        # sparse vectors (term id -> count) for the corpus. most works only use a small
+        # part of the vocabulary, so this is much smaller than one slot per word
+        vertical_corpus_vectors = [vocab.toSparse(doc) for doc in vertical_corpus]
+
+    # instantiate a 'document ranker' with the original corpus as a reference
+    ranker = MusicRanker(vertical_corpus_vectors, b=b, k=k, reference_corpus=vertical_corpus,
+                         engine=corpora.get("engines", {}).get("word_vectors"))
+    bound = ScoreBound(ranker)
+
+    results = defaultdict(defaultdict)
+    lcs_correct = 0
+    lev_correct = 0
+    bm25_correct = 0
+    pln_correct = 0
+
+    keys = list(cases.keys())
+
+    for key, case in cases.items():
+        # get the file name and type or the defendant and complaintant
+        c_file = case["complaintant"]["file"]
+        c_type = case["complaintant"]["fileType"]
+        d_file = case["defendant"]["file"]
+        d_type = case["defendant"]["fileType"]
+
+        # parse the works into measure words
+        c_words = loadFeatures(c_file, cache=cache)["words"]
+        d_words = loadFeatures(d_file, cache=cache)["words"]
+
+        # get the list of keys minus the current key
+        valid_keys = copy(keys)
+        valid_keys.remove(key)
+        # select an unrelated cases
+        random_case = random.choice(valid_keys)
+        # choose from comp or def
+        random_cd = random.choice(["complaintant", "defendant"])
+        # get the work and its melody
+        random_work = cases[random_case][random_cd]
+        random_file = random_work["file"]
+        random_words = loadFeatures(random_file, cache=cache)["words"]
+
+        # get each work as a vector
+        c_vector = vocab.toSparse(c_words)
+        d_vector = vocab.toSparse(d_words)
+        random_vector = vocab.toSparse(random_words)
+
+        if screen:
+            lcs_pass = screenLCS((c_words, d_words), (c_words, random_words))
+            lev_pass = screenLevenshtein((c_words, d_words), (c_words, random_words))
+            bm25_pass = screenScore(ranker.bm25, bound.bm25, (d_vector, c_vector), (c_vector, random_vector))
+            pln_pass = screenScore(ranker.pivoted_length_normalization, bound.pln, (d_vector, c_vector), (c_vector, random_vector))
+        else:
+            # score by string matching techniques
+            lcs_score = lcsLength(c_words, d_words)
+            lev_score = levenshteinDistance(c_words, d_words)
+            lcs_score_base = lcsLength(c_words, random_words)
+            lev_score_base = levenshteinDistance(c_words, random_words)
+            lcs_pass = lcs_score > lcs_score_base
+            lev_pass = lev_score > lev_score_base
+
+            # vector text mining scores
+            bm25_score = ranker.bm25(d_vector, c_vector)
+            pln_score = ranker.pivoted_length_normalization(d_vector, c_vector)
+            bm25_score_base = ranker.bm25(c_vector, random_vector)
+            pln_score_base = ranker.pivoted_length_normalization(c_vector, random_vector)
+            bm25_pass = bm25_score > bm25_score_base
+            pln_pass = pln_score > pln_score_base
+
+        # string matching results
+        results[key]["LCS"] = lcs_pass
+        lcs_correct += 1 if lcs_pass else 0
+        results[key]["Levenshtein"] = lev_pass
+        lev_correct += 1 if lev_pass else 0
+
+        # text mining results
+        results[key]["BM25"] = bm25_pass
+        bm25_correct += 1 if bm25_pass else 0
+        results[key]["PLN"] = pln_pass
+        pln_correct += 1 if pln_pass else 0
+
+    vertical_statistics = defaultdict(defaultdict)
+    vertical_statistics["BM25"]["correct"] = bm25_correct / cases.__len__()
+    vertical_statistics["PLN"]["correct"] = pln_correct / cases.__len__()
+    vertical_statistics["LCS"]["correct"] = lcs_correct / cases.__len__()
+    vertical_statistics["Levenshtein"]["correct"] = lev_correct / cases.__len__()
+
+    return results, vertical_statistics
+
+def main(vector_min=None, vector_max=None, b=0.75, k=1.2, workers=WORKERS, seed=None, cache=FEATURE_CACHE, screen=False):
+    """run the horizontal and vertical analysis over every case and print the results.
+
+    :param vector_min: smallest interval with a vector slot, None for the smallest interval of the corpus
+    :type vector_min: int
+    :param vector_max: largest interval with a vector slot, None for the largest interval of the corpus
+    :type vector_max: int
+    :param b: length normalization parameter of the rankers
+    :type b: float
+    :param k: term frequency saturation parameter of the rankers
+    :type k: float
+    :param workers: number of processes parsing the works (see extractCorpusFeatures)
+    :type workers: int
+    :param seed: optional seed for drawing the baseline works, for repeatable results
+    :type seed: int
+    :param cache: feature cache to use, or None to always parse
+    :type cache: FeatureCache
+    :param screen: decide the comparisons with score bounds and early terminating scorers,
+    which gives the same results with less work
+    :type screen: bool
+    :return: horizontal and vertical statistics
+    :rtype: tuple
+    """
+    if seed is not None:
+        random.seed(seed)
+
+    # build the dict of case pairings
+    cases = parseData(CASES_XML)
+
+    # parse the works missing from the cache once (in parallel). the corpora are views that
+    # read one work at a time from the cache, and the doc freq, avdl and vocabulary come out of
+    # a single streaming pass. the size of the vectors is optimized with the corpus statistics
+    # unless it is given
+    corpora = buildLazyCorpora(cases, vector_min=vector_min, vector_max=vector_max, workers=workers, cache=cache)
+    vector_min, vector_max = corpora["range"]
+
+    _, horizontal_statistics = horizontalAnalysis(cases, corpora, vector_min, vector_max, b, k, cache, screen)
+
+    print("==========================")
+    print("Horizontal results")
+    print("==========================")
+    print(horizontal_statistics)
+    print("==========================")
+    print("==========================")
+
+    _, vertical_statistics = verticalAnalysis(cases, corpora, b, k, cache, screen)
+
+    print("Vertical results")
+    print("==========================")
+    print(vertical_statistics)
+    print("==========================")
+    print("==========================")
+
+    return horizontal_statistics, vertical_statistics
+
+
+if __name__ == "__main__":
+    if PROFILE:
+        # the results are written when the run ends
+        PROFILER.profileTo(PROFILE)
+    main()
+    if PROFILE:
+        PROFILER.report()
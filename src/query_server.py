@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import base64
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from vector_helpers import buildCorpusManager, extractFile, FEATURE_CACHE, EXTRACTOR_VERSION
+from lib.preprocess.parse_cases import parseData
+from lib.preprocess.feature_cache import FeatureCache
+from lib.sequence_similarity.sequence_similarity import lcsLength, levenshteinDistance
+from lib.instrumentation.profiler import PROFILER
+
+from constants import CASES_XML, WORKERS
+
+"""
+A long running local query server for plagiarism screening. The corpus features and
+the ranker state (see CorpusManager) are loaded once at startup, after that a query
+only costs parsing the uploaded work (if any) and scoring it.
+
+The server speaks a minimal HTTP/1.1 over TCP or a unix socket:
+
+    POST /query     json body with either
+                        {"intervals": [2, -1, ...]}
+                    or an upload of a MusicXML / MIDI file
+                        {"filename": "song.mid", "data": "<base64 of the file>"}
+                    and optionally "count" (default 10) and "metric" to rank by
+                    ("bm25", "pln", "lcs" or "levenshtein", default "bm25")
+    GET /stats      number of requests served and latency percentiles
+    GET /health     "ok"
+
+The response lists the matches, best first, with every metric's score and the latency
+of the request split into parse (upload only), queue (waiting for its batch) and score.
+
+Uploads are parsed in a process pool so music21 never blocks the event loop. Queries
+waiting at the same time are scored as one batch: the bm25 and pln scores of the whole
+batch against the whole catalog are a single matrix product with document weights that
+are computed once at startup.
+
+usage: python query_server.py --port 8765
+       curl -d '{"intervals": [2, 2, -4, 1]}' localhost:8765/query
+"""
+
+METRICS = ("bm25", "pln", "lcs", "levenshtein")
+MAX_BODY = 64 * 1024 * 1024
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+def _parseUpload(cache, filename, data):
+    # runs in a worker process with the cache of the server. music21 picks the format
+    # from the extension, so the upload is written to a temporary file with the same one
+    suffix = os.path.splitext(filename)[1] or ".xml"
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # features are cached by content hash, so uploading the same file twice parses it once
+        return cache.getOrExtract(path, extractFile)
+    finally:
+        os.remove(path)
+
+
+class QueryServer(object):
+
+    def __init__(self, manager, workers=WORKERS, max_batch=32, batch_window=0.005, history=1000, cache=FEATURE_CACHE):
+        """
+        :param manager: corpus to search (see buildCorpusManager)
+        :type manager: CorpusManager
+        :param workers: number of processes parsing uploads
+        :type workers: int
+        :param max_batch: most queries scored together
+        :type max_batch: int
+        :param batch_window: seconds the first query of a batch waits for others to arrive
+        :type batch_window: float
+        :param history: number of recent request latencies kept for /stats
+        :type history: int
+        :param cache: feature cache the uploads are parsed into, usually the one the
+        manager was built with
+        :type cache: FeatureCache
+        """
+        self.manager = manager
+        self.cache = cache
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        # the scoring runs in threads, and forking a process that has threads can deadlock
+        # the child on a lock some thread was holding. spawned workers start clean
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.latencies = deque(maxlen=history)
+        self.served = 0
+        self.queue = None
+
+        corpus = manager.horizontal
+        ranker = corpus.ranker
+        self.names = manager.works()
+        self.intervals = list(corpus.reference_corpus)
+        self.vectors = np.asarray(corpus.corpus, dtype=float)
+        # the candidates never change while the server runs, so their weights are computed once
+        self.weights = {
+            "bm25": ranker.engine.documentWeights(self.vectors, "bm25", ranker.B),
+            "pln": ranker.engine.documentWeights(self.vectors, "pln", ranker.B, ranker.K)
+        }
+
+    def _stringScores(self, intervals, candidates):
+        return {
+            "lcs": [lcsLength(intervals, self.intervals[c]) for c in candidates],
+            "levenshtein": [levenshteinDistance(intervals, self.intervals[c]) for c in candidates]
+        }
+
+    def _scoreBatch(self, batch):
+        # runs in a thread. batch is a list of (intervals, count, metric)
+        queries = np.array([self.manager.vectorize(intervals) for intervals, _, _ in batch], dtype=float)
+        vector_scores = {method: np.dot(queries, weights.T) for method, weights in self.weights.items()}
+        results = []
+        everything = list(range(len(self.names)))
+        for row, (intervals, count, metric) in enumerate(batch):
+            scores = {method: vector_scores[method][row] for method in vector_scores}
+            if metric in scores:
+                # rank by a vector score, the string scores are only needed for the matches
+                order = sorted(everything, key=lambda c: (-scores[metric][c], c))[:count]
+                strings = self._stringScores(intervals, order)
+            else:
+                strings = self._stringScores(intervals, everything)
+                sign = -1 if metric == "lcs" else 1
+                ranked = sorted(everything, key=lambda c: (sign * strings[metric][c], c))[:count]
+                strings = {name: [values[c] for c in ranked] for name, values in strings.items()}
+                order = ranked
+            results.append([
+                {
+                    "work": self.names[c],
+                    "bm25": float(scores["bm25"][c]),
+                    "pln": float(scores["pln"][c]),
+                    "lcs": strings["lcs"][i],
+                    "levenshtein": strings["levenshtein"][i]
+                }
+                for i, c in enumerate(order)
+            ])
+        return results
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # give queries arriving at the same time a moment to join the batch
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            started = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(None, self._scoreBatch, [request for request, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for result, (_, future, queued) in zip(results, batch):
+                if not future.done():
+                    future.set_result((result, started - queued, time.perf_counter() - started))
+
+    async def query(self, body):
+        """answer one /query request.
+
+        :param body: decoded json body, see the top of this file
+        :type body: dict
+        :rtype: dict
+        """
+        received = time.perf_counter()
+        if not isinstance(body, dict):
+            raise ValueError("The body must be a json object")
+        count = body.get("count", 10)
+        if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+            raise ValueError("'count' must be a positive integer")
+        metric = body.get("metric", "bm25")
+        if metric not in METRICS:
+            raise ValueError("Unknown metric {0}. Use one of {1}".format(metric, METRICS))
+
+        parse = 0.0
+        if "intervals" in body:
+            intervals = [int(i) for i in body["intervals"]]
+        elif "data" in body:
+            data = base64.b64decode(body["data"])
+            features = await asyncio.get_running_loop().run_in_executor(
+                self.pool, _parseUpload, self.cache, body.get("filename", "upload.xml"), data)
+            intervals = features["intervals"]
+            parse = time.perf_counter() - received
+        else:
+            raise ValueError("Send either 'intervals' or an upload in 'data'")
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(((intervals, count, metric), future, time.perf_counter()))
+        matches, queued, scored = await future
+
+        total = time.perf_counter() - received
+        self.served += 1
+        self.latencies.append(total)
+        return {
+            "metric": metric,
+            "matches": matches,
+            "latency_ms": {
+                "parse": 1000 * parse,
+                "queue": 1000 * queued,
+                "score": 1000 * scored,
+                "total": 1000 * total
+            }
+        }
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        percentile = lambda p: 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+        return {
+            "served": self.served,
+            "works": len(self.names),
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)}
+        }
+
+    async def _respond(self, writer, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        head = "HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\nConnection: close\r\n\r\n".format(
+            status, STATUS[status], len(body))
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+        writer.close()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ("\r\n", "\n", ""):
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return await self._respond(writer, 400, {"error": "Malformed request"})
+            method, path = request_line[0], request_line[1]
+
+            if method == "GET" and path == "/health":
+                return await self._respond(writer, 200, "ok")
+            if method == "GET" and path == "/stats":
+                return await self._respond(writer, 200, self.stats())
+            if method != "POST" or path != "/query":
+                return await self._respond(writer, 404, {"error": "Use POST /query, GET /stats or GET /health"})
+
+            length = headers.get("content-length", "0")
+            if not length.isdigit():
+                return await self._respond(writer, 400, {"error": "Malformed Content-Length"})
+            length = int(length)
+            if length > MAX_BODY:
+                return await self._respond(writer, 413, {"error": "Request body too large"})
+            try:
+                # malformed json and bodies that are not utf-8 are ValueErrors as well
+                body = json.loads((await reader.readexactly(length)).decode("utf-8"))
+                result = await self.query(body)
+            except asyncio.IncompleteReadError:
+                return await self._respond(writer, 400, {"error": "Request body shorter than its Content-Length"})
+            except (ValueError, KeyError, TypeError) as e:
+                return await self._respond(writer, 400, {"error": str(e)})
+            await self._respond(writer, 200, result)
+        except Exception as e:
+            try:
+                await self._respond(writer, 500, {"error": str(e)})
+            except Exception:
+                pass
+
+    async def serve(self, host="127.0.0.1", port=8765, unix_socket=None):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self._batcher())
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+            print("Serving {0} works on {1}".format(len(self.names), unix_socket))
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print("Serving {0} works on http://{1}:{2}".format(len(self.names), host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve plagiarism screening queries against the case catalog")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", help="listen on this unix socket instead of tcp")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="processes parsing uploads and building the corpus")
+    parser.add_argument("--cache-dir", help="feature cache directory (default: .cache/features)")
+    parser.add_argument("--vector-min", type=int, help="default: smallest interval of the corpus")
+    parser.add_argument("--vector-max", type=int, help="default: largest interval of the corpus")
+    parser.add_argument("--b", type=float, default=0.75)
+    parser.add_argument("--k", type=float, default=1.2)
+    parser.add_argument("--max-batch", type=int, default=32, help="most queries scored together")
+    parser.add_argument("--batch-window", type=float, default=5, help="milliseconds a batch waits for more queries")
+    parser.add_argument("--profile", help="record every stage and write the summary / chrome trace here on exit")
+    args = parser.parse_args()
+
+    if args.profile:
+        PROFILER.profileTo(args.profile)
+    cache = FEATURE_CACHE if args.cache_dir is None else FeatureCache(args.cache_dir, EXTRACTOR_VERSION)
+    manager = buildCorpusManager(parseData(CASES_XML), args.vector_min, args.vector_max, b=args.b, k=args.k, workers=args.workers, cache=cache)
+    server = QueryServer(manager, workers=args.workers, max_batch=args.max_batch, batch_window=args.batch_window / 1000.0, cache=cache)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
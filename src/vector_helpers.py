@@ -5,10 +5,27 @@ import os
 from pathlib import Path
 from collections import Counter
 from math import inf
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from bisect import bisect_right
 
-from music21.converter import Converter, parse
+from lib.instrumentation.profiler import PROFILER, instrument
+from lib.preprocess.feature_cache import FeatureCache
+from lib.preprocess.feature_store import FeatureStore
+from lib.preprocess.corpus_stats import CorpusStats, corpusFingerprint
+from lib.preprocess.lazy_corpus import LazyCorpus
+from lib.preprocess.vocabulary import Vocabulary
+from lib.preprocess.hashed_features import NgramFeatures
+from lib.preprocess.score_reader import readScore, UnsupportedScore, isArchive, openArchive
+from lib.music_ranker.scoring_engine import DocFreqCounter
 
-from constants import DATA_DIR, CASES_XML
+from constants import DATA_DIR, CASES_XML, CACHE_DIR, STORE_DIR, STATS_DIR
+
+# bump whenever streamToIntervals, parseMeasures, extractFeatures or the readers change
+# so that cached features are recomputed
+EXTRACTOR_VERSION = "5"
+
+FEATURE_CACHE = FeatureCache(CACHE_DIR, EXTRACTOR_VERSION)
 
 
 def streamToIntervals(stream):
@@ -21,8 +38,214 @@ def streamToIntervals(stream):
     melody = stream.parts[0]
     melody = melody.pitches
     melody = [pitch.diatonicNoteNum for pitch in melody]
-    melody = [melody[i+1] - melody[i] for i in range(len(melody)-1)]
-    return melody
+    return pitchesToIntervals(melody)
+
+def pitchesToIntervals(pitches):
+    """Takes a list of diatonic note numbers and returns the
+    intervals between each consecutive pair.
+
+    :param pitches: list of ints representing diatonic note numbers
+    :type pitches: list
+    :return: list of intervals
+    :rtype: list
+    """
+    return [pitches[i+1] - pitches[i] for i in range(len(pitches)-1)]
+
+def extractFeatures(stream, file=None):
+    """Takes a music21 stream and derives every representation we use
+    from it in one go. The result is json serializable so it can be cached.
+
+    Every part (or midi track) is walked once, and that one walk yields both the
+    notes of the part and the pitch classes of its measures, so the cost of the
+    extraction does not grow with the number of representations. "pitches" and
+    "intervals" are those of the first part, like streamToIntervals, "durations"
+    the length in quarter notes of the note or chord each of its pitches belongs to
+    and "measures" the number of the measure that note starts in. "parts" holds the
+    intervals of every part and "melody" the part that most likely carries the tune
+    (see melodyPart).
+
+    :param stream: music21 stream/score
+    :type stream: music21.Stream
+    :param file: optional file the stream was parsed from, for the profiler
+    :type file: str
+    :return: dict with the melody pitches, durations, intervals and measure words,
+    the parts and the index of the melody part
+    :rtype: dict
+    """
+    with PROFILER.stage("extractParts", file=file):
+        parts = []
+        for part in _scoreParts(stream):
+            measures, made = _measures(part)
+            measures = list(measures)
+            # makeNotation splits notes at the barlines and moves overlapping notes into
+            # voices, which changes their order. the notes are read from the part itself
+            notes = _madeNotes(part, measures) if made else None
+            parts.append(([(measure.number, _notes(measure)) for measure in measures], notes))
+        return featuresFromParts(parts, file=file)
+
+def featuresFromParts(parts, file=None):
+    """derive the features of extractFeatures from the notes of every part, however
+    they were read (from a music21 stream, or by lib/preprocess/score_reader.py).
+
+    :param parts: (measures, notes) of every part. measures holds (measure number,
+    notes of the measure) for every measure, a note being (diatonic note numbers,
+    length in quarter notes). notes is the notes of the part in order, each with the
+    number of the measure it starts in as a third item, or None when they are those
+    of its measures
+    :type parts: list
+    :param file: optional file the parts were read from, for the profiler
+    :type file: str
+    :rtype: dict
+    """
+    # pitch classes of every measure number, merged across the parts
+    pitch_classes = {}
+    summaries = []
+    first_pitches = []
+    first_durations = []
+    first_measures = []
+    for index, (measures, notes) in enumerate(parts):
+        events = []
+        # number of the measure every event starts in
+        starts = []
+        for number, (_, measure) in zip(_measureNumbers([number for number, _ in measures]), measures):
+            classes = pitch_classes.setdefault(number, set())
+            for chord, _ in measure:
+                classes.update([pitch % 12 for pitch in chord])
+            events.extend(measure)
+            starts.extend([number] * len(measure))
+        if notes is not None:
+            events = [(chord, length) for chord, length, _ in notes]
+            starts = [number for _, _, number in notes]
+        pitches = [pitch for chord, _ in events for pitch in chord]
+        if index == 0:
+            first_pitches = pitches
+            first_durations = [length for chord, length in events for _ in chord]
+            first_measures = [number for (chord, _), number in zip(events, starts) for _ in chord]
+        summaries.append({
+            "intervals": pitchesToIntervals(pitches),
+            "notes": len(events),
+            "chords": sum(1 for chord, _ in events if len(chord) > 1),
+            "mean_pitch": sum(pitches) / len(pitches) if pitches else 0.0
+        })
+    words = _classesToWords(pitch_classes)
+    PROFILER.annotate(file, notes=len(first_pitches), measure_words=len(words), parts=len(summaries))
+    return {
+        "pitches": first_pitches,
+        "durations": first_durations,
+        "measures": first_measures,
+        "intervals": summaries[0]["intervals"] if summaries else [],
+        "words": words,
+        "parts": summaries,
+        "melody": melodyPart(summaries)
+    }
+
+def melodyPart(parts):
+    """index of the part most likely to carry the melody. Tunes are mostly one note
+    at a time, move in steps and lie above the accompaniment, so every part with at
+    least two notes is scored on
+
+        the share of its notes that are not chords
+        the share of its intervals that are at most a third
+        its mean pitch, scaled from 0 (lowest part) to 1 (highest part)
+
+    and the highest total wins, the earlier part on a tie.
+
+    :param parts: the "parts" of the features of a work (see extractFeatures)
+    :type parts: list
+    :rtype: int
+    """
+    candidates = [i for i, part in enumerate(parts) if part["notes"] >= 2]
+    if not candidates:
+        return 0
+    low = min(parts[i]["mean_pitch"] for i in candidates)
+    high = max(parts[i]["mean_pitch"] for i in candidates)
+
+    def score(i):
+        part = parts[i]
+        monophony = 1 - part["chords"] / part["notes"]
+        intervals = part["intervals"]
+        steps = sum(1 for interval in intervals if abs(interval) <= 2) / len(intervals) if intervals else 0.0
+        height = (part["mean_pitch"] - low) / (high - low) if high > low else 0.5
+        return monophony + steps + height
+
+    return max(candidates, key=lambda i: (score(i), -i))
+
+def extractFile(filePath):
+    """extract the features of a file. It is read with the light readers of
+    score_reader.py, which give the same features without building a music21
+    stream, and only parsed with music21 when they decline it.
+
+    :param filePath: path to an xml, mxl or midi file
+    :type filePath: str
+    :rtype: dict
+    """
+    try:
+        with PROFILER.stage("read", file=filePath):
+            parts = readScore(filePath)
+    except UnsupportedScore:
+        parts = None
+    if parts is not None:
+        PROFILER.count("reader", "read")
+        with PROFILER.stage("extractParts", file=filePath):
+            return featuresFromParts(parts, file=filePath)
+    PROFILER.count("reader", "fallback")
+    # music21 is slow to import, only pay for it when we actually parse
+    from music21.converter import parse, parseData
+    with PROFILER.stage("parse", file=filePath):
+        if isArchive(filePath):
+            # the same score the reader and the feature cache see, decompressed in memory
+            with openArchive(filePath) as score:
+                stream = parseData(score.read(), format="musicxml")
+        else:
+            stream = parse(filePath)
+    return extractFeatures(stream, file=filePath)
+
+def scorePath(file, data_dir=DATA_DIR):
+    """path of a file of the dataset. The dataset names the MusicXML works
+    name.xml, they are read from the compressed name.mxl archive when data_dir
+    holds that instead (see openArchive), so new works need not be unzipped.
+
+    :param file: file name relative to data_dir
+    :type file: str
+    :param data_dir: directory containing the data files
+    :type data_dir: str
+    :rtype: str
+    """
+    filePath = os.path.join(data_dir, file)
+    stem, extension = os.path.splitext(filePath)
+    if extension.lower() == ".xml" and not os.path.exists(filePath) and os.path.exists(stem + ".mxl"):
+        return stem + ".mxl"
+    return filePath
+
+def catalogName(file):
+    """name of a file in the catalog, the reverse of scorePath: the file name without
+    its directory, with a compressed name.mxl archive named name.xml like the dataset
+    names it.
+
+    :param file: path or name of a score
+    :type file: str
+    :rtype: str
+    """
+    stem, extension = os.path.splitext(os.path.basename(file))
+    return stem + ".xml" if extension.lower() == ".mxl" else stem + extension
+
+def loadFeatures(file, data_dir=DATA_DIR, cache=FEATURE_CACHE):
+    """get the features for a file in the dataset, reading them from the
+    feature cache when possible and parsing the file otherwise.
+
+    :param file: file name relative to data_dir
+    :type file: str
+    :param data_dir: directory containing the data files
+    :type data_dir: str
+    :param cache: feature cache to use, or None to always parse
+    :type cache: FeatureCache
+    :return: dict with the melody pitches, intervals and measure words
+    :rtype: dict
+    """
+    filePath = scorePath(file, data_dir)
+    if cache is None:
+        return extractFile(filePath)
+    return cache.getOrExtract(filePath, extractFile)
 
 def intervalToVector(intervalList, start=-30, end=30):
     """Takes a list of intervals ie [0,2,-3,...] and converts
@@ -44,86 +267,553 @@ def intervalToVector(intervalList, start=-30, end=30):
     result = [counter[i] for i in range(start,end+1)]
     return result
 
-def getMaxIntervals(cases):
+def getMaxIntervals(cases, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats_dir=STATS_DIR):
     """takes a cases dictionary, reads each of the files in question,
     and determines the min an max intervals present in the dataset. This
     information is used to optimize the size of the vectors we use to
     store the music.
 
+    The statistics persisted by an earlier run over the same files are reused,
+    otherwise they are collected while extracting the features (see CorpusStats).
+
     :param cases: case information
     :type cases: dict
+    :param stats_dir: directory the corpus statistics are persisted to, or None to not persist them
+    :type stats_dir: str
+    :return: (min interval, max interval)
+    :rtype: tuple
     """
-    min_interval = inf
-    max_interval = -inf
+    return corpusStats(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache, stats_dir=stats_dir).intervalRange()
 
-def buildCorpus(cases, vertical=False, vectors=False, vector_min=-30, vector_max=30):
-    """Iterates over each case to parse the data into interval notation,
-    adding each work to a list so that we can build a corpus.
+def _fingerprint(cases, data_dir, cache):
+    # the cache key covers the file contents and the extractor version, and the
+    # file hashes are memoized so this reads nothing twice in a process
+    cache = cache if cache is not None else FEATURE_CACHE
+    return corpusFingerprint(cache.key(scorePath(file, data_dir)) for file in dict.fromkeys(corpusFiles(cases)))
+
+def corpusStats(cases, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats_dir=STATS_DIR):
+    """statistics of the corpus (see lib/preprocess/corpus_stats.py), read back when
+    they were persisted for the same files, collected during extraction otherwise.
 
     :param cases: cases dictionary
     :type cases: dict
+    :param stats_dir: directory the statistics are persisted to, or None to not persist them
+    :type stats_dir: str
+    :rtype: CorpusStats
     """
-    corpus = []
+    if stats_dir is not None:
+        fingerprint = _fingerprint(cases, data_dir, cache)
+        stats = CorpusStats.load(os.path.join(stats_dir, fingerprint + ".json"), fingerprint)
+        if stats is not None:
+            return stats
+    stats = CorpusStats()
+    # streamed, so only one work is held in memory at a time
+    corpus = lazyCorpus(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache)
+    for file, features in zip(corpus.files, corpus):
+        stats.add(file, features)
+    _saveStats(stats, cases, data_dir, cache, stats_dir)
+    return stats
+
+def _saveStats(stats, cases, data_dir, cache, stats_dir):
+    # one file per corpus, so runs over different corpora do not overwrite each other
+    if stats_dir is not None:
+        fingerprint = _fingerprint(cases, data_dir, cache)
+        stats.save(os.path.join(stats_dir, fingerprint + ".json"), fingerprint)
 
+def _vectorRange(stats, vector_min, vector_max):
+    # bounds that were not given are taken from the corpus statistics
+    low, high = stats.intervalRange()
+    return (low if vector_min is None else vector_min), (high if vector_max is None else vector_max)
+
+def corpusFiles(cases):
+    """list the file of every work in corpus order: the complaintant then the
+    defendant of each case, in the order of the cases dictionary.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :rtype: list
+    """
+    files = []
     for key, case in cases.items():
-        # get the file name and type or the defendant and complaintant
-        c_file = case["complaintant"]["file"]
-        c_type = case["complaintant"]["fileType"]
-        d_file = case["defendant"]["file"]
-        d_type = case["defendant"]["fileType"]
-
-        # get the complaintant as a list of intervals
-        complaintant = parse(DATA_DIR + "/" + c_file)
-        # get the defendant as a list of intervals
-        defendant = parse(DATA_DIR + "/" + d_file)
-
-        if not vertical:
-            # get the melodies
-            c = streamToIntervals(complaintant)
-            d = streamToIntervals(defendant)
-
-            if vectors:
-                c = intervalToVector(c, vector_min, vector_max)
-                d = intervalToVector(d, vector_min, vector_max)
+        files.append(case["complaintant"]["file"])
+        files.append(case["defendant"]["file"])
+    return files
+
+def _extractAndStore(filePath, cache, profile=None):
+    # runs in a worker process. the worker writes its own cache entry so the
+    # parent only has to collect the features
+    if profile is not None:
+        # a forked worker starts with a copy of the parent's records, only send back its own
+        PROFILER.reset()
+        PROFILER.enable(memory=profile)
+    features = extractFile(filePath)
+    if cache is not None:
+        cache.put(filePath, features)
+    if profile is not None:
+        return features, PROFILER.drain()
+    return features
+
+def _extractMissing(paths, cache, workers, chunksize):
+    # parse the files across a pool of processes, yielding their features in input order
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            yield _extractAndStore(path, cache)
+        return
+    # workers record into their own profiler, the records come back with the features
+    profile = PROFILER.memory if PROFILER.enabled else None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map returns results in input order no matter which worker finishes first
+        for work in pool.map(_extractAndStore, paths, [cache] * len(paths), [profile] * len(paths), chunksize=chunksize):
+            if profile is not None:
+                work, state = work
+                PROFILER.merge(state)
+            yield work
+
+@instrument("extractCorpusFeatures")
+def extractCorpusFeatures(cases, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats=None):
+    """get the features of every work in the corpus, parsing the cache misses
+    across a pool of processes. Every file is parsed at most once, even when a
+    work appears in several cases.
 
+    :param cases: cases dictionary
+    :type cases: dict
+    :param workers: number of worker processes. None uses one per cpu, 1 parses in this process
+    :type workers: int
+    :param chunksize: number of files handed to a worker at a time
+    :type chunksize: int
+    :param data_dir: directory containing the data files
+    :type data_dir: str
+    :param cache: feature cache to use, or None to always parse
+    :type cache: FeatureCache
+    :param stats: optional corpus statistics to collect from the features as they are extracted
+    :type stats: CorpusStats
+    :return: one features dict per work, in corpus order (see corpusFiles)
+    :rtype: list
+    """
+    files = corpusFiles(cases)
+    features = {}
+    missing = []
+    # dict.fromkeys keeps the first occurrence of each file, so the order is deterministic
+    for file in dict.fromkeys(files):
+        cached = cache.get(scorePath(file, data_dir)) if cache is not None else None
+        if cached is None:
+            missing.append(file)
         else:
-            # get the 'words' from the works
-            c = parseMeasures(complaintant)
-            d = parseMeasures(defendant)
+            features[file] = cached
+
+    paths = [scorePath(file, data_dir) for file in missing]
+    features.update(zip(missing, _extractMissing(paths, cache, workers, chunksize)))
+
+    if stats is not None:
+        for file in dict.fromkeys(files):
+            stats.add(file, features[file])
+
+    return [features[file] for file in files]
+
+@instrument("buildCorpora")
+def buildCorpora(cases, vector_min=None, vector_max=None, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats_dir=STATS_DIR):
+    """build the interval, vector and measure word corpora in a single extraction
+    pass over the works (see extractCorpusFeatures). The corpus statistics are
+    collected in the same pass, and vector bounds that are not given are taken from
+    them so the vectors are exactly as wide as the intervals of the corpus.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :param stats_dir: directory the corpus statistics are persisted to, or None to not persist them
+    :type stats_dir: str
+    :return: dict with the "intervals", "vectors" and "words" corpora, each in corpus order,
+    the "stats" of the corpus and the vector "range" (vector_min, vector_max)
+    :rtype: dict
+    """
+    stats = CorpusStats()
+    features = extractCorpusFeatures(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache, stats=stats)
+    _saveStats(stats, cases, data_dir, cache, stats_dir)
+    vector_min, vector_max = _vectorRange(stats, vector_min, vector_max)
+    return {
+        "intervals": [work["intervals"] for work in features],
+        "vectors": [intervalToVector(work["intervals"], vector_min, vector_max) for work in features],
+        "words": [work["words"] for work in features],
+        "stats": stats,
+        "range": (vector_min, vector_max)
+    }
+
+def lazyCorpus(cases, distinct=True, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, files=None):
+    """a corpus that loads the features of a work only when it is read (see
+    lib/preprocess/lazy_corpus.py). Works missing from the feature cache are parsed
+    up front across a pool of processes, so reading the corpus only touches the cache.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :param distinct: every file once, in the order it first appears. Otherwise the
+    works are in corpus order (see corpusFiles), where a file can appear several times
+    :type distinct: bool
+    :param cache: feature cache to use, or None to parse a work every time it is read
+    :type cache: FeatureCache
+    :param files: works to read instead of those of the cases, e.g. every file of
+    buildCounterparts, which keeps works whose titles collide in the cases dictionary
+    :type files: list
+    :rtype: LazyCorpus
+    """
+    files = corpusFiles(cases) if files is None else list(files)
+    if cache is not None:
+        paths = [scorePath(file, data_dir) for file in dict.fromkeys(files)]
+        # the features are only stored, the corpus reads them back when it needs them
+        for _ in _extractMissing([path for path in paths if not os.path.exists(cache.entryPath(path))], cache, workers, chunksize):
+            pass
+    return LazyCorpus(dict.fromkeys(files) if distinct else files, partial(loadFeatures, data_dir=data_dir, cache=cache))
+
+@instrument("buildLazyCorpora")
+def buildLazyCorpora(cases, vector_min=None, vector_max=None, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats_dir=STATS_DIR):
+    """the lazy counterpart of buildCorpora. The corpora are views over one LazyCorpus,
+    and the doc freq and avdl of the interval vectors and of the measure word vectors,
+    together with the measure word vocabulary, are computed in a single streaming pass,
+    so memory stays flat however large the catalog is.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :return: dict with the "intervals", "vectors", "words" and "word_vectors" views in
+    corpus order, the "vocab" of the measure words, the vector "range" and the
+    scoring "engines" of the "vectors" and "word_vectors" (see MusicRanker's engine argument)
+    :rtype: dict
+    """
+    corpus = lazyCorpus(cases, distinct=False, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache)
+    if vector_min is None or vector_max is None:
+        # persisted statistics are read back, so this usually costs no pass
+        stats = corpusStats(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache, stats_dir=stats_dir)
+        vector_min, vector_max = _vectorRange(stats, vector_min, vector_max)
+    vectorize = partial(intervalToVector, start=vector_min, end=vector_max)
+
+    vocab = Vocabulary()
+    horizontal = DocFreqCounter()
+    vertical = DocFreqCounter()
+
+    def countWork(features):
+        horizontal.add(vectorize(features["intervals"]), len(features["intervals"]))
+        # term ids are handed out in the order words are first seen, like Vocabulary(corpus)
+        vocab.add(features["words"])
+        vertical.add(vocab.toSparse(features["words"]), len(features["words"]))
+
+    corpus.scan(countWork)
+
+    return {
+        "intervals": corpus.intervals(),
+        "vectors": corpus.view(lambda features: vectorize(features["intervals"])),
+        "words": corpus.words(),
+        "word_vectors": corpus.view(lambda features: vocab.toSparse(features["words"])),
+        "vocab": vocab,
+        "range": (vector_min, vector_max),
+        "engines": {"vectors": horizontal.engine(), "word_vectors": vertical.engine()}
+    }
+
+def buildFeatureStore(cases, directory=STORE_DIR, vector_min=None, vector_max=None, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats_dir=STATS_DIR):
+    """write the features of every work to a memory mapped columnar store
+    (see lib/preprocess/feature_store.py) and open it. Works are stored in corpus order
+    and streamed from the feature cache into the store one at a time.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :param directory: directory to write the store to
+    :type directory: str
+    :rtype: FeatureStore
+    """
+    corpus = lazyCorpus(cases, distinct=False, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache)
+    if vector_min is None or vector_max is None:
+        # persisted statistics are read back, so this usually costs no pass
+        stats = corpusStats(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache, stats_dir=stats_dir)
+        vector_min, vector_max = _vectorRange(stats, vector_min, vector_max)
+    return FeatureStore.build(directory, corpus.files, corpus, vector_min, vector_max)
+
+def buildCorpusManager(cases, vector_min=None, vector_max=None, b=0.75, k=1.2, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats_dir=STATS_DIR):
+    """build an incremental corpus (see lib/music_ranker/corpus_manager.py) with every
+    distinct work of the cases. Later works can be added with
+    manager.add(file, loadFeatures(file)), which only parses the new file.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :rtype: CorpusManager
+    """
+    # imported here so that the extraction helpers do not pull in the ranker (and nltk)
+    from lib.music_ranker.corpus_manager import CorpusManager
+
+    stats = CorpusStats()
+    features = extractCorpusFeatures(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache, stats=stats)
+    _saveStats(stats, cases, data_dir, cache, stats_dir)
+    vector_min, vector_max = _vectorRange(stats, vector_min, vector_max)
+    manager = CorpusManager(partial(intervalToVector, start=vector_min, end=vector_max), b=b, k=k)
+    for file, work in zip(corpusFiles(cases), features):
+        # a work can be part of several cases, it is only added once
+        if file not in manager:
+            manager.add(file, work)
+    return manager
+
+def buildPartIndex(cases, vector_min=None, vector_max=None, b=0.75, k=1.2, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE):
+    """build an index where every part of every distinct work is a document of its own
+    (see lib/music_ranker/part_index.py). Vector bounds that are not given cover the
+    intervals of every part.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :rtype: PartIndex
+    """
+    # imported here so that the extraction helpers do not pull in the ranker (and nltk)
+    from lib.music_ranker.part_index import PartIndex
+
+    corpus = lazyCorpus(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache)
+    # only the parts are kept, one work is loaded at a time
+    works = [(file, {"parts": features["parts"], "melody": features["melody"]}) for file, features in zip(corpus.files, corpus)]
+    intervals = [interval for _, work in works for part in work["parts"] for interval in part["intervals"]]
+    if vector_min is None:
+        vector_min = min(intervals) if intervals else -20
+    if vector_max is None:
+        vector_max = max(intervals) if intervals else 20
+    return PartIndex(works, partial(intervalToVector, start=vector_min, end=vector_max), b=b, k=k)
+
+def buildPassageIndex(cases, k=4, band=4, window=16, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE):
+    """build the seed index of the passage finder over every distinct work
+    (see lib/music_ranker/passage_index.py).
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :rtype: PassageIndex
+    """
+    from lib.music_ranker.passage_index import PassageIndex
+
+    corpus = lazyCorpus(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache)
+    # only the intervals and their measures are kept, one work is loaded at a time
+    works = ((file, {"intervals": features["intervals"], "measures": features.get("measures")}) for file, features in zip(corpus.files, corpus))
+    return PassageIndex(works, k=k, band=band, window=window)
+
+def buildFusionRanker(cases, vertical=False, fusion="rrf", weights=None, rrf_k=60, b=0.75, k=1.2, vector_min=None, vector_max=None, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats_dir=STATS_DIR, files=None):
+    """build a ranker that scores every distinct work with all metrics in one pass and
+    fuses them (see lib/music_ranker/fusion_ranker.py). The vectors, sequences and doc
+    freq come out of a single streaming pass over the works. Work i is queried with
+    ranker.vectors[i] and ranker.sequences[i], any other work with
+    ranker.rankSequence(its intervals, or its measure words when vertical).
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :param vertical: score the measure words (sparse vectors) instead of the intervals
+    :type vertical: bool
+    :param fusion: 'weighted' or 'rrf'
+    :type fusion: str
+    :param weights: metric -> weight, see FusionRanker
+    :type weights: dict
+    :param files: works to rank instead of those of the cases, see lazyCorpus. The vector
+    bounds still come from the statistics of the cases
+    :type files: list
+    :rtype: FusionRanker
+    """
+    from lib.music_ranker.fusion_ranker import FusionRanker
+
+    corpus = lazyCorpus(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache, files=files)
+    if not vertical and (vector_min is None or vector_max is None):
+        stats = corpusStats(cases, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache, stats_dir=stats_dir)
+        vector_min, vector_max = _vectorRange(stats, vector_min, vector_max)
+    vocab = Vocabulary()
+    vectorize = vocab.toSparse if vertical else partial(intervalToVector, start=vector_min, end=vector_max)
+    counter = DocFreqCounter()
+    vectors = []
+    sequences = []
+    for features in corpus:
+        sequence = features["words"] if vertical else features["intervals"]
+        if vertical:
+            vocab.add(sequence)
+        vector = vectorize(sequence)
+        counter.add(vector, len(sequence))
+        vectors.append(vector)
+        sequences.append(sequence)
+    return FusionRanker(vectors, sequences, counter.engine(), b=b, k=k, fusion=fusion, weights=weights, rrf_k=rrf_k,
+                        names=list(corpus.files), vectorize=vectorize)
+
+def buildHashedCorpus(cases, hasher=None, dense=True, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE):
+    """hashed n-gram vectors of every work (see lib/preprocess/hashed_features.py) in
+    corpus order, built in one streaming pass that also computes their doc freq and avdl.
+    Score them with MusicRanker(corpus["vectors"], engine=corpus["engine"]).
 
-        # add both works to the corpus
-        corpus.append(c)
-        corpus.append(d)
+    :param cases: cases dictionary
+    :type cases: dict
+    :param hasher: feature engine to use, NgramFeatures() by default
+    :type hasher: NgramFeatures
+    :param dense: dense vectors of hasher.width slots, or sparse dicts
+    :type dense: bool
+    :return: dict with the "vectors" and their scoring "engine"
+    :rtype: dict
+    """
+    hasher = hasher if hasher is not None else NgramFeatures()
+    corpus = lazyCorpus(cases, distinct=False, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache)
+    # dense vectors have every slot, even ones no work hits
+    counter = DocFreqCounter(hasher.width if dense else 0)
+    vectors = []
+    for features in corpus:
+        vector = hasher.sparse(features)
+        # the length of a work is its number of tokens
+        counter.add(vector, sum(vector.values()))
+        if dense:
+            vector = [vector.get(slot, 0) for slot in range(hasher.width)]
+        vectors.append(vector)
+    return {"vectors": vectors, "engine": counter.engine()}
+
+def buildCorpus(cases, vertical=False, vectors=False, vector_min=None, vector_max=None, workers=None, chunksize=1, data_dir=DATA_DIR, cache=FEATURE_CACHE, stats_dir=STATS_DIR):
+    """Iterates over each case to parse the data into interval notation,
+    adding each work to a list so that we can build a corpus.
+
+    :param cases: cases dictionary
+    :type cases: dict
+    :param workers: number of processes used to parse the works (see extractCorpusFeatures)
+    :type workers: int
+    :param data_dir: directory containing the data files
+    :type data_dir: str
+    :param cache: feature cache to use, or None to always parse
+    :type cache: FeatureCache
+    """
+    corpora = buildCorpora(cases, vector_min, vector_max, workers=workers, chunksize=chunksize, data_dir=data_dir, cache=cache, stats_dir=stats_dir)
+    if vertical:
+        # the 'words' from the works
+        return corpora["words"]
+    if vectors:
+        return corpora["vectors"]
+    return corpora["intervals"]
+
+def _notes(stream):
+    # (diatonic note numbers, length) of every note and chord of a stream
+    return [([pitch.diatonicNoteNum for pitch in pitches], length) for pitches, length, _ in _events(stream)]
+
+def _madeNotes(part, measures):
+    # (diatonic note numbers, length, measure number) of every note and chord of a part
+    # whose measures were made, the number being that of the measure the note starts in.
+    # a note after the end of the last measure belongs to the last one
+    starts = [float(measure.offset) for measure in measures]
+    numbers = _measureNumbers([measure.number for measure in measures])
+    return [([pitch.diatonicNoteNum for pitch in pitches], length, numbers[max(bisect_right(starts, offset) - 1, 0)])
+            for pitches, length, offset in _events(part)]
+
+def _events(stream, offset=0.0):
+    """yield (pitches, length in quarter notes, offset) for every note and chord of a
+    stream, in the order stream.pitches lists them (descending into measures and voices).
+    A note has a list of one pitch, a chord the list of its pitches.
+
+    :param stream: music21 stream
+    :type stream: music21.Stream
+    :param offset: offset of the stream itself, the offsets are counted from the stream's parent
+    :type offset: float
+    """
+    for element in stream.elements:
+        if "music21.key.Key" in element.classSet:
+            continue
+        if hasattr(element, "pitch"):
+            # tuplets have Fraction lengths, which json can not store
+            yield [element.pitch], float(element.quarterLength), offset + float(element.offset)
+        elif hasattr(element, "pitches"):
+            if element.isStream:
+                yield from _events(element, offset + float(element.offset))
+            else:
+                yield list(element.pitches), float(element.quarterLength), offset + float(element.offset)
+
+def _measures(part):
+    # the measures of a part, and whether they had to be made first
+    measures = part.getElementsByClass("Measure")
+    if measures:
+        return measures, False
+    # parts without measures (midi files) get them the same way stream.measures() does
+    return part.makeNotation(inPlace=False).getElementsByClass("Measure"), True
 
-    return corpus
+def _measureNumbers(numbers):
+    # stream.measures() counts the measures from 1 when every one of them is numbered 0
+    if any(number != 0 for number in numbers):
+        return numbers
+    return list(range(1, len(numbers) + 1))
+
+def _numberMeasures(measures):
+    # a music21 StreamIterator starts over when it is iterated again, so take the list first
+    measures = list(measures)
+    return zip(_measureNumbers([measure.number for measure in measures]), measures)
+
+def _partMeasures(part):
+    """the measure numbers of a part, and an iterator over (measure number, pitch classes)
+    of its measures in the order they appear. The numbers are cheap and known up front,
+    the pitch classes of a measure are only computed when the iterator reaches it. Pitch
+    classes are diatonic note numbers with the octave disregarded.
+
+    :param part: music21 part (or any stream holding measures)
+    :type part: music21.Stream
+    :rtype: tuple
+    """
+    numbered = list(_numberMeasures(_measures(part)[0]))
+    # .pitches already descends into voices and chords, no need to flatten
+    classes = ((number, set([pitch.diatonicNoteNum % 12 for pitch in measure.pitches])) for number, measure in numbered)
+    return [number for number, _ in numbered], classes
+
+def _scoreParts(stream):
+    # a score has parts, a single part holds its measures directly
+    parts = list(stream.parts)
+    return parts if parts else [stream]
+
+def _measureWord(pitch_classes):
+    # want a string but need to differentiate 1,2 from 12
+    return ".".join([str(p) for p in sorted(pitch_classes)])
 
 def parseMeasures(stream):
     """Takes a music21 stream and builds 'words' by grouping notes
     together that occur in the same measure. These 'words' are then
     tokenized to comprise a document
 
+    Word n holds the pitch classes of measures n and n+1 across every part
+    (what stream.measures(n, n+1) selects), and the document ends at the first
+    n where neither measure exists. Each part is walked once, so the cost is
+    linear in the length of the score.
+
     :param stream: music21 stream
     :type stream: music21.Stream
     """
-    max_time = stream.highestTime
-    measure_time = 0
+    return list(iterMeasureWords(stream))
+
+def iterMeasureWords(stream):
+    """Generator version of parseMeasures, yielding the same words one at a time
+    without merging the pitch classes of the whole score first. Word n is yielded as
+    soon as no part has a measure numbered n or n + 1 left to read, so only the
+    measures read ahead of the current word are held.
+
+    The measure numbers of every part are read up front (they are cheap, the pitch
+    classes are not), so scores that renumber or skip measures give the same words
+    as reading them all.
+
+    :param stream: music21 stream
+    :type stream: music21.Stream
+    """
+    parts = []
+    for part in _scoreParts(stream):
+        numbers, classes = _partMeasures(part)
+        # the smallest measure number still to come from every position on
+        ahead = [inf] * (len(numbers) + 1)
+        for i in range(len(numbers) - 1, -1, -1):
+            ahead[i] = min(numbers[i], ahead[i + 1])
+        parts.append((ahead, classes))
+    positions = [0] * len(parts)
+
+    # pitch classes of the measures read ahead, merged across the parts
+    window = {}
     measure_number = 0
+    while True:
+        # read every part until none of its remaining measures is numbered n or n + 1
+        for index, (ahead, classes) in enumerate(parts):
+            while ahead[positions[index]] <= measure_number + 1:
+                number, pitch_classes = next(classes)
+                if number >= measure_number:
+                    window.setdefault(number, set()).update(pitch_classes)
+                positions[index] += 1
+        if measure_number not in window and measure_number + 1 not in window:
+            return
+        yield _measureWord(window.get(measure_number, set()) | window.get(measure_number + 1, set()))
+        window.pop(measure_number, None)
+        measure_number += 1
+
+def _classesToWords(pitch_classes):
+    # word n holds the pitch classes of measures n and n + 1
     words = []
-    while measure_time <= max_time:
-        # isolate the next measure
-        measure = stream.measures(measure_number, measure_number+1)
-        if measure.highestTime == 0:
-            # double safety catch. invalid measures can still be selected, but will have max time of zero
-            break
-        # get the pitches in the measure
-        pitches = measure.flat.pitches
-        # cast the pitches to ints and disregard octave
-        pitches = sorted(set([pitch.diatonicNoteNum % 12 for pitch in pitches]))
-        # want a string but need to differentiate 1,2 from 12
-        words.append(".".join([str(p) for p in pitches]))
-        # increment the measure number and take the highest time in the 
-        # measure as the new measuretime
-        measure_time = measure.highestTime
+    measure_number = 0
+    while measure_number in pitch_classes or measure_number + 1 in pitch_classes:
+        classes = pitch_classes.get(measure_number, set()) | pitch_classes.get(measure_number + 1, set())
+        words.append(_measureWord(classes))
         measure_number += 1
     return words
 